@@ -0,0 +1,219 @@
+import argparse
+import csv
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from fake_services import FakeElasticsearch, FakeGemini, FakeOllama, LatencyModel, fake_remove_backgrounds, start_server
+
+# --- 離線基準測試：以本機模擬的 Ollama、Gemini 與 Elasticsearch 跑完整的導入與推薦流程 ---
+# 用法: python benchmark.py --ollama-latency 0.5 --gemini-latency 2 --es-latency 0.01
+# 去背、LLM 與 Elasticsearch 都由 fake_services 以可設定的延遲模擬，完全不需要網路 (rembg 第一次使用時會下載模型)，
+# 因此可以在沒有 GPU、API 金鑰與 Elasticsearch 的機器上比較各階段的吞吐量、延遲分佈與記憶體峰值；
+# 加上 --real-matting 則改用真正的 rembg 量測去背。
+
+# --- 1. 設定 ---
+BENCHMARK_REPORT_FILENAME = "benchmark_report.csv"
+BENCHMARK_IMAGE_DIRECTORY = "./my_clothes"  # <--- 兩個導入腳本都使用同一組圖片，結果才能比較
+REPORT_HEADERS = ["stage", "count", "total_seconds", "throughput_per_second", "p50_ms", "p95_ms", "peak_rss_mb"]
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# --- 2. 計時 ---
+def peak_rss_mb():
+    """本行程與子行程 (去背行程池) 的最大常駐記憶體 (Linux 上 ru_maxrss 以 KB 為單位)"""
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (self_kb + children_kb) / 1024
+
+class StageTimer:
+    """記錄每個階段每次呼叫的秒數，以及該階段最後一次呼叫結束時的記憶體峰值"""
+    def __init__(self):
+        self._samples = {}
+        self._peak_rss = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        rss = peak_rss_mb()
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+            self._peak_rss[stage] = rss
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage(*args, **kwargs) if callable(stage) else stage, time.perf_counter() - start_time)
+        return timed
+
+    def wrap_generator(self, stage, fn):
+        """產生器的每一筆結果都計入一次：從開始等待到拿到這一筆的時間"""
+        def timed(*args, **kwargs):
+            iterator = iter(fn(*args, **kwargs))
+            while True:
+                start_time = time.perf_counter()
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+                self.record(stage, time.perf_counter() - start_time)
+                yield value
+        return timed
+
+    def rows(self):
+        rows = []
+        for stage, samples in self._samples.items():
+            values = np.array(samples)
+            total = float(values.sum())
+            rows.append({
+                "stage": stage,
+                "count": len(values),
+                "total_seconds": round(total, 3),
+                "throughput_per_second": round(len(values) / total, 2) if total > 0 else "",
+                "p50_ms": round(float(np.percentile(values, 50)) * 1000, 1),
+                "p95_ms": round(float(np.percentile(values, 95)) * 1000, 1),
+                "peak_rss_mb": round(self._peak_rss[stage], 1),
+            })
+        return rows
+
+# --- 3. 模擬環境 ---
+def start_fake_services(args):
+    """啟動三個模擬伺服器並設定環境變數，必須在匯入導入與推薦腳本之前呼叫"""
+    ollama = FakeOllama(LatencyModel(args.ollama_latency, args.jitter, seed=1), load_seconds=args.ollama_load_latency)
+    gemini = FakeGemini(LatencyModel(args.gemini_latency, args.jitter, seed=2))
+    elasticsearch = FakeElasticsearch(LatencyModel(args.es_latency, args.jitter, seed=3))
+    servers = {}
+    for name, service in (("ollama", ollama), ("gemini", gemini), ("elasticsearch", elasticsearch)):
+        servers[name] = start_server(service)
+        print(f"  -> 模擬 {name} 伺服器: {servers[name][1]}")
+    os.environ["OLLAMA_BASE_URL"] = servers["ollama"][1]
+    os.environ["GEMINI_API_ENDPOINT"] = servers["gemini"][1]
+    os.environ["ES_HOST"] = servers["elasticsearch"][1]
+    os.environ["GOOGLE_API_KEY"] = "fake-benchmark-key"
+    # 每次都要真的送出請求，量到的才是各階段的延遲
+    os.environ["LLM_CACHE"] = "0"
+    return servers, ollama
+
+def prepare_workdir(reuse_matting_cache):
+    """在暫存資料夾中執行，去背結果、感知雜湊索引與報告都不會寫進專案資料夾"""
+    workdir = tempfile.mkdtemp(prefix="closet_benchmark_")
+    for name in ("my_clothes", "prompts"):
+        os.symlink(os.path.join(SCRIPT_DIRECTORY, name), os.path.join(workdir, name))
+    if reuse_matting_cache and os.path.isdir(os.path.join(SCRIPT_DIRECTORY, ".matting_cache")):
+        shutil.copytree(os.path.join(SCRIPT_DIRECTORY, ".matting_cache"), os.path.join(workdir, ".matting_cache"))
+    return workdir
+
+recommend_pipeline_backend = ["ollama"]  # 目前執行中的推薦後端，兩個推薦腳本共用的步驟依此命名階段
+
+def instrument(timer, args):
+    """把計時包在各階段的函式外面；模組以 from ... import 取得的名稱要在各自的模組中替換"""
+    import closet_index
+    import llm_client
+    import ingest_clothes
+    import ingest_gemini
+    import recommend_outfits
+    import recommend_outfits_gemini
+    import recommend_pipeline
+
+    # 預設以模擬去背取代 rembg，整個基準測試不需要下載任何模型
+    matting_latency = LatencyModel(args.matting_latency, args.jitter, seed=4)
+    for module in (ingest_clothes, ingest_gemini):
+        if args.real_matting:
+            remove_backgrounds = module.iter_remove_backgrounds
+        else:
+            remove_backgrounds = lambda image_paths: fake_remove_backgrounds(image_paths, matting_latency)
+        module.iter_remove_backgrounds = timer.wrap_generator("matting", remove_backgrounds)
+        module.IMAGE_DIRECTORY = BENCHMARK_IMAGE_DIRECTORY
+
+    original_call = llm_client.BackendClient.call
+    def backend_stage(client, fn, *args, **kwargs):
+        # Ollama 以模型名稱區分視覺、數據專家與推薦文案；Gemini 只有一個模型
+        model = getattr(getattr(fn, "__self__", None), "model", None)
+        return f"llm:{client.name}" + (f":{model}" if isinstance(model, str) else "")
+    llm_client.BackendClient.call = timer.wrap(backend_stage, original_call)
+    closet_index.BulkWriter.flush = timer.wrap("es_bulk", closet_index.BulkWriter.flush)
+
+    # 兩個推薦腳本共用 recommend_pipeline 的步驟函式，階段名稱依目前執行的後端區分
+    def recommend_stage(step):
+        return lambda *args, **kwargs: f"recommend_{recommend_pipeline_backend[0]}:{step}"
+    for step, name in (("query_translation", "generate_es_queries"), ("es_msearch", "search_outfit_candidates"),
+                       ("pairing", "pair_outfits"), ("text_generation", "generate_recommendation_text")):
+        setattr(recommend_pipeline, name, timer.wrap(recommend_stage(step), getattr(recommend_pipeline, name)))
+    return ingest_clothes, ingest_gemini, {"ollama": recommend_outfits, "gemini": recommend_outfits_gemini}
+
+# --- 4. 報告 ---
+def write_report(rows, filename):
+    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=REPORT_HEADERS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_report(rows):
+    print("\n" + "=" * 90)
+    print(f"{'階段':<34}{'次數':>6}{'總秒數':>10}{'每秒':>8}{'p50 ms':>10}{'p95 ms':>10}{'RSS MB':>10}")
+    print("-" * 90)
+    for row in rows:
+        print(f"{row['stage']:<36}{row['count']:>6}{row['total_seconds']:>10}{row['throughput_per_second']:>10}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['peak_rss_mb']:>10}")
+    print("=" * 90)
+
+def main():
+    parser = argparse.ArgumentParser(description="以模擬的 LLM 與 Elasticsearch 伺服器進行離線基準測試")
+    parser.add_argument("--ollama-latency", type=float, default=0.5, help="每個 Ollama 請求的推論秒數")
+    parser.add_argument("--ollama-load-latency", type=float, default=5.0, help="Ollama 切換模型時的載入秒數")
+    parser.add_argument("--gemini-latency", type=float, default=2.0, help="每個 Gemini 請求的秒數")
+    parser.add_argument("--es-latency", type=float, default=0.01, help="每個 Elasticsearch 請求的秒數")
+    parser.add_argument("--matting-latency", type=float, default=0.2, help="模擬去背時每張圖片的秒數")
+    parser.add_argument("--real-matting", action="store_true", help="改用真正的 rembg 去背 (第一次使用時會下載模型)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="延遲上下浮動的比例")
+    parser.add_argument("--recommend-runs", type=int, default=5, help="推薦流程執行幾次")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["ollama", "gemini", "recommend", "recommend_gemini"], help="略過的流程")
+    parser.add_argument("--reuse-matting-cache", action="store_true", help="搭配 --real-matting：複製專案的 .matting_cache，只量測去背以外的階段")
+    parser.add_argument("--report", default=BENCHMARK_REPORT_FILENAME, help="CSV 報告路徑")
+    args = parser.parse_args()
+    report_path = os.path.abspath(args.report)
+
+    print("--- 正在啟動模擬伺服器 ---")
+    servers, fake_ollama = start_fake_services(args)
+    workdir = prepare_workdir(args.reuse_matting_cache)
+    sys.path.insert(0, SCRIPT_DIRECTORY)
+    os.chdir(workdir)
+    print(f"  -> 工作目錄: {workdir}")
+
+    timer = StageTimer()
+    try:
+        ingest_clothes, ingest_gemini, recommenders = instrument(timer, args)
+        # 兩個導入腳本寫入同一個索引：先完整重建，第二個腳本才會處理所有圖片 (增量模式下不會有待處理的圖片)
+        ingest_clothes.INCREMENTAL_MODE = ingest_gemini.INCREMENTAL_MODE = False
+        if "ollama" not in args.skip:
+            print("\n--- [基準測試] Ollama 導入流程 ---")
+            timer.wrap("total:ingest_ollama", ingest_clothes.main)()
+            print(f"  -> Ollama 模型載入次數: {fake_ollama.model_loads}")
+        if "gemini" not in args.skip:
+            print("\n--- [基準測試] Gemini 導入流程 ---")
+            timer.wrap("total:ingest_gemini", ingest_gemini.main)()
+        for backend, skip_name in (("ollama", "recommend"), ("gemini", "recommend_gemini")):
+            if skip_name in args.skip:
+                continue
+            print(f"\n--- [基準測試] 推薦流程 ({backend}) ---")
+            recommend_pipeline_backend[0] = backend
+            for _ in range(args.recommend_runs):
+                timer.wrap(f"total:recommend_{backend}", recommenders[backend].main)()
+    finally:
+        for server, _ in servers.values():
+            server.shutdown()
+        os.chdir(SCRIPT_DIRECTORY)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    rows = timer.rows()
+    write_report(rows, report_path)
+    print_report(rows)
+    print(f"報告已寫入: {report_path}")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
-from elasticsearch import Elasticsearch
+import os
+from closet_search import open_search_client
 import json
 
 # --- 設定 ---
-ES_HOST = "http://localhost:9200"
+ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")  # 可用環境變數覆寫 (例如基準測試時指向本機的模擬伺服器)
 INDEX_NAME = "virtual_closet"
 
 def main():
     print("正在連接 Elasticsearch...")
-    es = Elasticsearch(hosts=[ES_HOST])
+    es = open_search_client(ES_HOST)
 
     # 1. 確認文件總數
     print("\n--- 1. 正在確認文件總數 ---")
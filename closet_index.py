@@ -0,0 +1,331 @@
+import argparse
+import hashlib
+import json
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from elasticsearch import Elasticsearch, helpers
+from closet_schema import KEYWORD_TAG_FIELDS, TEXT_TAG_FIELDS
+from color_extractor import COLOR_HISTOGRAM_DIMS
+from tracing import span
+
+# --- 1. 設定 ---
+ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")  # 可用環境變數覆寫 (例如基準測試時指向本機的模擬伺服器)
+INDEX_NAME = "virtual_closet"  # 查詢端使用的別名，實際資料存放在 virtual_closet_v<時間戳> 索引中
+INDEX_VERSIONS_TO_KEEP = 2     # 除了目前使用中的版本，另外保留幾個通過驗證的舊版本供回滾
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MAPPING_VERSION = 3  # 修改 build_index_mapping() 時請加 1，舊索引會在下次導入時自動重建
+HASH_CHUNK_SIZE = 1024 * 1024  # 以 1MB 為單位讀檔，避免大圖一次佔滿記憶體
+BULK_MAX_DOCS = 500                # 每批最多幾筆文件
+BULK_MAX_BYTES = 5 * 1024 * 1024   # 每批最多幾個位元組 (以 JSON 大小估算)
+BULK_MAX_RETRIES = 3               # 失敗項目最多重試幾次
+BULK_RETRY_BACKOFF_SECONDS = 1.0   # 第一次重試前等待的秒數，之後每次加倍
+
+# --- 2. 內容指紋 ---
+def compute_file_hash(file_path):
+    """以 SHA-256 計算檔案內容的指紋，同時作為 Elasticsearch 文件的 _id"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_image_directory(image_directory):
+    """列出資料夾中的所有圖片，回傳 {content_hash: image_name}
+
+    內容完全相同的檔案只會保留第一個檔名，避免同一件衣服被重複標記。
+    """
+    image_hashes = {}
+    for image_name in sorted(os.listdir(image_directory)):
+        if not image_name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        content_hash = compute_file_hash(os.path.join(image_directory, image_name))
+        image_hashes.setdefault(content_hash, image_name)
+    return image_hashes
+
+# --- 3. 索引與 mapping ---
+def build_index_mapping():
+    """衣櫃索引的明確 mapping：封閉詞彙用 keyword 以便做可快取的精確過濾，圖片路徑只存不索引"""
+    tag_properties = {field: {"type": "keyword"} for field in KEYWORD_TAG_FIELDS}
+    for field in TEXT_TAG_FIELDS:
+        tag_properties[field] = {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}}
+    return {
+        "_meta": {"mapping_version": MAPPING_VERSION},
+        "properties": {
+            "image_path": {"type": "keyword", "index": False, "doc_values": False},
+            "content_hash": {"type": "keyword"},
+            # 與已標記衣物重複時，記錄沿用其標籤的原始文件 _id
+            "duplicate_of": {"type": "keyword"},
+            # 本地取色得到的 Lab 色彩直方圖，供之後以顏色相似度查詢
+            "color_histogram": {"type": "dense_vector", "dims": COLOR_HISTOGRAM_DIMS, "index": True, "similarity": "cosine"},
+            # 模型偶爾會回傳 schema 以外的欄位，只保留在 _source 中，不建立索引
+            "tags": {"dynamic": False, "properties": tag_properties},
+        },
+    }
+
+def create_closet_index(es, index_name):
+    es.indices.create(index=index_name, mappings=build_index_mapping())
+
+def get_index_meta(es, index_name):
+    """讀取索引 mapping 中的 _meta，舊版 (動態 mapping) 的索引回傳空 dict"""
+    response = es.indices.get_mapping(index=index_name)
+    return next(iter(response.values()), {}).get("mappings", {}).get("_meta", {})
+
+def get_mapping_version(es, index_name):
+    return get_index_meta(es, index_name).get("mapping_version")
+
+def prepare_index(es, alias, image_hashes, incremental=True, resume_index=None):
+    """決定本次寫入的目標索引與要處理的圖片，回傳 (target_index, pending, full_rebuild)
+
+    增量模式且別名目前指向的索引 mapping 版本相符時，直接在該索引上新增或刪除變動的文件；
+    否則建立一個新的版本索引並處理所有圖片，查詢端在 publish_index() 切換別名之前都看不到它。
+    resume_index 為上次中斷時寫到一半 (尚未切換別名) 的版本索引，仍然存在時接續寫入，只處理還沒寫入的圖片。
+    """
+    current = resolve_alias(es, alias)
+    if resume_index and resume_index != current and es.indices.exists(index=resume_index) \
+            and get_mapping_version(es, resume_index) == MAPPING_VERSION:
+        pending, stale = plan_incremental_sync(image_hashes, fetch_indexed_hashes(es, resume_index))
+        print(f"接續上次未完成的版本索引 {resume_index}：已寫入 {len(image_hashes) - len(pending)} 張，{len(pending)} 張需要處理")
+        delete_documents(es, resume_index, stale)
+        return resume_index, pending, True
+    if incremental and current:
+        if get_mapping_version(es, current) == MAPPING_VERSION:
+            pending, stale = plan_incremental_sync(image_hashes, fetch_indexed_hashes(es, current))
+            print(f"增量模式 ({current})：共 {len(image_hashes)} 張圖片，{len(pending)} 張需要處理，{len(stale)} 筆過期文件將被刪除")
+            delete_documents(es, current, stale)
+            return current, pending, False
+        print(f"索引 '{current}' 的 mapping 與目前版本 (v{MAPPING_VERSION}) 不符，改為完整重建")
+
+    new_index = versioned_index_name(alias)
+    print(f"正在建立新版本索引: {new_index} (mapping v{MAPPING_VERSION})，完成驗證前 '{alias}' 仍指向舊資料")
+    create_closet_index(es, new_index)
+    return new_index, dict(image_hashes), True
+
+# --- 4. 增量同步 ---
+def fetch_indexed_hashes(es, index_name):
+    """取得索引中所有文件的 _id (即圖片內容指紋)"""
+    if not es.indices.exists(index=index_name):
+        return set()
+    hits = helpers.scan(es, index=index_name, query={"query": {"match_all": {}}}, _source=False)
+    return {hit["_id"] for hit in hits}
+
+def plan_incremental_sync(image_hashes, indexed_hashes):
+    """比對資料夾與索引，回傳 (需要處理的圖片, 需要刪除的文件 _id)
+
+    - 新增或內容被修改過的圖片，其指紋不在索引中 -> 需要處理
+    - 索引中存在、但資料夾已找不到對應內容的文件 -> 需要刪除
+    """
+    pending = {h: name for h, name in image_hashes.items() if h not in indexed_hashes}
+    stale = sorted(indexed_hashes - set(image_hashes))
+    return pending, stale
+
+def delete_documents(es, index_name, doc_ids):
+    """批次刪除指定 _id 的文件，回傳成功刪除的數量"""
+    if not doc_ids:
+        return 0
+    actions = ({"_op_type": "delete", "_index": index_name, "_id": doc_id} for doc_id in doc_ids)
+    success, _ = helpers.bulk(es, actions, raise_on_error=False)
+    return success
+
+# --- 5. 批次寫入 ---
+def _is_retryable(status):
+    # 429 (佇列已滿) 與 5xx 屬於暫時性錯誤，其餘 (如 mapping 衝突) 重試也不會成功
+    return status == 429 or status >= 500
+
+class BulkWriter:
+    """以 Elasticsearch bulk API 批次寫入文件
+
+    文件先放入緩衝區，累積到 max_docs 筆或 max_bytes 位元組時才送出；
+    每筆文件的結果會透過 on_result(doc_id, error) 回報，error 為 None 表示成功。
+    同一批中只有暫時性失敗的項目會被重試，已成功的文件不會重送。
+    """
+    def __init__(self, es, index_name, on_result=None, max_docs=BULK_MAX_DOCS, max_bytes=BULK_MAX_BYTES,
+                 max_retries=BULK_MAX_RETRIES):
+        self.es = es
+        self.index_name = index_name
+        self.on_result = on_result
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.indexed = 0
+        self.failed = 0
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def add(self, doc_id, doc):
+        self._buffer.append((doc_id, doc))
+        self._buffer_bytes += len(json.dumps(doc, ensure_ascii=False).encode("utf-8"))
+        if len(self._buffer) >= self.max_docs or self._buffer_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        pending, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        for attempt in range(self.max_retries + 1):
+            if not pending:
+                return
+            if attempt > 0:
+                time.sleep(BULK_RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1))
+            operations = []
+            for doc_id, doc in pending:
+                operations.append({"index": {"_index": self.index_name, "_id": doc_id}})
+                operations.append(doc)
+            try:
+                with span("es.bulk", docs=len(pending), attempt=attempt):
+                    response = self.es.bulk(operations=operations)
+            except Exception as e:
+                # 整批請求失敗 (例如連線中斷)，全部留待下一輪重試
+                last_errors = {doc_id: str(e) for doc_id, _ in pending}
+                continue
+
+            retry, last_errors = [], {}
+            for (doc_id, doc), item in zip(pending, response["items"]):
+                result = item["index"]
+                status = result.get("status", 500)
+                if status < 300:
+                    self._report(doc_id, None)
+                elif _is_retryable(status):
+                    retry.append((doc_id, doc))
+                    last_errors[doc_id] = json.dumps(result.get("error"), ensure_ascii=False)
+                else:
+                    self._report(doc_id, json.dumps(result.get("error"), ensure_ascii=False))
+            pending = retry
+
+        for doc_id, _ in pending:
+            self._report(doc_id, last_errors.get(doc_id, "重試次數已用盡"))
+
+    def _report(self, doc_id, error):
+        if error is None:
+            self.indexed += 1
+        else:
+            self.failed += 1
+        if self.on_result is not None:
+            self.on_result(doc_id, error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+@contextmanager
+def refresh_disabled(es, index_name):
+    """大量寫入期間關閉 refresh_interval，結束後恢復原設定並手動 refresh 一次"""
+    response = es.indices.get_settings(index=index_name, name="index.refresh_interval")
+    index_settings = next(iter(response.values()), {}).get("settings", {}).get("index", {})
+    previous = index_settings.get("refresh_interval")  # None 代表使用 Elasticsearch 預設值
+    es.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": "-1"}})
+    try:
+        yield
+    finally:
+        es.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": previous}})
+        es.indices.refresh(index=index_name)
+
+# --- 6. 版本索引與別名切換 ---
+def versioned_index_name(alias):
+    """別名 + 微秒時間戳 + 隨機後綴：同一秒內 (或兩個行程同時) 重建也不會拿到相同的名稱而寫進使用中的索引"""
+    now = time.time()
+    timestamp = f"{time.strftime('%Y%m%d%H%M%S', time.localtime(now))}{int(now % 1 * 1_000_000):06d}"
+    return f"{alias}_v{timestamp}_{secrets.token_hex(3)}"
+
+def list_index_versions(es, alias):
+    """列出所有版本索引，依建立時間由舊到新排序 (固定寬度的時間戳可直接以字串排序)"""
+    return sorted(es.indices.get(index=f"{alias}_v*", expand_wildcards="open"))
+
+def resolve_alias(es, alias):
+    """回傳別名目前指向的索引；尚未使用別名的舊版實體索引也視為目前索引"""
+    if es.indices.exists_alias(name=alias):
+        return sorted(es.indices.get_alias(name=alias))[-1]
+    if es.indices.exists(index=alias):
+        return alias
+    return None
+
+def validate_index(es, index_name, expected_count):
+    """切換別名前的檢查：mapping 版本正確、文件數與成功寫入的數量一致且不為 0"""
+    es.indices.refresh(index=index_name)
+    count = es.count(index=index_name)["count"]
+    problems = []
+    if get_mapping_version(es, index_name) != MAPPING_VERSION:
+        problems.append(f"mapping 版本不是 v{MAPPING_VERSION}")
+    if count == 0:
+        problems.append("索引中沒有任何文件")
+    elif count != expected_count:
+        problems.append(f"文件數 {count} 與成功寫入的 {expected_count} 筆不一致")
+    return count, problems
+
+def swap_alias(es, alias, new_index):
+    """以單一 update_aliases 請求切換別名，查詢端不會看到別名消失的瞬間"""
+    actions = [{"add": {"index": new_index, "alias": alias}}]
+    if es.indices.exists_alias(name=alias):
+        actions += [{"remove": {"index": old, "alias": alias}} for old in es.indices.get_alias(name=alias) if old != new_index]
+    elif es.indices.exists(index=alias):
+        # 舊版直接以 virtual_closet 為名的實體索引，在同一個請求中刪除，名稱才能給別名使用
+        actions.append({"remove_index": {"index": alias}})
+    es.indices.update_aliases(actions=actions)
+
+def publish_index(es, alias, index_name, expected_count):
+    """驗證新版本索引，通過後將別名切換過去並清除多餘的舊版本；回傳是否已切換"""
+    count, problems = validate_index(es, index_name, expected_count)
+    if problems:
+        print(f"!!! 新索引 '{index_name}' 未通過驗證 ({'；'.join(problems)})，'{alias}' 維持指向原本的索引")
+        return False
+    meta = dict(get_index_meta(es, index_name), validated=True, doc_count=count)
+    es.indices.put_mapping(index=index_name, meta=meta)
+    swap_alias(es, alias, index_name)
+    print(f"已將別名 '{alias}' 切換至 '{index_name}' ({count} 筆文件)")
+    garbage_collect_versions(es, alias)
+    return True
+
+def garbage_collect_versions(es, alias, keep=INDEX_VERSIONS_TO_KEEP):
+    """刪除多餘的版本索引：目前使用中的版本以外，只保留最新的 keep 個通過驗證的版本
+
+    回滾後比目前版本新的索引也一樣只依是否在最新的 keep 個之內決定去留；
+    未通過驗證的索引只刪除比目前版本舊的，較新的可能是進行中或可以 --resume 接續的重建。
+    """
+    current = resolve_alias(es, alias)
+    if current is None:
+        return
+    others = [name for name in list_index_versions(es, alias) if name != current]
+    validated = [name for name in others if get_index_meta(es, name).get("validated")]
+    keep_set = set(validated[-keep:]) if keep > 0 else set()
+    for name in others:
+        if name in keep_set or (name > current and name not in validated):
+            continue
+        print(f"  -> 正在刪除舊版本索引: {name}")
+        es.indices.delete(index=name)
+
+def rollback(es, alias):
+    """將別名切回前一個通過驗證的版本"""
+    current = resolve_alias(es, alias)
+    candidates = [name for name in list_index_versions(es, alias)
+                  if current and name < current and get_index_meta(es, name).get("validated")]
+    if not candidates:
+        print(f"找不到比 '{current}' 更舊且通過驗證的版本，無法回滾。")
+        return False
+    swap_alias(es, alias, candidates[-1])
+    print(f"已將別名 '{alias}' 從 '{current}' 回滾至 '{candidates[-1]}'")
+    return True
+
+def print_status(es, alias):
+    current = resolve_alias(es, alias)
+    print(f"別名 '{alias}' 目前指向: {current or '(無)'}")
+    for name in list_index_versions(es, alias):
+        meta = get_index_meta(es, name)
+        marker = "*" if name == current else " "
+        state = "已驗證" if meta.get("validated") else "未驗證"
+        print(f"  {marker} {name}  mapping v{meta.get('mapping_version')}  {state}  {meta.get('doc_count', '?')} 筆")
+
+def main():
+    parser = argparse.ArgumentParser(description="管理 virtual_closet 的版本索引")
+    parser.add_argument("command", choices=["status", "rollback", "gc"], help="status: 列出版本；rollback: 切回上一版；gc: 清除舊版本")
+    args = parser.parse_args()
+
+    es = Elasticsearch(hosts=[ES_HOST])
+    if args.command == "rollback":
+        rollback(es, INDEX_NAME)
+    elif args.command == "gc":
+        garbage_collect_versions(es, INDEX_NAME)
+    print_status(es, INDEX_NAME)
+
+if __name__ == "__main__":
+    main()
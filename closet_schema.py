@@ -0,0 +1,296 @@
+import json
+import re
+
+# --- 1. 衣櫃標籤的封閉詞彙表 ---
+# 唯一的來源：Ollama 的 JSON schema (format)、Gemini 的 response_schema、prompt 中的欄位說明與本地驗證都由這裡產生
+NOT_APPLICABLE = "不適用"
+
+CLOSET_VOCABULARY = {
+    "primary_category": ["上衣", "下著", "連身裙", "外套", "配件"],
+    "pattern": ["素色", "條紋", "格紋", "印花", "波點", "迷彩"],
+    "sleeve_length": ["無袖", "短袖", "五分袖", "七分袖", "長袖", NOT_APPLICABLE],
+    "neckline": ["圓領", "V領", "方領", "高領", "Polo領", "連帽", NOT_APPLICABLE],
+    "fit": ["緊身", "合身", "常規", "寬鬆", "Oversized"],
+    "suitable_seasons": ["春季", "夏季", "秋季", "冬季"],
+    "style_tags": ["日常休閒", "商務休閒", "正式", "街頭潮流", "運動機能", "簡約", "甜美", "復古"],
+    "occasion_tags": ["上班通勤", "商務會議", "約會", "派對晚宴", "戶外運動", "旅行度假", "居家"],
+}
+
+# 以精確值比對的欄位 (Elasticsearch 中為 keyword)；顏色雖沒有封閉詞彙，但同樣是完整的詞
+KEYWORD_TAG_FIELDS = list(CLOSET_VOCABULARY) + ["main_color", "secondary_colors"]
+
+# 自由文字的欄位 (Elasticsearch 中為 text，另附 .keyword 子欄位供聚合使用)
+TEXT_TAG_FIELDS = ["sub_category", "material_guess"]
+
+# 顏色沒有寫在 prompt 的 CONSTRAINTS 中，這裡是搭配評分與顏色比對使用的標準色名
+COLOR_VOCABULARY = ["白色", "黑色", "灰色", "米色", "卡其色", "棕色", "深藍色", "藍色",
+                    "紅色", "粉紅色", "橘色", "黃色", "綠色", "紫色"]
+NEUTRAL_COLORS = ["白色", "黑色", "灰色", "米色", "卡其色", "深藍色"]
+
+# --- 2. 標籤 schema ---
+# 欄位 -> (型別, 允許的值)；允許的值為 None 代表自由文字。顏色不限制，寫入前會以本地取色結果覆蓋
+TAG_SCHEMA = {
+    "primary_category": ("string", CLOSET_VOCABULARY["primary_category"]),
+    "sub_category": ("string", None),
+    "main_color": ("string", None),
+    "secondary_colors": ("array", None),
+    "pattern": ("string", CLOSET_VOCABULARY["pattern"]),
+    "sleeve_length": ("string", CLOSET_VOCABULARY["sleeve_length"]),
+    "neckline": ("string", CLOSET_VOCABULARY["neckline"]),
+    "fit": ("string", CLOSET_VOCABULARY["fit"]),
+    "material_guess": ("string", None),
+    "suitable_seasons": ("array", CLOSET_VOCABULARY["suitable_seasons"]),
+    "style_tags": ("array", CLOSET_VOCABULARY["style_tags"]),
+    "occasion_tags": ("array", CLOSET_VOCABULARY["occasion_tags"]),
+}
+# 不允許 "不適用" 的單值欄位對應不到詞彙表時改填的預設值 (最常見的值)；
+# 主類別無法判斷就不能搭配，沒有預設值，正規化後仍不合法時整筆結果視為失敗
+TAG_DEFAULTS = {"pattern": "素色", "fit": "常規"}
+# 這些類別沒有袖長與領口
+NO_SLEEVE_CATEGORIES = ["下著", "配件"]
+
+def build_json_schema():
+    """JSON Schema，給 Ollama 的 format 參數 (structured outputs) 使用"""
+    properties = {}
+    for field, (kind, allowed) in TAG_SCHEMA.items():
+        value_schema = {"type": "string", "enum": allowed} if allowed else {"type": "string"}
+        properties[field] = {"type": "array", "items": value_schema} if kind == "array" else value_schema
+    return {"type": "object", "properties": properties, "required": list(TAG_SCHEMA), "additionalProperties": False}
+
+def build_gemini_schema(batch=False):
+    """Gemini 的 response_schema (OpenAPI 子集)；batch 為 True 時是帶有 image_id 的物件陣列"""
+    properties = {}
+    for field, (kind, allowed) in TAG_SCHEMA.items():
+        value_schema = {"type": "STRING", "enum": allowed} if allowed else {"type": "STRING"}
+        properties[field] = {"type": "ARRAY", "items": value_schema} if kind == "array" else value_schema
+    item = {"type": "OBJECT", "properties": properties, "required": list(TAG_SCHEMA)}
+    if not batch:
+        return item
+    item["properties"] = {"image_id": {"type": "STRING"}, **properties}
+    item["required"] = ["image_id"] + item["required"]
+    return {"type": "ARRAY", "items": item}
+
+def render_schema_prompt():
+    """prompt 中的欄位說明：輸出格式已由 schema 強制，這裡只列出欄位與規則，不再重複完整的 JSON 範本"""
+    lines = ["Return one JSON object with exactly these fields (the allowed values are enforced by the response schema):"]
+    for field, (kind, allowed) in TAG_SCHEMA.items():
+        shape = "list of" if kind == "array" else "one of"
+        lines.append(f"- {field}: {shape} {' / '.join(allowed)}" if allowed else f"- {field}: {'list of ' if kind == 'array' else ''}free text in Traditional Chinese")
+    lines.append(f'If primary_category is {" or ".join(NO_SLEEVE_CATEGORIES)}, sleeve_length and neckline MUST be "{NOT_APPLICABLE}".')
+    lines.append(f'If a field is not applicable, use "{NOT_APPLICABLE}". Do not add any other fields.')
+    return "\n".join(lines)
+
+# --- 3. 本地正規化與驗證 ---
+# 模型常回傳的近似欄位名稱 -> 正確欄位 (例如 Ollama 鏈回傳的 product_type)
+FIELD_ALIASES = {
+    "category": "primary_category", "type": "primary_category", "main_category": "primary_category",
+    "product_type": "sub_category", "subcategory": "sub_category", "item_type": "sub_category", "garment_type": "sub_category",
+    "color": "main_color", "primary_color": "main_color", "colour": "main_color",
+    "secondary_color": "secondary_colors", "other_colors": "secondary_colors",
+    "sleeve": "sleeve_length", "sleeves": "sleeve_length", "collar": "neckline", "neck": "neckline",
+    "material": "material_guess", "fabric": "material_guess",
+    "season": "suitable_seasons", "seasons": "suitable_seasons",
+    "style": "style_tags", "styles": "style_tags",
+    "occasion": "occasion_tags", "occasions": "occasion_tags",
+}
+
+# 各欄位的近似值 (英文或常見說法，皆為小寫) -> 詞彙表中的值
+VALUE_SYNONYMS = {
+    "primary_category": {
+        "top": "上衣", "tops": "上衣", "shirt": "上衣", "t-shirt": "上衣", "tshirt": "上衣", "tee": "上衣", "blouse": "上衣",
+        "polo": "上衣", "sweater": "上衣", "hoodie": "上衣", "t恤": "上衣", "襯衫": "上衣",
+        "bottom": "下著", "bottoms": "下著", "pants": "下著", "trousers": "下著", "jeans": "下著", "shorts": "下著",
+        "skirt": "下著", "褲子": "下著", "長褲": "下著", "短褲": "下著", "裙子": "下著",
+        "dress": "連身裙", "jumpsuit": "連身裙", "洋裝": "連身裙",
+        "jacket": "外套", "coat": "外套", "outerwear": "外套", "blazer": "外套",
+        "accessory": "配件", "accessories": "配件",
+    },
+    "pattern": {
+        "solid": "素色", "plain": "素色", "none": "素色", "無": "素色", "純色": "素色",
+        "striped": "條紋", "stripes": "條紋", "stripe": "條紋", "條紋狀": "條紋",
+        "plaid": "格紋", "checked": "格紋", "checkered": "格紋", "check": "格紋", "tartan": "格紋", "格子": "格紋",
+        "printed": "印花", "print": "印花", "floral": "印花", "graphic": "印花", "圖案": "印花",
+        "polka dot": "波點", "polka dots": "波點", "dotted": "波點", "點點": "波點",
+        "camo": "迷彩", "camouflage": "迷彩",
+    },
+    "sleeve_length": {
+        "sleeveless": "無袖", "short": "短袖", "short sleeve": "短袖", "short-sleeved": "短袖",
+        "half": "五分袖", "elbow": "五分袖", "3/4": "七分袖", "three-quarter": "七分袖",
+        "long": "長袖", "long sleeve": "長袖", "long-sleeved": "長袖",
+    },
+    "neckline": {
+        "crew": "圓領", "crew neck": "圓領", "crewneck": "圓領", "round": "圓領", "round neck": "圓領",
+        "v-neck": "V領", "v neck": "V領", "vneck": "V領", "square": "方領", "square neck": "方領",
+        "turtleneck": "高領", "high neck": "高領", "mock neck": "高領",
+        "polo": "Polo領", "polo collar": "Polo領", "collar": "Polo領", "collared": "Polo領", "shirt collar": "Polo領",
+        "hood": "連帽", "hooded": "連帽", "hoodie": "連帽",
+    },
+    "fit": {
+        "tight": "緊身", "skinny": "緊身", "slim": "合身", "slim fit": "合身", "fitted": "合身",
+        "regular": "常規", "regular fit": "常規", "standard": "常規", "straight": "常規",
+        "loose": "寬鬆", "relaxed": "寬鬆", "loose fit": "寬鬆", "oversized": "Oversized", "oversize": "Oversized",
+    },
+    "suitable_seasons": {
+        "spring": "春季", "summer": "夏季", "autumn": "秋季", "fall": "秋季", "winter": "冬季",
+        "春": "春季", "夏": "夏季", "秋": "秋季", "冬": "冬季", "春天": "春季", "夏天": "夏季", "秋天": "秋季", "冬天": "冬季",
+    },
+    "style_tags": {
+        "casual": "日常休閒", "休閒": "日常休閒", "business casual": "商務休閒", "smart casual": "商務休閒",
+        "formal": "正式", "street": "街頭潮流", "streetwear": "街頭潮流", "sporty": "運動機能", "athletic": "運動機能",
+        "sport": "運動機能", "運動": "運動機能", "minimal": "簡約", "minimalist": "簡約", "simple": "簡約",
+        "sweet": "甜美", "cute": "甜美", "vintage": "復古", "retro": "復古",
+    },
+    "occasion_tags": {
+        "commute": "上班通勤", "work": "上班通勤", "office": "上班通勤", "通勤": "上班通勤",
+        "meeting": "商務會議", "business": "商務會議", "date": "約會", "party": "派對晚宴", "dinner": "派對晚宴",
+        "outdoor": "戶外運動", "sports": "戶外運動", "hiking": "戶外運動", "travel": "旅行度假", "vacation": "旅行度假",
+        "旅行": "旅行度假", "home": "居家", "lounge": "居家", "loungewear": "居家",
+    },
+}
+NOT_APPLICABLE_SYNONYMS = {"n/a", "na", "none", "null", "not applicable", "", "無", "-"}
+# 代表所有季節的說法，展開為完整的季節列表
+ALL_SEASONS_SYNONYMS = {"all seasons", "all season", "all-season", "all", "year-round", "year round", "四季", "全年", "四季皆宜", "四季皆可"}
+
+# 自由文字欄位的常見英文說法 (皆為小寫) -> 繁體中文；對應不到的英文改填預設值，索引中只有中文
+FREE_TEXT_SYNONYMS = {
+    "sub_category": {
+        "t-shirt": "T恤", "tshirt": "T恤", "tee": "T恤", "shirt": "襯衫", "blouse": "女襯衫", "polo": "Polo衫", "polo shirt": "Polo衫",
+        "sweater": "毛衣", "hoodie": "連帽上衣", "sweatshirt": "大學T", "tank top": "背心", "cardigan": "針織外套",
+        "jeans": "牛仔褲", "pants": "長褲", "trousers": "長褲", "chinos": "卡其褲", "shorts": "短褲", "skirt": "裙子",
+        "dress": "洋裝", "jacket": "夾克", "coat": "大衣", "blazer": "西裝外套",
+    },
+    "material_guess": {
+        "cotton": "棉質", "denim": "丹寧", "linen": "亞麻", "wool": "羊毛", "polyester": "聚酯纖維", "nylon": "尼龍",
+        "silk": "絲質", "leather": "皮革", "knit": "針織", "fleece": "刷毛", "spandex": "彈性纖維",
+    },
+}
+
+# 預先建立查表，驗證與正規化都是 O(1) 的字典查詢
+_ALLOWED = {field: set(allowed) for field, (_, allowed) in TAG_SCHEMA.items() if allowed}
+_CASEFOLDED = {field: {value.casefold(): value for value in allowed} for field, (_, allowed) in TAG_SCHEMA.items() if allowed}
+_LIST_SEPARATORS = re.compile(r"\s*[,，、/]\s*")
+_CJK = re.compile(r"[\u4e00-\u9fff]")
+
+def validate_tags(tags):
+    """回傳問題列表 (空列表代表完全符合 schema)"""
+    if not isinstance(tags, dict):
+        return ["結果不是 JSON 物件"]
+    problems = [f"多餘的欄位 {key}" for key in tags if key not in TAG_SCHEMA]
+    for field, (kind, allowed) in TAG_SCHEMA.items():
+        value = tags.get(field)
+        if value is None:
+            problems.append(f"缺少欄位 {field}")
+        elif kind == "array":
+            if not isinstance(value, list):
+                problems.append(f"{field} 應為列表")
+            else:
+                problems += [f"{field} 的值 {v!r} 應為字串" for v in value if not isinstance(v, str)]
+                if allowed:
+                    problems += [f"{field} 的值 {v!r} 不在詞彙表中" for v in value if isinstance(v, str) and v not in _ALLOWED[field]]
+        elif not isinstance(value, str):
+            problems.append(f"{field} 應為字串")
+        elif allowed and value not in _ALLOWED[field]:
+            problems.append(f"{field} 的值 {value!r} 不在詞彙表中")
+        elif not allowed and field in FREE_TEXT_SYNONYMS and value != NOT_APPLICABLE and not _CJK.search(value):
+            problems.append(f"{field} 的值 {value!r} 不是中文")
+    if tags.get("primary_category") in NO_SLEEVE_CATEGORIES:
+        problems += [f"{tags['primary_category']} 的 {field} 應為 {NOT_APPLICABLE}" for field in ("sleeve_length", "neckline")
+                     if tags.get(field) not in (None, NOT_APPLICABLE)]
+    return problems
+
+def _normalize_value(field, value):
+    """單一值對應到詞彙表，對應不到回傳 None"""
+    text = str(value).strip()
+    allowed = _CASEFOLDED[field]
+    key = text.casefold()
+    if key in allowed:
+        return allowed[key]
+    if key in NOT_APPLICABLE_SYNONYMS and NOT_APPLICABLE in _ALLOWED[field]:
+        return NOT_APPLICABLE
+    return VALUE_SYNONYMS.get(field, {}).get(key)
+
+def normalize_tags(raw):
+    """把模型的輸出就地修正為符合 schema 的標籤，不必再呼叫一次模型
+
+    近似的欄位名稱改為正確名稱、多餘的欄位丟棄，近似的值 (例如 "striped") 對應到詞彙表中的值 ("條紋")；
+    對應不到的單一值改為 "不適用" (若該欄位允許) 或 TAG_DEFAULTS 的預設值，列表中對應不到的值直接移除，
+    "all seasons" / "四季" 展開為全部季節；自由文字的英文對應到中文，對應不到時子類別改用主類別、其餘改為 "不適用"。
+    只有主類別對應不到時結果仍不合法，由 parse_tags 判定失敗。
+    """
+    tags = {}
+    for key, value in raw.items():
+        field = key if key in TAG_SCHEMA else FIELD_ALIASES.get(str(key).strip().lower())
+        if field is not None and field not in tags:
+            tags[field] = value
+
+    for field, (kind, allowed) in TAG_SCHEMA.items():
+        value = tags.get(field)
+        if kind == "array":
+            values = value if isinstance(value, list) else _LIST_SEPARATORS.split(value) if isinstance(value, str) else []
+            if field == "suitable_seasons" and any(str(v).strip().casefold() in ALL_SEASONS_SYNONYMS for v in values):
+                values = list(allowed)
+            if allowed:
+                values = [_normalize_value(field, v) for v in values]
+                values = [v for v in values if v is not None and v != NOT_APPLICABLE]
+            else:
+                # 非字串的項目 (數字、巢狀物件) 不是有效的標籤，直接移除
+                values = [v.strip() for v in values if isinstance(v, str) and v.strip().casefold() not in NOT_APPLICABLE_SYNONYMS]
+            tags[field] = list(dict.fromkeys(values))
+            continue
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if allowed:
+            normalized = _normalize_value(field, value) if value is not None else None
+            if normalized is None and NOT_APPLICABLE in _ALLOWED[field]:
+                normalized = NOT_APPLICABLE
+            if normalized is None:
+                normalized = TAG_DEFAULTS.get(field)
+            if normalized is None:
+                tags.pop(field, None)
+            else:
+                tags[field] = normalized
+        else:
+            tags[field] = NOT_APPLICABLE if value is None or str(value).strip().casefold() in NOT_APPLICABLE_SYNONYMS else str(value).strip()
+
+    # 沒有主類別時，試著從子類別 (例如 product_type: "t-shirt") 推斷
+    if "primary_category" not in tags and tags.get("sub_category"):
+        category = _normalize_value("primary_category", tags["sub_category"])
+        if category is not None:
+            tags["primary_category"] = category
+    if tags.get("primary_category") in NO_SLEEVE_CATEGORIES:
+        tags["sleeve_length"] = tags["neckline"] = NOT_APPLICABLE
+    for field, synonyms in FREE_TEXT_SYNONYMS.items():
+        text = tags[field]
+        if text != NOT_APPLICABLE and not _CJK.search(text):
+            fallback = tags.get("primary_category", NOT_APPLICABLE) if field == "sub_category" else NOT_APPLICABLE
+            tags[field] = synonyms.get(text.casefold(), fallback)
+    return tags
+
+def _strip_code_fence(text):
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.split("\n", 1)[1] if "\n" in cleaned else cleaned[3:]
+        cleaned = cleaned.rsplit("```", 1)[0]
+    return cleaned.strip()
+
+def parse_tags(text):
+    """解析並正規化單一物件的模型輸出，回傳 (tags, 正規化前的問題列表)
+
+    JSON 無法解析、或正規化後重新驗證仍不符合 schema (例如主類別對應不到) 時拋出 ValueError。
+    """
+    raw = json.loads(_strip_code_fence(text)) if isinstance(text, str) else text
+    if not isinstance(raw, dict):
+        raise ValueError("模型輸出不是 JSON 物件")
+    problems = validate_tags(raw)
+    tags = normalize_tags(raw) if problems else raw
+    remaining = validate_tags(tags) if problems else []
+    if remaining:
+        raise ValueError(f"模型輸出在本地修正後仍不符合 schema: {', '.join(remaining)}")
+    return tags, problems
+
+def parse_tag_list(text):
+    """解析批次回應的 JSON 陣列，回傳物件列表 (未正規化)；格式不對時拋出 ValueError"""
+    results = json.loads(_strip_code_fence(text))
+    if not isinstance(results, list):
+        raise ValueError("模型輸出不是 JSON 陣列")
+    return results
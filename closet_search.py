@@ -0,0 +1,105 @@
+import os
+from elasticsearch import Elasticsearch
+from closet_schema import KEYWORD_TAG_FIELDS
+from embedded_index import EmbeddedIndex, EMBEDDED_SNAPSHOT_PATH
+from search_utils import as_list
+from tracing import span
+
+# --- 1. 設定 ---
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "elasticsearch")  # <--- 設為 embedded 則改用本機的內嵌索引快照，不需要啟動 Elasticsearch
+EXACT_FIELDS = {f"tags.{field}" for field in KEYWORD_TAG_FIELDS}
+
+# 搭配評分與推薦文案實際用到的欄位，其餘欄位不需要傳回來
+OUTFIT_SOURCE_FIELDS = [
+    "image_path", "tags.primary_category", "tags.sub_category", "tags.main_color",
+    "tags.style_tags", "tags.occasion_tags", "tags.suitable_seasons",
+]
+
+# --- 2. 查詢改寫 ---
+def _as_term(clause):
+    """若子句是針對精確詞彙欄位的 match，回傳對應的 term 子句，否則回傳 None
+
+    boost 會保留；帶有 operator、fuzziness 等其他選項的 match 語意與 term 不同，維持原樣不改寫。
+    """
+    if not isinstance(clause, dict) or list(clause) != ["match"] or len(clause["match"]) != 1:
+        return None
+    (field, value), = clause["match"].items()
+    if field not in EXACT_FIELDS:
+        return None
+    boost = None
+    if isinstance(value, dict):
+        if not set(value) <= {"query", "boost"}:
+            return None
+        boost = value.get("boost")
+        value = value.get("query")
+    if not isinstance(value, str):
+        return None
+    if boost is None:
+        return {"term": {field: value}}
+    return {"term": {field: {"value": value, "boost": boost}}}
+
+def rewrite_query(query):
+    """改寫 LLM 產生的查詢，讓 Elasticsearch 能快取精確條件
+
+    - 精確詞彙欄位 (如 tags.primary_category) 的 match 一律改為 term
+    - must 中的精確條件不需要計分，移到 filter context
+    - should 中的精確條件保留計分，只改為 term
+    """
+    if not isinstance(query, dict):
+        return query
+
+    term = _as_term(query)
+    if term is not None:
+        return {"bool": {"filter": [term]}}
+    if list(query) != ["bool"]:
+        return query
+
+    bool_query = dict(query["bool"])
+    must, filters = [], [_as_term(c) or rewrite_query(c) for c in as_list(bool_query.pop("filter", []))]
+    for clause in as_list(bool_query.pop("must", [])):
+        term = _as_term(clause)
+        if term is not None:
+            filters.append(term)
+        else:
+            must.append(rewrite_query(clause))
+    for occur in ("should", "must_not"):
+        if occur in bool_query:
+            bool_query[occur] = [_as_term(c) or rewrite_query(c) for c in as_list(bool_query[occur])]
+
+    if must:
+        bool_query["must"] = must
+    if filters:
+        bool_query["filter"] = filters
+    return {"bool": bool_query}
+
+# --- 3. 多類別搜尋 ---
+def search_categories(es_client, index_name, category_queries, size, source_fields=OUTFIT_SOURCE_FIELDS):
+    """以單一 _msearch 請求同時查詢多個類別 (上衣、下著，之後的外套、配件)，回傳 {類別: hits}
+
+    每筆 hit 是 _source 加上 _score；某個類別查詢失敗時印出錯誤並回傳空列表，不影響其他類別。
+    """
+    names = list(category_queries)
+    searches = []
+    for name in names:
+        searches.append({"index": index_name})
+        searches.append({"query": rewrite_query(category_queries[name]), "size": size, "_source": source_fields})
+    with span("es.msearch", categories=len(names)):
+        response = es_client.msearch(searches=searches)
+
+    results = {}
+    for name, result in zip(names, response["responses"]):
+        if "error" in result:
+            print(f"  !!! 類別 {name} 查詢失敗: {result['error']}")
+            results[name] = []
+            continue
+        results[name] = [dict(hit["_source"], _score=hit["_score"]) for hit in result["hits"]["hits"]]
+    return results
+
+# --- 4. 搜尋後端 ---
+def open_search_client(es_host, backend=SEARCH_BACKEND):
+    """回傳搜尋用的用戶端：Elasticsearch 或載入快照的 EmbeddedIndex，兩者的 search / msearch / count 介面相同"""
+    if backend == "embedded":
+        if not os.path.exists(EMBEDDED_SNAPSHOT_PATH):
+            raise FileNotFoundError(f"找不到內嵌索引快照 {EMBEDDED_SNAPSHOT_PATH}，請先執行 python embedded_index.py build")
+        return EmbeddedIndex.load()
+    return Elasticsearch(hosts=[es_host])
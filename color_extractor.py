@@ -0,0 +1,98 @@
+import io
+import numpy as np
+from PIL import Image
+from closet_schema import COLOR_VOCABULARY
+
+# --- 1. 設定 ---
+COLOR_SAMPLE_EDGE = 128        # <--- 取色前先縮到此尺寸，幾千個像素就足以代表整件衣服
+ALPHA_THRESHOLD = 128          # <--- alpha 大於此值才視為衣物本身的像素
+KMEANS_CLUSTERS = 4            # <--- k-means 的群數
+KMEANS_ITERATIONS = 10
+SECONDARY_MIN_SHARE = 0.12     # <--- 佔衣物面積此比例以上的顏色才列入 secondary_colors
+MAX_SECONDARY_COLORS = 2
+HISTOGRAM_BINS = (4, 4, 4)     # <--- Lab 三個通道各切幾格，乘積即 ES dense_vector 的維度
+COLOR_HISTOGRAM_DIMS = int(np.prod(HISTOGRAM_BINS))
+
+# 色表中每個顏色的代表色 (sRGB)，與 closet_schema.COLOR_VOCABULARY 一一對應
+COLOR_REFERENCE_RGB = {
+    "白色": (245, 245, 245), "黑色": (25, 25, 25), "灰色": (128, 128, 128), "米色": (225, 210, 180),
+    "卡其色": (190, 170, 120), "棕色": (120, 80, 50), "深藍色": (30, 40, 80), "藍色": (60, 120, 200),
+    "紅色": (200, 30, 40), "粉紅色": (240, 160, 180), "橘色": (240, 130, 40), "黃色": (240, 210, 60),
+    "綠色": (60, 140, 70), "紫色": (120, 70, 150),
+}
+
+# --- 2. 色彩空間 ---
+def rgb_to_lab(rgb):
+    """(N, 3) 的 sRGB (0-255) 轉成 CIE Lab (D65)，全部以 NumPy 向量運算"""
+    c = np.asarray(rgb, dtype=np.float32) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = c @ np.array([[0.4124, 0.2126, 0.0193],
+                        [0.3576, 0.7152, 0.1192],
+                        [0.1805, 0.0722, 0.9505]], dtype=np.float32)
+    xyz /= np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+REFERENCE_LAB = rgb_to_lab([COLOR_REFERENCE_RGB[name] for name in COLOR_VOCABULARY])
+
+# --- 3. 取色 ---
+def opaque_pixels(png_data, sample_edge=COLOR_SAMPLE_EDGE):
+    """從去背後的 PNG 取出不透明像素的 RGB，形狀為 (N, 3)"""
+    with Image.open(io.BytesIO(png_data)) as image:
+        image = image.convert("RGBA")
+    image.thumbnail((sample_edge, sample_edge), Image.BILINEAR)
+    pixels = np.asarray(image).reshape(-1, 4)
+    return pixels[pixels[:, 3] > ALPHA_THRESHOLD, :3]
+
+def kmeans(points, k=KMEANS_CLUSTERS, iterations=KMEANS_ITERATIONS):
+    """簡單的 k-means (固定亂數種子，相同圖片永遠得到相同結果)，回傳 (中心點, 各點所屬群)"""
+    rng = np.random.default_rng(0)
+    k = min(k, len(points))
+    centers = points[rng.choice(len(points), size=k, replace=False)]
+    for _ in range(iterations):
+        distances = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        new_centers = np.array([points[labels == i].mean(axis=0) if np.any(labels == i) else centers[i] for i in range(k)])
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+    return centers, labels
+
+def color_histogram(lab):
+    """Lab 色彩直方圖 (L2 正規化)，存入 ES 的 dense_vector 供之後以顏色相似度查詢"""
+    ranges = [(0, 100), (-128, 128), (-128, 128)]
+    histogram, _ = np.histogramdd(lab, bins=HISTOGRAM_BINS, range=ranges)
+    histogram = histogram.ravel()
+    return (histogram / np.linalg.norm(histogram)).round(4).tolist()
+
+def extract_colors(png_data):
+    """從去背圖片算出 (main_color, secondary_colors, color_histogram)
+
+    衣物像素在 Lab 空間做 k-means，每一群對應到色表中最接近的顏色，依面積加總後排序；
+    沒有任何不透明像素時回傳 (None, [], None)。
+    """
+    pixels = opaque_pixels(png_data)
+    if len(pixels) == 0:
+        return None, [], None
+    lab = rgb_to_lab(pixels)
+    centers, labels = kmeans(lab)
+
+    shares = np.bincount(labels, minlength=len(centers)) / len(labels)
+    nearest = ((centers[:, None, :] - REFERENCE_LAB[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+    color_shares = np.bincount(nearest, weights=shares, minlength=len(COLOR_VOCABULARY))
+    ranked = [i for i in np.argsort(-color_shares) if color_shares[i] > 0]
+
+    main_color = COLOR_VOCABULARY[ranked[0]]
+    secondary_colors = [COLOR_VOCABULARY[i] for i in ranked[1:1 + MAX_SECONDARY_COLORS]
+                        if color_shares[i] >= SECONDARY_MIN_SHARE]
+    return main_color, secondary_colors, color_histogram(lab)
+
+def apply_extracted_colors(doc, png_data):
+    """以本地取色結果覆蓋 LLM 回傳的顏色 (LLM 常回傳英文或 N/A)，並附上色彩直方圖"""
+    main_color, secondary_colors, histogram = extract_colors(png_data)
+    if main_color is None:
+        return doc
+    doc["tags"]["main_color"] = main_color
+    doc["tags"]["secondary_colors"] = secondary_colors
+    doc["color_histogram"] = histogram
+    return doc
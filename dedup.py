@@ -0,0 +1,182 @@
+import argparse
+import csv
+import io
+import json
+import os
+import threading
+import numpy as np
+from PIL import Image
+from color_extractor import opaque_pixels, rgb_to_lab, color_histogram, COLOR_HISTOGRAM_DIMS
+
+# --- 1. 設定 ---
+PHASH_INDEX_PATH = "./.phash_index_{script}.json"  # <--- 每個導入腳本各自一份 (兩種模型的標籤不能混用，掃描的資料夾也不同)
+DUPLICATE_MAX_DISTANCE = 4                  # <--- pHash (63 位元) 與 dHash (64 位元) 的漢明距離都不超過此值，輪廓才算相同
+DUPLICATE_MIN_COLOR_SIMILARITY = 0.95       # <--- Lab 色彩直方圖的餘弦相似度也要達到此值 (雜湊只看灰階輪廓，不分顏色與條紋)
+DUPLICATE_ACTION = "flag"                   # <--- flag: 不標記也不寫入索引，只列入報告；reuse: 沿用已標記衣物的標籤
+                                            #      門檻只以 test_dedup.py 在 my_clothes 上校準過，以實際去背結果確認前不要改成 reuse
+CLUSTER_REPORT_FILENAME = "duplicate_clusters_report_{script}.csv"
+
+# --- 2. 感知雜湊 ---
+def _grayscale_on_white(png_data, size):
+    """去背圖片貼在白底上轉灰階並縮放，透明背景不會影響雜湊"""
+    with Image.open(io.BytesIO(png_data)) as image:
+        image = image.convert("RGBA")
+    canvas = Image.new("RGBA", image.size, (255, 255, 255, 255))
+    canvas.alpha_composite(image)
+    return np.asarray(canvas.convert("L").resize(size, Image.LANCZOS), dtype=np.float32)
+
+def _bits_to_int(bits):
+    return int("".join("1" if b else "0" for b in bits.ravel()), 2)
+
+def _dct_matrix(n):
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / n)
+
+_DCT_32 = _dct_matrix(32)
+
+def phash(png_data):
+    """32x32 灰階做 2D DCT，取左上 8x8 低頻係數，去掉直流分量 (整體亮度) 後與中位數比較，共 63 位元"""
+    pixels = _grayscale_on_white(png_data, (32, 32))
+    low = (_DCT_32 @ pixels @ _DCT_32.T)[:8, :8].ravel()[1:]
+    return _bits_to_int(low > np.median(low))
+
+def dhash(png_data):
+    """9x8 灰階，比較左右相鄰像素的亮度變化"""
+    pixels = _grayscale_on_white(png_data, (9, 8))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+def color_signature(png_data):
+    """衣物像素的 Lab 色彩直方圖 (與寫入索引的 color_histogram 相同)；沒有不透明像素時回傳 None"""
+    pixels = opaque_pixels(png_data)
+    return color_histogram(rgb_to_lab(pixels)) if len(pixels) else None
+
+def perceptual_hashes(png_data):
+    """回傳 (pHash, dHash, 色彩直方圖)"""
+    return phash(png_data), dhash(png_data), color_signature(png_data)
+
+def hamming_distances(value, values):
+    """一個 64 位元雜湊與一整組雜湊的漢明距離 (向量運算)"""
+    xor = np.bitwise_xor(values, np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+# --- 3. 雜湊索引 ---
+class PerceptualHashIndex:
+    """已標記衣物的感知雜湊：content_hash -> 圖片名稱、pHash、dHash、色彩直方圖與標籤
+
+    導入時先以漢明距離找輪廓相近、且色彩直方圖也相近的圖片，找到就不必再去呼叫 LLM。
+    script 為 "ollama" 或 "gemini"，兩個導入腳本的索引互不影響 (prune 不會刪掉另一個腳本的紀錄)。
+    """
+    def __init__(self, script, path=None, max_distance=DUPLICATE_MAX_DISTANCE, min_color_similarity=DUPLICATE_MIN_COLOR_SIMILARITY):
+        self.script = script
+        self.path = path or PHASH_INDEX_PATH.format(script=script)
+        self.max_distance = max_distance
+        self.min_color_similarity = min_color_similarity
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                # 舊格式的紀錄 (沒有色彩直方圖、pHash 含直流分量) 無法比較，直接捨棄
+                self._entries = {k: e for k, e in json.load(f).items() if "color_histogram" in e}
+        self._rebuild_arrays()
+
+    def _rebuild_arrays(self):
+        self._keys = list(self._entries)
+        self._phashes = np.array([int(self._entries[k]["phash"], 16) for k in self._keys], dtype=np.uint64)
+        self._dhashes = np.array([int(self._entries[k]["dhash"], 16) for k in self._keys], dtype=np.uint64)
+        # 沒有不透明像素的圖片以零向量表示，與任何圖片的相似度都是 0
+        self._histograms = np.array([self._entries[k]["color_histogram"] or [0.0] * COLOR_HISTOGRAM_DIMS for k in self._keys],
+                                    dtype=np.float32).reshape(-1, COLOR_HISTOGRAM_DIMS)
+
+    def _distances(self, phash_value, dhash_value, histogram, rows=slice(None)):
+        """與 rows 中每筆紀錄的漢明距離 (pHash 與 dHash 取大者)；顏色不夠接近的記為無限大"""
+        distances = np.maximum(hamming_distances(phash_value, self._phashes[rows]),
+                               hamming_distances(dhash_value, self._dhashes[rows])).astype(np.float64)
+        distances[self._histograms[rows] @ np.asarray(histogram, dtype=np.float32) < self.min_color_similarity] = np.inf
+        return distances
+
+    def find_duplicate(self, hashes, exclude=None):
+        """回傳最相近的已知衣物 (content_hash, entry, distance)，沒有夠近的則回傳 None"""
+        with self._lock:
+            if not self._keys or hashes[2] is None:
+                return None
+            distances = self._distances(*hashes)
+            for i in np.argsort(distances, kind="stable"):
+                if distances[i] > self.max_distance:
+                    return None
+                if self._keys[i] != exclude:
+                    return self._keys[i], self._entries[self._keys[i]], int(distances[i])
+            return None
+
+    def add(self, content_hash, image_name, hashes, tags, duplicate_of=None):
+        with self._lock:
+            self._entries[content_hash] = {"image_name": image_name, "phash": f"{hashes[0]:016x}", "dhash": f"{hashes[1]:016x}",
+                                           "color_histogram": hashes[2], "tags": tags, "duplicate_of": duplicate_of}
+            self._rebuild_arrays()
+
+    def get(self, content_hash):
+        with self._lock:
+            return self._entries.get(content_hash)
+
+    def discard(self, content_hash):
+        with self._lock:
+            if self._entries.pop(content_hash, None) is not None:
+                self._rebuild_arrays()
+
+    def prune(self, valid_hashes):
+        """移除已不在衣櫃資料夾中的圖片"""
+        with self._lock:
+            stale = [k for k in self._entries if k not in valid_hashes]
+            for key in stale:
+                del self._entries[key]
+            self._rebuild_arrays()
+        return len(stale)
+
+    def save(self):
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def clusters(self):
+        """把輪廓與顏色都在門檻內的圖片合併成群 (union-find)，只回傳有兩張以上圖片的群"""
+        with self._lock:
+            keys, phashes, dhashes, histograms = self._keys, self._phashes, self._dhashes, self._histograms
+            parent = list(range(len(keys)))
+
+            def find(i):
+                while parent[i] != i:
+                    parent[i] = parent[parent[i]]
+                    i = parent[i]
+                return i
+
+            for i in range(len(keys)):
+                distances = self._distances(int(phashes[i]), int(dhashes[i]), histograms[i], slice(i + 1, None))
+                for j in np.nonzero(distances <= self.max_distance)[0]:
+                    parent[find(i + 1 + int(j))] = find(i)
+
+            groups = {}
+            for i, key in enumerate(keys):
+                groups.setdefault(find(i), []).append((key, self._entries[key]))
+            return [members for members in groups.values() if len(members) > 1]
+
+def write_cluster_report(index, filename=None):
+    filename = filename or CLUSTER_REPORT_FILENAME.format(script=index.script)
+    clusters = index.clusters()
+    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(["cluster_id", "content_hash", "image_name", "duplicate_of"])
+        for cluster_id, members in enumerate(clusters, start=1):
+            for content_hash, entry in members:
+                csv_writer.writerow([cluster_id, content_hash, entry["image_name"], entry.get("duplicate_of") or ""])
+    print(f"找到 {len(clusters)} 組重複的衣物，共 {sum(len(m) for m in clusters)} 張圖片，報告已寫入: {filename}")
+    return clusters
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="衣櫃重複圖片報告")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("--script", choices=["ollama", "gemini"], default="ollama", help="ollama: ingest_clothes.py 的索引；gemini: ingest_gemini.py 的索引")
+    args = parser.parse_args()
+    write_cluster_report(PerceptualHashIndex(args.script))
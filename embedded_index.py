@@ -0,0 +1,273 @@
+import argparse
+import json
+import math
+import os
+import re
+import time
+import numpy as np
+from elasticsearch import Elasticsearch, helpers
+from closet_schema import KEYWORD_TAG_FIELDS, TEXT_TAG_FIELDS
+from search_utils import as_list, field_values, filter_source
+
+# --- 1. 設定 ---
+ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")  # 可用環境變數覆寫 (例如基準測試時指向本機的模擬伺服器)
+INDEX_NAME = "virtual_closet"
+EMBEDDED_SNAPSHOT_PATH = "./.closet_snapshot.npz"  # <--- 內嵌索引的快照，啟動時直接載入，不必重建倒排索引
+BM25_K1 = 1.2   # 與 Elasticsearch 預設的 BM25 參數相同
+BM25_B = 0.75
+
+# 與 closet_index.build_index_mapping() 對應：keyword 欄位做精確比對，text 欄位斷詞後比對 (另有 .keyword 子欄位)
+KEYWORD_FIELDS = ["content_hash", "duplicate_of"] + [f"tags.{field}" for field in KEYWORD_TAG_FIELDS]
+TEXT_FIELDS = [f"tags.{field}" for field in TEXT_TAG_FIELDS]
+
+# 近似 Elasticsearch standard analyzer：中日韓文字逐字切開，英數字以連續字串為一個詞並轉小寫
+_TOKEN_PATTERN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]|[a-z0-9]+")
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall(str(text).lower())
+
+# --- 2. 欄位的倒排索引 ---
+class FieldIndex:
+    """單一欄位的詞典與位元圖：每個詞一列 packbits 後的位元圖 (每份文件 1 bit)
+
+    text 欄位另外以欄式陣列記錄每份文件的詞數，計算 BM25 的長度正規化。
+    與 Lucene 相同，idf 與平均長度只計入有這個欄位的文件；keyword 欄位沒有 norms，長度一律以 1 計，
+    平均長度則是每份文件的平均值數 (Lucene 對只索引文件的欄位以 sumDocFreq / docCount 計算)。
+    """
+    def __init__(self, terms, bitmaps, lengths=None):
+        self.terms = terms                    # 詞 -> 位元圖的列號
+        self.bitmaps = bitmaps                # uint8 (詞數, ceil(文件數 / 8))
+        self.doc_freq = np.unpackbits(bitmaps, axis=1).sum(axis=1) if len(terms) else np.zeros(0, dtype=np.int64)
+        self.lengths = lengths                # uint16 (文件數,)，keyword 欄位為 None
+        self.field_doc_count = int(np.unpackbits(np.bitwise_or.reduce(bitmaps, axis=0)).sum()) if len(terms) else 0
+        total_length = int(lengths.sum()) if lengths is not None else int(self.doc_freq.sum())
+        self.average_length = total_length / self.field_doc_count if self.field_doc_count else 1.0
+
+    @classmethod
+    def build(cls, values_per_doc, analyzed):
+        """values_per_doc[i] 為第 i 份文件在此欄位的值列表；analyzed 為 True 時先斷詞"""
+        postings = {}
+        lengths = np.zeros(len(values_per_doc), dtype=np.uint16)
+        for doc, values in enumerate(values_per_doc):
+            terms = [t for v in values for t in tokenize(v)] if analyzed else [str(v) for v in values]
+            lengths[doc] = len(terms)
+            for term in terms:
+                postings.setdefault(term, set()).add(doc)
+        terms = {term: row for row, term in enumerate(sorted(postings))}
+        matrix = np.zeros((len(terms), len(values_per_doc)), dtype=bool)
+        for term, row in terms.items():
+            matrix[row, list(postings[term])] = True
+        return cls(terms, np.packbits(matrix, axis=1), lengths if analyzed else None)
+
+    def mask(self, term, doc_count):
+        row = self.terms.get(term)
+        if row is None:
+            return np.zeros(doc_count, dtype=bool)
+        return np.unpackbits(self.bitmaps[row], count=doc_count).astype(bool)
+
+    def idf(self, term):
+        row = self.terms.get(term)
+        n = int(self.doc_freq[row]) if row is not None else 0
+        return math.log(1 + (self.field_doc_count - n + 0.5) / (n + 0.5))
+
+# --- 3. 內嵌索引 ---
+class EmbeddedIndex:
+    """記憶體中的衣櫃索引，提供與 Elasticsearch 用戶端相同的 search / msearch / count 介面
+
+    只支援 3_rag_query_prompt.txt 會產生的查詢：match_all、bool (must/filter/should/must_not)、match、term 與 terms。
+    評分採用與 Elasticsearch (Lucene) 相同的 BM25 公式，term 與 match 都計分，filter 與 terms 不計分；
+    但詞頻一律以 1 計、文件長度沒有經過 Lucene 的有損編碼，而且相當於只有一個 shard，
+    所以 _score 只是近似值，分數非常接近的文件排序可能與 Elasticsearch 不同。
+    search_categories() 不需要任何修改就能改用它。
+
+    快照由 Elasticsearch 中的衣櫃索引建立 (sync_snapshot)：導入仍然需要 Elasticsearch，
+    內嵌索引取代的是推薦時的查詢端，讓推薦腳本可以在沒有啟動 Elasticsearch 的機器上執行。
+    """
+    def __init__(self, index_name, doc_ids, sources, fields):
+        self.index_name = index_name
+        self.doc_ids = doc_ids
+        self.sources = sources
+        self.fields = fields
+        self.doc_count = len(doc_ids)
+
+    @classmethod
+    def from_documents(cls, index_name, documents):
+        """documents 為 [(文件 _id, _source), ...]"""
+        doc_ids = [doc_id for doc_id, _ in documents]
+        sources = [source for _, source in documents]
+        fields = {}
+        for field in KEYWORD_FIELDS:
+            fields[field] = FieldIndex.build([field_values(s, field) for s in sources], analyzed=False)
+        for field in TEXT_FIELDS:
+            values = [field_values(s, field) for s in sources]
+            fields[field] = FieldIndex.build(values, analyzed=True)
+            fields[f"{field}.keyword"] = FieldIndex.build(values, analyzed=False)
+        return cls(index_name, doc_ids, sources, fields)
+
+    @classmethod
+    def from_elasticsearch(cls, es, index_name):
+        hits = helpers.scan(es, index=index_name, query={"query": {"match_all": {}}})
+        return cls.from_documents(index_name, [(hit["_id"], hit["_source"]) for hit in hits])
+
+    # 快照
+    def save(self, path=EMBEDDED_SNAPSHOT_PATH):
+        """文件與每個欄位的位元圖存成一個 npz 檔；先寫暫存檔再替換，讀取端不會讀到寫到一半的快照"""
+        names = list(self.fields)
+        meta = {"index_name": self.index_name, "fields": names, "built_at": time.time(),
+                "terms": [sorted(self.fields[n].terms, key=self.fields[n].terms.get) for n in names]}
+        arrays = {"meta": np.array(json.dumps(meta, ensure_ascii=False)),
+                  "doc_ids": np.array(self.doc_ids, dtype=str),
+                  "sources": np.array([json.dumps(s, ensure_ascii=False) for s in self.sources], dtype=str)}
+        for i, name in enumerate(names):
+            arrays[f"bitmaps_{i}"] = self.fields[name].bitmaps
+            if self.fields[name].lengths is not None:
+                arrays[f"lengths_{i}"] = self.fields[name].lengths
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=EMBEDDED_SNAPSHOT_PATH):
+        with np.load(path) as snapshot:
+            meta = json.loads(str(snapshot["meta"]))
+            fields = {}
+            for i, name in enumerate(meta["fields"]):
+                terms = {term: row for row, term in enumerate(meta["terms"][i])}
+                lengths = snapshot[f"lengths_{i}"] if f"lengths_{i}" in snapshot.files else None
+                fields[name] = FieldIndex(terms, snapshot[f"bitmaps_{i}"], lengths)
+            doc_ids = snapshot["doc_ids"].tolist()
+            sources = [json.loads(s) for s in snapshot["sources"].tolist()]
+        return cls(meta["index_name"], doc_ids, sources, fields)
+
+    # 查詢
+    def _clause(self, field, term_text, analyzed):
+        """單一欄位比對，回傳 (符合的文件, BM25 分數)；詞頻以 1 計，即 idf / (1 + k1 * (1 - b + b * 長度 / 平均長度))"""
+        field_index = self.fields.get(field)
+        n = self.doc_count
+        if field_index is None:
+            # 與 Elasticsearch 相同：不存在的欄位不會符合任何文件
+            return np.zeros(n, dtype=bool), np.zeros(n, dtype=np.float32)
+        terms = tokenize(term_text) if analyzed and field_index.lengths is not None else [str(term_text)]
+        mask = np.zeros(n, dtype=bool)
+        scores = np.zeros(n, dtype=np.float32)
+        for term in terms:
+            term_mask = field_index.mask(term, n)
+            idf = field_index.idf(term)
+            # keyword 欄位沒有 norms，Lucene 以長度 1 計算，整個欄位的正規化是同一個常數
+            lengths = 1.0 if field_index.lengths is None else field_index.lengths
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / field_index.average_length)
+            term_scores = idf / (1 + norm)
+            mask |= term_mask
+            scores += np.where(term_mask, term_scores, 0).astype(np.float32)
+        return mask, scores
+
+    def _evaluate(self, query):
+        """回傳 (符合的文件, 分數)，兩者都是長度為文件數的陣列"""
+        n = self.doc_count
+        (kind, spec), = query.items()
+        if kind == "match_all":
+            boost = spec.get("boost", 1.0) if isinstance(spec, dict) else 1.0
+            return np.ones(n, dtype=bool), np.full(n, boost, dtype=np.float32)
+        if kind in ("term", "match"):
+            (field, value), = spec.items()
+            boost = 1.0
+            if isinstance(value, dict):
+                boost = value.get("boost", 1.0)
+                value = value.get("value" if kind == "term" else "query")
+            mask, scores = self._clause(field, value, analyzed=kind == "match")
+            return mask, scores * boost
+        if kind == "terms":
+            field, values = next((k, v) for k, v in spec.items() if k != "boost")
+            mask = np.zeros(n, dtype=bool)
+            for value in values:
+                mask |= self._clause(field, value, analyzed=False)[0]
+            return mask, np.where(mask, spec.get("boost", 1.0), 0).astype(np.float32)
+        if kind == "bool":
+            return self._evaluate_bool(spec)
+        raise ValueError(f"內嵌索引不支援的查詢類型: {kind}")
+
+    def _evaluate_bool(self, spec):
+        n = self.doc_count
+        mask = np.ones(n, dtype=bool)
+        scores = np.zeros(n, dtype=np.float32)
+        must = as_list(spec.get("must"))
+        filters = as_list(spec.get("filter"))
+        for clause in must:
+            clause_mask, clause_scores = self._evaluate(clause)
+            mask &= clause_mask
+            scores += clause_scores
+        for clause in filters:
+            # filter context 只過濾不計分
+            mask &= self._evaluate(clause)[0]
+        for clause in as_list(spec.get("must_not")):
+            mask &= ~self._evaluate(clause)[0]
+        should = as_list(spec.get("should"))
+        if should:
+            matched = np.zeros(n, dtype=np.int32)
+            for clause in should:
+                clause_mask, clause_scores = self._evaluate(clause)
+                matched += clause_mask
+                scores += clause_scores
+            # 與 Elasticsearch 相同：沒有 must/filter 時至少要符合一個 should
+            minimum = int(spec.get("minimum_should_match", 0 if must or filters else 1))
+            mask &= matched >= minimum
+        return mask, np.where(mask, scores * spec.get("boost", 1.0), 0).astype(np.float32)
+
+    def search(self, index=None, query=None, size=10, _source=None, **kwargs):
+        """與 Elasticsearch.search() 相同的參數與回應格式 (index 只是為了相容，不會用到)"""
+        start_time = time.perf_counter()
+        mask, scores = self._evaluate(query or {"match_all": {}})
+        matched = np.nonzero(mask)[0]
+        # 分數相同時依文件順序，結果是固定的
+        order = matched[np.argsort(-scores[matched], kind="stable")][:size]
+        hits = [{"_index": self.index_name, "_id": self.doc_ids[i], "_score": float(scores[i]),
+                 "_source": filter_source(self.sources[i], _source)} for i in order]
+        if _source is False:
+            for hit in hits:
+                hit.pop("_source")
+        return {"took": int((time.perf_counter() - start_time) * 1000), "timed_out": False,
+                "hits": {"total": {"value": int(len(matched)), "relation": "eq"},
+                         "max_score": hits[0]["_score"] if hits else None, "hits": hits}}
+
+    def msearch(self, searches, **kwargs):
+        """searches 為 Elasticsearch msearch 的 [header, body, header, body, ...]；單一查詢失敗時該項回傳 error"""
+        responses = []
+        for body in searches[1::2]:
+            try:
+                body = {key: value for key, value in body.items() if key != "index"}
+                responses.append(dict(self.search(**body), status=200))
+            except (ValueError, TypeError) as e:
+                responses.append({"error": {"type": "parsing_exception", "reason": str(e)}, "status": 400})
+        return {"took": 0, "responses": responses}
+
+    def count(self, index=None, query=None, **kwargs):
+        return {"count": int(self._evaluate(query or {"match_all": {}})[0].sum())}
+
+# --- 4. 與 Elasticsearch 同步 ---
+def sync_snapshot(es, index_name, path=EMBEDDED_SNAPSHOT_PATH, force=False):
+    """導入完成後更新快照；只有快照已經存在 (或 force) 時才更新，沒有使用內嵌索引的人不必多做一次 scan"""
+    if not force and not os.path.exists(path):
+        return None
+    # 增量寫入後的文件要 refresh 之後 scan 才看得到
+    es.indices.refresh(index=index_name)
+    embedded = EmbeddedIndex.from_elasticsearch(es, index_name)
+    embedded.save(path)
+    print(f"內嵌索引快照已更新: {path} ({embedded.doc_count} 筆文件)")
+    return embedded
+
+def main():
+    parser = argparse.ArgumentParser(description="管理衣櫃的內嵌索引快照")
+    parser.add_argument("command", choices=["build", "status"], help="build: 從 Elasticsearch 的索引建立快照 (需要可連線的 Elasticsearch)；status: 顯示快照內容")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        sync_snapshot(Elasticsearch(hosts=[ES_HOST]), INDEX_NAME, force=True)
+    start_time = time.perf_counter()
+    embedded = EmbeddedIndex.load()
+    print(f"快照 {EMBEDDED_SNAPSHOT_PATH}: {embedded.doc_count} 筆文件，{len(embedded.fields)} 個欄位，"
+          f"載入耗時 {(time.perf_counter() - start_time) * 1000:.1f} 毫秒")
+    for name, field_index in embedded.fields.items():
+        print(f"  - {name}: {len(field_index.terms)} 個詞")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+import fnmatch
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from PIL import Image, ImageOps
+from closet_schema import CLOSET_VOCABULARY, COLOR_VOCABULARY, NOT_APPLICABLE
+from embedded_index import EmbeddedIndex
+
+# --- 本機模擬伺服器：Ollama HTTP API、Gemini REST 端點與 Elasticsearch，以及不需要下載模型的模擬去背 ---
+# 只實作本專案實際用到的 API，供 benchmark.py 在沒有外部服務的機器上執行真正的導入與推薦流程。
+
+# --- 1. 共用 ---
+class LatencyModel:
+    """每個請求注入的延遲：固定秒數上下浮動 jitter 比例"""
+    def __init__(self, seconds=0.0, jitter=0.2, seed=0):
+        self.seconds = seconds
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sleep(self, seconds=None):
+        base = self.seconds if seconds is None else seconds
+        if base <= 0:
+            return
+        with self._lock:
+            factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(base * factor)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None  # 由 start_server 設定
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        parsed = urlparse(self.path)
+        status, payload, content_type = self.service.handle(self.command, parsed.path, parse_qs(parsed.query), body)
+        self.send_response(status)
+        for name, value in self.service.extra_headers.items():
+            self.send_header(name, value)
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        payload = payload or b""
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+def start_server(service, host="127.0.0.1", port=0):
+    """在背景執行緒啟動伺服器，回傳 (server, base_url)；結束時呼叫 server.shutdown()"""
+    handler = type(f"{type(service).__name__}Handler", (_Handler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+# --- 2. 假標籤 ---
+def fake_tags(seed, primary_category=None):
+    """依 seed 產生固定且符合封閉詞彙的標籤；上衣與下著各半，推薦流程才找得到組合"""
+    rng = random.Random(seed)
+    category = primary_category or rng.choice(["上衣", "下著"])
+    tags = {
+        "primary_category": category,
+        "sub_category": rng.choice(["T恤", "襯衫", "Polo衫"] if category == "上衣" else ["牛仔褲", "休閒褲", "短褲"]),
+        "main_color": rng.choice(COLOR_VOCABULARY),
+        "secondary_colors": rng.sample(COLOR_VOCABULARY, 1),
+        "material_guess": rng.choice(["棉質", "丹寧", "聚酯纖維"]),
+    }
+    for field, vocabulary in CLOSET_VOCABULARY.items():
+        if field == "primary_category":
+            continue
+        if field in ("suitable_seasons", "style_tags", "occasion_tags"):
+            tags[field] = rng.sample(vocabulary, 2)
+        else:
+            choices = [v for v in vocabulary if v != NOT_APPLICABLE]
+            tags[field] = NOT_APPLICABLE if category == "下著" and NOT_APPLICABLE in vocabulary else rng.choice(choices)
+    return tags
+
+def _digest(data):
+    return hashlib.sha256(data if isinstance(data, bytes) else data.encode("utf-8")).hexdigest()
+
+# --- 3. Ollama ---
+class FakeOllama:
+    """模擬 /api/chat 與 /api/generate，並模擬單一模型常駐：切換模型時要付出 load_seconds 的載入時間"""
+    extra_headers = {}
+
+    def __init__(self, latency=None, load_seconds=0.0, stream_chunks=8):
+        self.latency = latency or LatencyModel()
+        self.load_seconds = load_seconds
+        self.stream_chunks = stream_chunks
+        self.loaded_model = None
+        self.model_loads = 0
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self, model, keep_alive=None):
+        """回傳這次請求的載入秒數；keep_alive=0 代表卸載"""
+        with self._lock:
+            if keep_alive in (0, "0"):
+                if self.loaded_model == model:
+                    self.loaded_model = None
+                return 0.0
+            if self.loaded_model == model:
+                return 0.0
+            self.loaded_model = model
+            self.model_loads += 1
+        self.latency.sleep(self.load_seconds)
+        return self.load_seconds
+
+    def handle(self, method, path, query, body):
+        if path == "/api/tags":
+            return 200, {"models": []}, "application/json"
+        request = json.loads(body or b"{}")
+        if path == "/api/generate":
+            load = self._ensure_loaded(request["model"], request.get("keep_alive"))
+            return 200, {"model": request["model"], "created_at": _now(), "response": "", "done": True,
+                         "load_duration": int(load * 1e9), "total_duration": int(load * 1e9)}, "application/json"
+        if path == "/api/chat":
+            return self._chat(request)
+        return 404, {"error": f"unknown path {path}"}, "application/json"
+
+    def _chat(self, request):
+        start_time = time.monotonic()
+        load = self._ensure_loaded(request["model"], request.get("keep_alive"))
+        self.latency.sleep()
+        content = self._reply(request)
+        done = {"model": request["model"], "created_at": _now(), "message": {"role": "assistant", "content": ""},
+                "done": True, "done_reason": "stop", "total_duration": int((time.monotonic() - start_time) * 1e9),
+                "load_duration": int(load * 1e9), "prompt_eval_count": 100, "eval_count": len(content) // 4}
+        if request.get("stream", True) is False:
+            done["message"]["content"] = content
+            return 200, done, "application/json"
+        step = max(1, len(content) // self.stream_chunks)
+        lines = [{"model": request["model"], "created_at": _now(),
+                  "message": {"role": "assistant", "content": content[i:i + step]}, "done": False}
+                 for i in range(0, len(content), step)]
+        lines.append(done)
+        return 200, "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines).encode("utf-8"), "application/x-ndjson"
+
+    def _reply(self, request):
+        message = request["messages"][-1]
+        text = message.get("content") or ""
+        images = message.get("images") or []
+        if images:
+            # 視覺模型：描述中帶著依圖片決定的類別，讓數據模型產生一致的標籤
+            seed = _digest(images[0])
+            category = fake_tags(seed)["primary_category"]
+            return f"This is a clothing item. [[FAKE_SEED={seed[:16]}]] [[FAKE_CATEGORY={category}]]"
+        if request.get("format"):
+            seed = re.search(r"\[\[FAKE_SEED=(\w+)\]\]", text)
+            category = re.search(r"\[\[FAKE_CATEGORY=(\S+?)\]\]", text)
+            return json.dumps(fake_tags(seed.group(1) if seed else _digest(text), category.group(1) if category else None),
+                              ensure_ascii=False)
+        return _text_reply(text)
+
+def _text_reply(text):
+    """純文字請求：查詢翻譯回傳固定的 ES 查詢，其餘 (推薦文案) 回傳固定的一段話"""
+    if "top_query" in text:
+        return json.dumps({"top_query": {"bool": {"must": [{"match": {"tags.primary_category": "上衣"}}]}},
+                           "bottom_query": {"bool": {"must": [{"match": {"tags.primary_category": "下著"}}]}}})
+    return "這幾套穿搭輕鬆又有型，很適合您的行程，祝您有美好的一天！"
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000000000Z", time.gmtime())
+
+# --- 4. Gemini ---
+class FakeGemini:
+    """模擬 REST 的 models/{model}:generateContent 與 :streamGenerateContent
+
+    有圖片的請求回傳標籤 (批次請求有 image_id 標記，回傳 JSON 陣列)；純文字請求 (推薦流程) 回傳查詢或文案。
+    """
+    extra_headers = {}
+    TOKENS_PER_IMAGE = 258
+
+    def __init__(self, latency=None, stream_chunks=8):
+        self.latency = latency or LatencyModel()
+        self.stream_chunks = stream_chunks
+
+    def handle(self, method, path, query, body):
+        streaming = path.endswith(":streamGenerateContent")
+        if not streaming and not path.endswith(":generateContent"):
+            return 404, {"error": {"code": 404, "message": f"unknown path {path}"}}, "application/json"
+        request = json.loads(body or b"{}")
+        self.latency.sleep()
+        parts = [part for content in request.get("contents", []) for part in content.get("parts", [])]
+        texts = [part["text"] for part in parts if "text" in part]
+        images = [part.get("inline_data") or part.get("inlineData") for part in parts
+                  if "inline_data" in part or "inlineData" in part]
+        image_ids = [text.split(":", 1)[1].strip() for text in texts if text.startswith("image_id:")]
+        if image_ids:
+            text = json.dumps([dict(fake_tags(_digest(image["data"])), image_id=image_id) for image_id, image in zip(image_ids, images)],
+                              ensure_ascii=False)
+        elif images:
+            text = json.dumps(fake_tags(_digest(images[0]["data"])), ensure_ascii=False)
+        else:
+            text = _text_reply("".join(texts))
+        prompt_tokens = sum(len(t) for t in texts) // 4 + self.TOKENS_PER_IMAGE * len(images)
+        if not streaming:
+            return 200, self._response(text, prompt_tokens), "application/json"
+        # 串流：REST 預設回傳回應片段組成的 JSON 陣列，alt=sse 時改為 server-sent events
+        step = max(1, len(text) // self.stream_chunks)
+        chunks = [self._response(text[i:i + step], prompt_tokens) for i in range(0, len(text), step)]
+        if "sse" in query.get("alt", []):
+            return 200, "".join(f"data: {json.dumps(c, ensure_ascii=False)}\r\n\r\n" for c in chunks).encode("utf-8"), "text/event-stream"
+        return 200, chunks, "application/json"
+
+    @staticmethod
+    def _response(text, prompt_tokens):
+        output_tokens = len(text) // 4
+        return {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                              "totalTokenCount": prompt_tokens + output_tokens},
+        }
+
+# --- 5. Elasticsearch ---
+class FakeElasticsearch:
+    """記憶體中的 Elasticsearch：索引、別名、mapping/_meta、settings、bulk、count、search/scroll、msearch
+
+    查詢交給 embedded_index 的內嵌索引執行 (match_all、bool、term、terms 與 match，以近似 Elasticsearch 的 BM25 計分)，
+    模擬伺服器與內嵌索引共用同一套查詢邏輯；每個索引寫入後才重建一次。
+    """
+    extra_headers = {"X-Elastic-Product": "Elasticsearch"}
+    CONTENT_TYPE = "application/vnd.elasticsearch+json;compatible-with=8"
+
+    def __init__(self, latency=None):
+        self.latency = latency or LatencyModel()
+        self.indices = {}
+        self.aliases = {}
+        self._lock = threading.Lock()
+
+    def handle(self, method, path, query, body):
+        self.latency.sleep()
+        with self._lock:
+            try:
+                status, payload = self._route(method, [p for p in path.split("/") if p], query, body)
+            except KeyError as e:
+                status, payload = 404, {"error": {"type": "index_not_found_exception", "reason": f"no such index [{e.args[0]}]"}, "status": 404}
+            except ValueError as e:
+                status, payload = 400, {"error": {"type": "parsing_exception", "reason": str(e)}, "status": 400}
+        return status, payload, self.CONTENT_TYPE
+
+    # 路由
+    def _route(self, method, parts, query, body):
+        if not parts:
+            return 200, {"name": "fake", "cluster_name": "fake", "version": {"number": "8.14.0", "build_flavor": "default"},
+                         "tagline": "You Know, for Search"}
+        head = parts[0]
+        if head == "_alias":
+            return self._get_alias(parts[1])
+        if head == "_aliases":
+            return self._update_aliases(json.loads(body))
+        if head == "_bulk":
+            return self._bulk(body)
+        if head == "_msearch":
+            return self._msearch(body)
+        if head == "_search" and parts[1:] == ["scroll"]:
+            return 200, {"succeeded": True, "num_freed": 1} if method == "DELETE" else self._empty_scroll()
+        if len(parts) == 1:
+            return self._index_level(method, head, query, body)
+        action = parts[1]
+        if action == "_bulk":
+            return self._bulk(body, default_index=head)
+        if action == "_mapping":
+            return self._mapping(method, head, body)
+        if action == "_settings":
+            return self._settings(method, head, body)
+        if action == "_refresh":
+            self._resolve(head)
+            return 200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+        if action == "_count":
+            return 200, {"count": sum(len(self.indices[name]["docs"]) for name in self._resolve(head))}
+        if action == "_search":
+            return 200, self._search(head, json.loads(body or b"{}"), scroll="scroll" in query)
+        return 400, {"error": {"type": "illegal_argument_exception", "reason": f"unsupported {method} {'/'.join(parts)}"}}
+
+    def _resolve(self, name):
+        """名稱可以是索引、別名或萬用字元，回傳實際的索引列表"""
+        if name in self.aliases:
+            return sorted(self.aliases[name])
+        if name in self.indices:
+            return [name]
+        matches = sorted(n for n in self.indices if fnmatch.fnmatch(n, name))
+        if "*" in name:
+            return matches
+        raise KeyError(name)
+
+    def _index_level(self, method, name, query, body):
+        if method == "HEAD":
+            return (200 if name in self.indices or name in self.aliases else 404), {}
+        if method == "PUT":
+            if name in self.indices:
+                return 400, {"error": {"type": "resource_already_exists_exception"}, "status": 400}
+            request = json.loads(body or b"{}")
+            self.indices[name] = {"mappings": request.get("mappings", {}), "settings": {}, "docs": {}, "embedded": None}
+            return 200, {"acknowledged": True, "shards_acknowledged": True, "index": name}
+        if method == "DELETE":
+            for index in self._resolve(name):
+                del self.indices[index]
+                for members in self.aliases.values():
+                    members.discard(index)
+            return 200, {"acknowledged": True}
+        return 200, {index: {"aliases": {a: {} for a, m in self.aliases.items() if index in m},
+                             "mappings": self.indices[index]["mappings"],
+                             "settings": {"index": self.indices[index]["settings"]}}
+                     for index in self._resolve(name)}
+
+    def _get_alias(self, name):
+        if not self.aliases.get(name):
+            return 404, {"error": f"alias [{name}] missing", "status": 404}
+        return 200, {index: {"aliases": {name: {}}} for index in self.aliases[name]}
+
+    def _update_aliases(self, request):
+        for action in request.get("actions", []):
+            (kind, spec), = action.items()
+            if kind == "add":
+                self.aliases.setdefault(spec["alias"], set()).add(spec["index"])
+            elif kind == "remove":
+                self.aliases.get(spec["alias"], set()).discard(spec["index"])
+            elif kind == "remove_index":
+                self.indices.pop(spec["index"], None)
+        self.aliases = {alias: members for alias, members in self.aliases.items() if members}
+        return 200, {"acknowledged": True}
+
+    def _mapping(self, method, name, body):
+        if method == "PUT":
+            request = json.loads(body or b"{}")
+            for index in self._resolve(name):
+                mappings = self.indices[index]["mappings"]
+                if "_meta" in request:
+                    mappings["_meta"] = request["_meta"]
+                mappings.setdefault("properties", {}).update(request.get("properties", {}))
+            return 200, {"acknowledged": True}
+        return 200, {index: {"mappings": self.indices[index]["mappings"]} for index in self._resolve(name)}
+
+    def _settings(self, method, name, body):
+        if method == "PUT":
+            request = json.loads(body or b"{}")
+            for index in self._resolve(name):
+                for key, value in request.get("index", request).items():
+                    if value is None:
+                        self.indices[index]["settings"].pop(key, None)
+                    else:
+                        self.indices[index]["settings"][key] = value
+            return 200, {"acknowledged": True}
+        return 200, {index: {"settings": {"index": dict(self.indices[index]["settings"])}} for index in self._resolve(name)}
+
+    def _bulk(self, body, default_index=None):
+        lines = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+        items, i = [], 0
+        while i < len(lines):
+            (op, meta), = lines[i].items()
+            index = self._resolve(meta.get("_index", default_index))[0] if meta.get("_index", default_index) in self.aliases else meta.get("_index", default_index)
+            doc_id = meta.get("_id") or _digest(json.dumps(lines[i + 1] if op != "delete" else {}, sort_keys=True))[:20]
+            if op == "delete":
+                found = doc_id in self.indices.get(index, {"docs": {}})["docs"]
+                if found:
+                    del self.indices[index]["docs"][doc_id]
+                    self.indices[index]["embedded"] = None
+                items.append({op: {"_index": index, "_id": doc_id, "status": 200 if found else 404, "result": "deleted" if found else "not_found"}})
+                i += 1
+                continue
+            if index not in self.indices:
+                self.indices[index] = {"mappings": {}, "settings": {}, "docs": {}, "embedded": None}
+            source = lines[i + 1].get("doc", lines[i + 1]) if op == "update" else lines[i + 1]
+            created = doc_id not in self.indices[index]["docs"]
+            self.indices[index]["docs"][doc_id] = source
+            self.indices[index]["embedded"] = None
+            items.append({op: {"_index": index, "_id": doc_id, "status": 201 if created else 200,
+                               "result": "created" if created else "updated"}})
+            i += 2
+        return 200, {"took": 1, "errors": False, "items": items}
+
+    def _msearch(self, body):
+        lines = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+        responses = []
+        for header, request in zip(lines[0::2], lines[1::2]):
+            try:
+                responses.append(dict(self._search(header["index"], request), status=200))
+            except KeyError as e:
+                responses.append({"error": {"type": "index_not_found_exception", "reason": f"no such index [{e.args[0]}]"}, "status": 404})
+            except ValueError as e:
+                responses.append({"error": {"type": "parsing_exception", "reason": str(e)}, "status": 400})
+        return 200, {"took": 1, "responses": responses}
+
+    def _empty_scroll(self):
+        return {"_scroll_id": "fake", "took": 1, "timed_out": False, "_shards": {"total": 1, "successful": 1, "failed": 0},
+                "hits": {"total": {"value": 0, "relation": "eq"}, "max_score": None, "hits": []}}
+
+    def _embedded(self, index):
+        entry = self.indices[index]
+        if entry.get("embedded") is None:
+            entry["embedded"] = EmbeddedIndex.from_documents(index, list(entry["docs"].items()))
+        return entry["embedded"]
+
+    def _search(self, name, request, scroll=False):
+        query = request.get("query", {"match_all": {}})
+        indices = self._resolve(name)
+        size = sum(len(self.indices[i]["docs"]) for i in indices) if scroll else request.get("size", 10)
+        source_filter = request.get("_source", True)
+        hits, total = [], 0
+        for index in indices:
+            result = self._embedded(index).search(query=query, size=size, _source=source_filter)
+            hits += result["hits"]["hits"]
+            total += result["hits"]["total"]["value"]
+        hits.sort(key=lambda hit: -hit["_score"])
+        response = {"took": 1, "timed_out": False, "_shards": {"total": 1, "successful": 1, "failed": 0},
+                    "hits": {"total": {"value": total, "relation": "eq"},
+                             "max_score": hits[0]["_score"] if hits else None, "hits": hits[:size]}}
+        if scroll:
+            response["_scroll_id"] = "fake"
+        return response
+
+# --- 6. 去背 ---
+FAKE_MATTING_MAX_EDGE = 1024     # 與 matting.MATTING_MAX_EDGE 相同的縮圖尺寸
+FAKE_MATTING_WHITE_LEVEL = 235   # RGB 都高於此值的像素視為背景
+
+def fake_remove_backgrounds(image_paths, latency=None):
+    """代替 matting.iter_remove_backgrounds，產生相同格式的 (image_path, output_data, error)
+
+    不載入 rembg (第一次使用時會下載 u2net 模型)：接近白色的像素設為透明當作去背結果，
+    推論時間由 latency 模擬；顏色擷取與感知雜湊仍會拿到帶有 alpha 的 PNG。
+    """
+    latency = latency or LatencyModel()
+    for image_path in image_paths:
+        try:
+            latency.sleep()
+            with Image.open(image_path) as source:
+                image = ImageOps.exif_transpose(source).convert("RGBA")
+            image.thumbnail((FAKE_MATTING_MAX_EDGE, FAKE_MATTING_MAX_EDGE))
+            pixels = np.array(image)
+            pixels[(pixels[..., :3] > FAKE_MATTING_WHITE_LEVEL).all(axis=2), 3] = 0
+            buffer = io.BytesIO()
+            Image.fromarray(pixels).save(buffer, format="PNG")
+            yield image_path, buffer.getvalue(), None
+        except Exception as e:
+            yield image_path, None, e
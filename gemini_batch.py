@@ -0,0 +1,148 @@
+import threading
+from closet_schema import build_gemini_schema, normalize_tags, parse_tags, parse_tag_list, validate_tags
+from llm_cache import cached_generate_content
+from llm_client import get_client
+from matting import PAYLOAD_MIME_TYPE
+from tracing import span
+
+# --- 1. 設定 ---
+GEMINI_BATCH_MAX_IMAGES = 8                   # <--- 每個 Gemini 請求最多放幾張圖片；設為 1 則一張圖一個請求
+GEMINI_BATCH_MAX_BYTES = 14 * 1024 * 1024     # <--- 每個請求的圖片總大小上限 (inline 請求上限 20MB，base64 會膨脹約 1/3)
+# 以 response_schema 強制輸出格式與詞彙表，回應就是純 JSON，不會再夾帶 Markdown
+GEMINI_SINGLE_CONFIG = {"response_mime_type": "application/json", "response_schema": build_gemini_schema()}
+GEMINI_BATCH_CONFIG = {"response_mime_type": "application/json", "response_schema": build_gemini_schema(batch=True)}
+
+# --- 2. 批次大小 ---
+class BatchSizer:
+    """自適應的批次大小：回應格式錯誤時減半，成功時逐步加回，最多到 max_images"""
+    def __init__(self, max_images=GEMINI_BATCH_MAX_IMAGES, max_bytes=GEMINI_BATCH_MAX_BYTES):
+        self.max_images = max_images
+        self.max_bytes = max_bytes
+        self.limit = max_images
+        self._lock = threading.Lock()
+
+    def shrink(self):
+        with self._lock:
+            self.limit = max(1, self.limit // 2)
+
+    def grow(self):
+        with self._lock:
+            self.limit = min(self.max_images, self.limit + 1)
+
+def iter_batches(items, sizer, size_of):
+    """把 items 依 sizer 的張數與位元組上限組成批次
+
+    size_of(item) 回傳圖片大小；回傳 None 的項目不需要呼叫 Gemini，會單獨成為一個批次立即交出。
+    """
+    batch, batch_bytes = [], 0
+    for item in items:
+        size = size_of(item)
+        if size is None:
+            yield [item]
+            continue
+        if batch and (len(batch) >= sizer.limit or batch_bytes + size > sizer.max_bytes):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+# --- 3. 請求與解析 ---
+def parse_batch_response(text, image_ids):
+    """解析 JSON 陣列，回傳 {image_id: tags}；只保留 image_id 在本批次中且正規化後符合 schema 的物件，其餘當作缺漏"""
+    try:
+        results = parse_tag_list(text)
+    except ValueError:
+        return {}
+    tags_by_id = {}
+    for result in results:
+        if isinstance(result, dict) and result.get("image_id") in image_ids:
+            tags = dict(result)
+            image_id = tags.pop("image_id")
+            tags = normalize_tags(tags)
+            if not validate_tags(tags):
+                tags_by_id[image_id] = tags
+    return tags_by_id
+
+def _usage(response):
+    # 快取命中的回應沒有 usage_metadata，代表這次沒有花費任何 token
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return 0, 0
+    return usage.prompt_token_count or 0, usage.candidates_token_count or 0
+
+def tag_batch(model, prompt_template, batch_instruction, entries, sizer):
+    """以一個請求標記多張圖片，entries 為 [(image_id, payload), ...]
+
+    回傳 {image_id: 結果}，結果包含 tags (或 error) 以及分攤到這張圖片的 token 與秒數；
+    回應格式錯誤或缺少部分圖片時，只把缺漏的圖片拆成兩半重試，單張圖片則改用原本的單張 prompt。
+    """
+    costs = {image_id: {"prompt_tokens": 0, "output_tokens": 0, "request_seconds": 0.0, "queue_wait_seconds": 0.0,
+                        "batch_size": len(entries)}
+             for image_id, _ in entries}
+    results = {}
+    _tag_batch(model, prompt_template, batch_instruction, entries, sizer, results, costs)
+    for image_id, cost in costs.items():
+        results[image_id].update(cost)
+    return results
+
+def _tag_batch(model, prompt_template, batch_instruction, entries, sizer, results, costs):
+    if len(entries) == 1:
+        image_id, payload = entries[0]
+        response = None
+        try:
+            with span("gemini.request", images=1):
+                response = cached_generate_content(model, [prompt_template, {"mime_type": PAYLOAD_MIME_TYPE, "data": payload}],
+                                                  generation_config=GEMINI_SINGLE_CONFIG)
+            with span("gemini.parse", images=1):
+                results[image_id] = {"tags": parse_tags(response.text)[0]}
+        except Exception as e:
+            results[image_id] = {"error": e}
+        _add_cost(costs, [image_id], response)
+        return
+
+    image_ids = [image_id for image_id, _ in entries]
+    contents = [prompt_template, batch_instruction.format(image_count=len(entries))]
+    for image_id, payload in entries:
+        contents.append(f"image_id: {image_id}")
+        contents.append({"mime_type": PAYLOAD_MIME_TYPE, "data": payload})
+    response = None
+    try:
+        with span("gemini.request", images=len(entries)):
+            response = cached_generate_content(model, contents, generation_config=GEMINI_BATCH_CONFIG)
+        with span("gemini.parse", images=len(entries)):
+            tags_by_id = parse_batch_response(response.text, set(image_ids))
+    except Exception as e:
+        print(f"  !!! [Gemini] {len(entries)} 張圖片的批次請求失敗 ({e})，拆開重試")
+        tags_by_id = {}
+    # 失敗或無法解析的請求同樣花了 token 與時間，一併分攤，重試的圖片才不會低估成本
+    _add_cost(costs, image_ids, response)
+
+    for image_id, tags in tags_by_id.items():
+        results[image_id] = {"tags": tags}
+    missing = [entry for entry in entries if entry[0] not in tags_by_id]
+    if not missing:
+        sizer.grow()
+        return
+    # 只重試缺漏的圖片，並縮小之後的批次
+    sizer.shrink()
+    print(f"  -> [Gemini] 批次回應缺少 {len(missing)}/{len(entries)} 張圖片，拆開重試 (批次上限調整為 {sizer.limit} 張)")
+    middle = (len(missing) + 1) // 2
+    for part in (missing[:middle], missing[middle:]):
+        if part:
+            _tag_batch(model, prompt_template, batch_instruction, part, sizer, results, costs)
+
+def _add_cost(costs, image_ids, response):
+    """把一個請求的 token、服務時間與排隊時間平均分攤到請求中的每張圖片
+
+    快取命中時都是 0；請求本身失敗 (response 為 None) 時沒有 token 用量，但仍計入排隊與服務時間。
+    """
+    prompt_tokens, output_tokens = _usage(response)
+    queue_wait, service = get_client("gemini").take_last_timing()
+    share = len(image_ids)
+    for image_id in image_ids:
+        costs[image_id]["prompt_tokens"] += prompt_tokens / share
+        costs[image_id]["output_tokens"] += output_tokens / share
+        costs[image_id]["request_seconds"] += service / share
+        costs[image_id]["queue_wait_seconds"] += queue_wait / share
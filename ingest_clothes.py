@@ -1,18 +1,30 @@
 import os
+import argparse
 import base64
 import json
+from contextlib import nullcontext
 from elasticsearch import Elasticsearch
 from langchain_ollama import ChatOllama
 from langchain_core.messages import HumanMessage
-from rembg import remove
+from llm_cache import print_cache_stats, cached_invoke
+from matting import iter_remove_backgrounds, encode_payload, PAYLOAD_MIME_TYPE
+from color_extractor import apply_extracted_colors
+from dedup import PerceptualHashIndex, perceptual_hashes, write_cluster_report, DUPLICATE_ACTION
+from ollama_phases import DescriptionStore, run_phase, OLLAMA_KEEP_ALIVE
+from closet_index import scan_image_directory, prepare_index, publish_index, BulkWriter, refresh_disabled
+from embedded_index import sync_snapshot
+from ingest_journal import IngestJournal
+from tracing import span, timed_iter, export_trace
+from closet_schema import build_json_schema, render_schema_prompt, parse_tags
 
 # --- 1. 設定 ---
 IMAGE_DIRECTORY = "./my_clothes"  # <--- 請將此路徑替換成您存放44張照片的資料夾
 PROMPT_FOLDER = "./prompts"
-ES_HOST = "http://localhost:9200"
-INDEX_NAME = "virtual_closet"
+ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")  # 可用環境變數覆寫 (例如基準測試時指向本機的模擬伺服器)
+INDEX_NAME = "virtual_closet"  # 別名；完整重建時會寫入新的版本索引，驗證通過後才切換
 OLLAMA_HOST_IP = "localhost"  # <--- 請務必確認這是您正確的 Windows IP
-OLLAMA_BASE_URL = f"http://{OLLAMA_HOST_IP}:11434"
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", f"http://{OLLAMA_HOST_IP}:11434")
+INCREMENTAL_MODE = True  # <--- 只處理新增或修改過的圖片；設為 False 則刪除舊索引並全部重建
 
 # --- 我們的冠軍團隊 ---
 VISION_MODEL = "llava:13b"
@@ -23,35 +35,11 @@ def load_prompt(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         return f.read()
 
-def image_to_base64(image_path):
-    with open(image_path, "rb") as input_file:
-        input_data = input_file.read()
-        output_data = remove(input_data)
-        return base64.b64encode(output_data).decode('utf-8')
-
 def get_schema_and_constraints():
-    # 將 Schema 和 Constraints 集中管理
-    return """
-    The output must be a single, valid JSON object. Do not add any text before or after the JSON object. The JSON object must conform to the following schema:
-    {
-      "primary_category": "string", "sub_category": "string", "main_color": "string", "secondary_colors": ["string"],
-      "pattern": "string", "sleeve_length": "string", "neckline": "string", "fit": "string",
-      "material_guess": "string", "suitable_seasons": ["string"], "style_tags": ["string"], "occasion_tags": ["string"]
-    }
-    
-    CONSTRAINTS:
-    - primary_category: ["上衣", "下著", "連身裙", "外套", "配件"]
-    - pattern: ["素色", "條紋", "格紋", "印花", "波點", "迷彩"]
-    - sleeve_length: ["無袖", "短袖", "五分袖", "七分袖", "長袖", "不適用"]
-    - neckline: ["圓領", "V領", "方領", "高領", "Polo領", "連帽", "不適用"]
-    - fit: ["緊身", "合身", "常規", "寬鬆", "Oversized"]
-    - suitable_seasons": ["春季", "夏季", "秋季", "冬季"]
-    - style_tags": ["日常休閒", "商務休閒", "正式", "街頭潮流", "運動機能", "簡約", "甜美", "復古"]
-    - occasion_tags": ["上班通勤", "商務會議", "約會", "派對晚宴", "戶外運動", "旅行度假", "居家"]
-    CRITICAL: If a field is not applicable, you MUST use the string "不適用".
-    """
-
-def main():
+    # 欄位與詞彙表集中在 closet_schema；格式由 format 參數的 JSON schema 強制，prompt 只需列出欄位規則
+    return render_schema_prompt()
+
+def main(resume=False, retry_failed=False):
     # --- 初始化 ---
     try:
         vision_prompt = load_prompt(os.path.join(PROMPT_FOLDER, "1_vision_expert_prompt.txt"))
@@ -61,53 +49,191 @@ def main():
         return
 
     schema_and_constraints = get_schema_and_constraints()
-    vision_expert = ChatOllama(model=VISION_MODEL, base_url=OLLAMA_BASE_URL, temperature=0)
-    data_expert = ChatOllama(model=DATA_MODEL, base_url=OLLAMA_BASE_URL, format="json", temperature=0)
+    # 兩個模型分階段執行：每個階段內模型保持常駐，不會每張圖片都來回切換
+    vision_expert = ChatOllama(model=VISION_MODEL, base_url=OLLAMA_BASE_URL, temperature=0, keep_alive=OLLAMA_KEEP_ALIVE)
+    # 以 JSON schema 限制解碼，輸出必定是符合詞彙表的物件，不需要再清理或重新詢問
+    data_expert = ChatOllama(model=DATA_MODEL, base_url=OLLAMA_BASE_URL, format=build_json_schema(), temperature=0, keep_alive=OLLAMA_KEEP_ALIVE)
     
     es = Elasticsearch(hosts=[ES_HOST])
     
-    # 每次運行前，都先刪除舊索引，確保資料最新
-    if es.indices.exists(index=INDEX_NAME):
-        print(f"發現舊索引 '{INDEX_NAME}'，正在刪除...")
-        es.indices.delete(index=INDEX_NAME)
-    print(f"正在建立新索引: {INDEX_NAME}")
-    es.indices.create(index=INDEX_NAME)
+    # 以圖片內容指紋作為文件 _id，增量模式下只處理新增或修改過的圖片
+    image_hashes = scan_image_directory(IMAGE_DIRECTORY)
+    # 導入日誌：每張圖片每完成一個階段就記錄一次，中斷後可以 --resume 接續
+    journal = IngestJournal("ollama")
+    journal.prune(image_hashes)
+    # --resume / --retry-failed 不重建索引：接續上次寫到一半的版本索引，或在目前的索引上增量處理
+    resuming = resume or retry_failed
+    target_index, pending, full_rebuild = prepare_index(es, INDEX_NAME, image_hashes, incremental=INCREMENTAL_MODE or resuming,
+                                                        resume_index=journal.unfinished_index() if resuming else None)
+    indexed_before = len(image_hashes) - len(pending)
+    if retry_failed:
+        if indexed_before:
+            failed = journal.failed()
+            pending = {h: name for h, name in pending.items() if h in failed}
+            print(f"只重新處理上次失敗的 {len(pending)} 張圖片")
+        else:
+            print("目前沒有可接續的索引，改為處理所有圖片")
+    # 感知雜湊索引：同一件衣服重複上傳時直接沿用之前的標籤
+    phash_index = PerceptualHashIndex("ollama")
+    phash_index.prune(image_hashes)
+    if resuming or not full_rebuild:
+        # 已標記為重複 (DUPLICATE_ACTION = "flag") 的圖片刻意不寫入索引，每次增量處理都會被當成新圖片；
+        # 原始圖片還在時不必重新去背與比對 (完整重建時才重新判定)
+        flagged = {h for h in journal.flagged_duplicates() if (phash_index.get(h) or {}).get("duplicate_of") in image_hashes}
+        pending = {h: name for h, name in pending.items() if h not in flagged}
+    journal.start_run(target_index, full_rebuild)
     
-    image_files = [f for f in os.listdir(IMAGE_DIRECTORY) if f.lower().endswith(('.png', '.jpg', 'jpeg'))]
-    
-    for image_name in image_files:
-        print(f"\n{'='*20} 正在處理圖片: {image_name} {'='*20}")
-        image_path = os.path.join(IMAGE_DIRECTORY, image_name)
-        
+    def report_result(doc_id, error):
+        journal.record(doc_id, pending[doc_id], "indexing", error)
+        if error is None:
+            print(f"  --> 成功存入 {pending[doc_id]}! ID: {doc_id}")
+        else:
+            print(f"  !!! 寫入圖片 {pending[doc_id]} 時發生錯誤: {error}")
+
+    # --- 階段 0: 去背與重複比對 (不需要 LLM) ---
+    items = {}   # content_hash -> 圖片資訊
+    to_tag = []  # 需要 LLM 標記的圖片
+    pending_paths = {os.path.join(IMAGE_DIRECTORY, name): (content_hash, name) for content_hash, name in pending.items()}
+    # 去背在行程池中進行，這裡記錄的是等待去背結果的時間
+    for (image_path, output_data, matting_error), _ in timed_iter("ingest_clothes.matting_wait", iter_remove_backgrounds(list(pending_paths))):
+        content_hash, image_name = pending_paths[image_path]
+        journal.record(content_hash, image_name, "matting", matting_error)
+        if matting_error is not None:
+            print(f"  !!! 處理圖片 {image_name} 時發生錯誤: {matting_error}")
+            continue
         try:
-            # --- 步驟 1: Llava 生成描述 ---
-            print("  [1/3] 視覺專家 (Llava) 正在描述...")
-            image_base64 = image_to_base64(image_path)
-            vision_msg = vision_expert.invoke([HumanMessage(content=[
+            with span("ingest_clothes.phash", image=image_name):
+                hashes = perceptual_hashes(output_data)
+        except Exception as e:
+            print(f"  !!! 處理圖片 {image_name} 時發生錯誤: {e}")
+            journal.record(content_hash, image_name, "prepare", e)
+            continue
+        journal.record(content_hash, image_name, "prepare")
+        # 接續時，日誌中已標記完成的圖片直接沿用標籤，不再呼叫 LLM
+        items[content_hash] = {"image_path": image_path, "image_name": image_name, "output_data": output_data,
+                               "hashes": hashes, "duplicate_of": None, "tags": journal.tags_for(content_hash) if resuming else None}
+
+        # 呼叫 LLM 之前，先以感知雜湊找出是否為已標記過 (或本次稍早已排入) 的衣服
+        duplicate = phash_index.find_duplicate(hashes, exclude=content_hash)
+        if duplicate is None:
+            to_tag.append(content_hash)
+            # 先登記雜湊 (標籤稍後才產生)，本次之後的重複圖片才找得到它
+            phash_index.add(content_hash, image_name, hashes, None)
+        else:
+            duplicate_of, original, distance = duplicate
+            items[content_hash]["duplicate_of"] = duplicate_of
+            print(f"  -> {image_name} 與 {original['image_name']} 重複 (漢明距離: {distance})，不呼叫 LLM")
+
+    # --- 階段 1: 視覺專家 (Llava) 連續描述所有圖片，描述逐筆存檔 ---
+    descriptions = DescriptionStore(vision_prompt)
+
+    def describe(content_hash):
+        image_name = items[content_hash]["image_name"]
+        # 送出縮圖後的 JPEG，而非完整的 PNG
+        with span("ingest_clothes.encode_payload", image=image_name):
+            payload = encode_payload(items[content_hash]["output_data"])
+            image_base64 = base64.b64encode(payload).decode('utf-8')
+        print(f"  [1/3] Llava 正在描述 {image_name} (送出圖片大小: {len(payload) / 1024:.1f} KB)")
+        with span("ingest_clothes.vision", image=image_name, model=VISION_MODEL):
+            vision_msg = cached_invoke(vision_expert, [HumanMessage(content=[
                 {"type": "text", "text": vision_prompt},
-                {"type": "image_url", "image_url": f"data:image/png;base64,{image_base64}"}
+                {"type": "image_url", "image_url": f"data:{PAYLOAD_MIME_TYPE};base64,{image_base64}"}
             ])])
-            description = vision_msg.content
-            
-            # --- 步驟 2: Gemma 3 轉換為 JSON ---
-            print("  [2/3] 數據專家 (Gemma 3) 正在轉換...")
-            final_prompt = data_prompt_template.format(
-                description_from_llava=description,
-                schema_and_constraints=schema_and_constraints
-            )
-            json_msg = data_expert.invoke(final_prompt)
-            final_json_str = json_msg.content
-            tags_data = json.loads(final_json_str)
-            
-            # --- 步驟 3: 存入 Elasticsearch ---
-            print("  [3/3] 正在存入 Elasticsearch...")
-            doc = { "image_path": image_path, "tags": tags_data }
-            res = es.index(index=INDEX_NAME, document=doc)
-            print(f"  --> 成功存入! ID: {res['_id']}")
-            print("  --> JSON 內容:", json.dumps(tags_data, indent=2, ensure_ascii=False))
+        descriptions.put(VISION_MODEL, content_hash, vision_msg.content)
+        return vision_msg
 
-        except Exception as e:
-            print(f"  !!! 處理圖片 {image_name} 時發生錯誤: {e}")
+    need_description = [h for h in to_tag if items[h]["tags"] is None and descriptions.get(VISION_MODEL, h) is None]
+    vision_results, vision_stats = run_phase("1/3 視覺專家", OLLAMA_BASE_URL, VISION_MODEL, need_description, describe)
+
+    # --- 階段 2: 數據專家 (Gemma 3) 連續把描述轉換為 JSON ---
+    def structure(content_hash):
+        print(f"  [2/3] Gemma 3 正在轉換 {items[content_hash]['image_name']}")
+        final_prompt = data_prompt_template.format(
+            description_from_llava=descriptions.get(VISION_MODEL, content_hash),
+            schema_and_constraints=schema_and_constraints
+        )
+        with span("ingest_clothes.structure", image=items[content_hash]["image_name"], model=DATA_MODEL):
+            return cached_invoke(data_expert, final_prompt)
+
+    described = [h for h in to_tag if items[h]["tags"] is None and descriptions.get(VISION_MODEL, h) is not None]
+    json_results, data_stats = run_phase("2/3 數據專家", OLLAMA_BASE_URL, DATA_MODEL, described, structure)
+
+    # --- 階段 3: 放入批次寫入佇列 (累積到一定數量才送出 bulk 請求) ---
+    print("\n--- [3/3] 正在寫入 Elasticsearch ---")
+    # 完整重建時暫停 refresh，全部寫完後再 refresh 一次
+    with refresh_disabled(es, target_index) if full_rebuild else nullcontext():
+        with BulkWriter(es, target_index, on_result=report_result) as writer:
+            # 先寫入新標記的圖片，重複的圖片才能沿用它們的標籤
+            ordered = to_tag + [h for h in items if items[h]["duplicate_of"] is not None]
+            for content_hash in ordered:
+                item = items[content_hash]
+                stage = "tagging"
+                try:
+                    if item["tags"] is not None:
+                        tags_data = item["tags"]
+                    elif item["duplicate_of"] is None:
+                        result = json_results.get(content_hash, vision_results.get(content_hash))
+                        if isinstance(result, Exception):
+                            raise result
+                        if result is None:
+                            raise RuntimeError("沒有取得模型的回應")
+                        with span("ingest_clothes.parse", image=item["image_name"]):
+                            tags_data, problems = parse_tags(result.content)
+                        if problems:
+                            print(f"  -> {item['image_name']} 的輸出不完全符合 schema，已在本地修正 ({len(problems)} 處)")
+                        journal.record(content_hash, item["image_name"], "tagging", tags=tags_data)
+                    else:
+                        original = phash_index.get(item["duplicate_of"])
+                        if original is None or original["tags"] is None:
+                            raise RuntimeError("重複的原始圖片標記失敗，無法沿用標籤")
+                        if DUPLICATE_ACTION == "flag":
+                            phash_index.add(content_hash, item["image_name"], item["hashes"], original["tags"], duplicate_of=item["duplicate_of"])
+                            journal.record(content_hash, item["image_name"], "tagging", tags=original["tags"])
+                            journal.record(content_hash, item["image_name"], "indexing", status="duplicate")
+                            print(f"  -> {item['image_name']} 已標記為重複，不寫入索引")
+                            continue
+                        tags_data = dict(original["tags"])
+
+                    stage = "indexing"
+                    doc = { "image_path": item["image_path"], "content_hash": content_hash, "tags": tags_data, "duplicate_of": item["duplicate_of"] }
+                    # 顏色改由去背圖片本地計算，不採用模型回傳的顏色
+                    with span("ingest_clothes.color_extraction", image=item["image_name"]):
+                        apply_extracted_colors(doc, item["output_data"])
+                    writer.add(content_hash, doc)
+                    phash_index.add(content_hash, item["image_name"], item["hashes"], tags_data, duplicate_of=item["duplicate_of"])
+                    print(f"  --> {item['image_name']} JSON 內容:", json.dumps(tags_data, indent=2, ensure_ascii=False))
+
+                except Exception as e:
+                    print(f"  !!! 處理圖片 {item['image_name']} 時發生錯誤: {e}")
+                    journal.record(content_hash, item["image_name"], stage, e)
+                    if item["duplicate_of"] is None:
+                        phash_index.discard(content_hash)
+
+    print(f"\n批次寫入完成：成功 {writer.indexed} 筆，失敗 {writer.failed} 筆")
+    for stats in (vision_stats, data_stats):
+        if stats["calls"] or stats["failures"]:
+            print(f"{stats['model']}: 模型載入 {stats['load_seconds']:.2f} 秒，推論 {stats['inference_seconds']:.2f} 秒 ({stats['calls']} 次)")
+    phash_index.save()
+    write_cluster_report(phash_index)
+
+    # 完整重建時，新索引通過驗證後才把別名切換過去，查詢端不會看到空的或寫到一半的索引
+    # (接續的版本索引中還有之前寫入的文件，一併計入預期的文件數)
+    published = publish_index(es, INDEX_NAME, target_index, indexed_before + writer.indexed) if full_rebuild else False
+    journal.finish_run(published)
+    journal.close()
+    # 使用內嵌索引時 (快照已存在)，同步更新快照
+    sync_snapshot(es, INDEX_NAME)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="以 Ollama (Llava + Gemma 3) 標記衣物並寫入 Elasticsearch")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--resume", action="store_true", help="接續上次中斷的導入：略過已完成的圖片，只重試失敗或未完成的")
+    mode.add_argument("--retry-failed", action="store_true", help="只重新處理導入日誌中失敗的圖片")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    with span("ingest_clothes.main"):
+        main(resume=args.resume, retry_failed=args.retry_failed)
+    print_cache_stats()
+    export_trace()
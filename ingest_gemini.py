@@ -1,13 +1,22 @@
-import io
 import os
-import json
 import csv
+import argparse
 import time
+from contextlib import nullcontext
 from dotenv import load_dotenv
 import google.generativeai as genai
 from elasticsearch import Elasticsearch
-from rembg import remove
-from PIL import Image
+from llm_cache import print_cache_stats
+from llm_client import BACKEND_LIMITS
+from matting import iter_remove_backgrounds, encode_payload
+from color_extractor import apply_extracted_colors
+from dedup import PerceptualHashIndex, perceptual_hashes, write_cluster_report, DUPLICATE_ACTION
+from gemini_batch import BatchSizer, iter_batches, tag_batch
+from pipeline import run_pipeline
+from tracing import span, timed_iter, export_trace
+from closet_index import scan_image_directory, prepare_index, publish_index, BulkWriter, refresh_disabled
+from embedded_index import sync_snapshot
+from ingest_journal import IngestJournal
 
 # --- 1. 設定與初始化 ---
 load_dotenv()
@@ -17,52 +26,63 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("錯誤：找不到 GOOGLE_API_KEY。請確認您的 .env 檔案已設定正確。")
 
-genai.configure(api_key=GOOGLE_API_KEY)
+# 可用環境變數 GEMINI_API_ENDPOINT 指向其他端點 (例如基準測試的模擬伺服器)，此時改用 REST 傳輸
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+if GEMINI_API_ENDPOINT:
+    genai.configure(api_key=GOOGLE_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+else:
+    genai.configure(api_key=GOOGLE_API_KEY)
 GEMINI_MODEL_NAME = "gemini-2.5-pro"
 
 # --- 新增：定義處理後圖片的儲存資料夾 ---
 IMAGE_DIRECTORY = "./test_pic" 
 PROCESSED_IMAGE_DIRECTORY = "./my_clothes_processed" # <--- 去背後的圖片將存放在這裡
 PROMPT_FILE = "./prompts/gemini_prompt.txt"
-ES_HOST = "http://localhost:9200"
-INDEX_NAME = "virtual_closet"
+BATCH_PROMPT_FILE = "./prompts/gemini_batch_prompt.txt"  # 多張圖片合併成一個請求時，附加在 PROMPT_FILE 之後的說明
+ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")  # 可用環境變數覆寫 (例如基準測試時指向本機的模擬伺服器)
+INDEX_NAME = "virtual_closet"  # 別名；完整重建時會寫入新的版本索引，驗證通過後才切換
 CSV_FILENAME = "gemini_ingestion_report_v2.csv"
+INCREMENTAL_MODE = True  # <--- 只處理新增或修改過的圖片；設為 False 則刪除舊索引並全部重建
+LLM_CONCURRENCY = BACKEND_LIMITS["gemini"]["max_concurrency"]  # 同時進行中的 Gemini 請求數，由 llm_client 設定 (環境變數 GEMINI_CONCURRENCY)
+PIPELINE_QUEUE_SIZE = 8   # <--- 各階段之間佇列的上限，下游跟不上時上游會暫停
+# 每張圖片在各階段花費的秒數 (CSV 的 <階段>_seconds 欄位)；去背在行程池中進行，這裡記錄的是等待去背結果的時間
+STAGE_NAMES = ["matting_wait", "save_image", "dedup", "encode_payload", "tagging", "color_extraction"]
 
 CSV_HEADERS = [
-    "original_image_name", "processed_image_path", "processing_time_seconds", "status", "error_message",
+    "original_image_name", "processed_image_path", "processing_time_seconds", "completed_at_seconds", "bytes_sent", "batch_size", "prompt_tokens", "output_tokens", "request_seconds", "queue_wait_seconds", "status", "error_message",
     "primary_category", "sub_category", "main_color", "secondary_colors",
     "pattern", "sleeve_length", "neckline", "fit", "material_guess",
     "suitable_seasons", "style_tags", "occasion_tags"
-]
+] + [f"{stage}_seconds" for stage in STAGE_NAMES]
 
-def process_and_save_image(image_name, input_dir, output_dir):
-    """讀取圖片，移除背景，儲存為新的 PNG 檔案，並返回 PIL Image 物件"""
-    input_path = os.path.join(input_dir, image_name)
-    
+def save_processed_image(image_name, output_data, output_dir):
+    """將去背後的圖片儲存為新的 PNG 檔案，並返回新的檔案路徑"""
     # 建立輸出檔案名稱與路徑
     file_name_without_ext = os.path.splitext(image_name)[0]
     output_filename = f"{file_name_without_ext}_processed.png"
     output_path = os.path.join(output_dir, output_filename)
 
-    with open(input_path, "rb") as input_file:
-        input_data = input_file.read()
-        
-        # 使用 rembg 移除背景
-        output_data = remove(input_data)
-        
-        # 將去背後的圖片儲存到新資料夾
-        with open(output_path, "wb") as output_file:
-            output_file.write(output_data)
-        
-        # 返回 PIL Image 物件以供 Gemini 分析，以及新的檔案路徑
-        return Image.open(io.BytesIO(output_data)), output_path
-
-def main():
+    # 將去背後的圖片儲存到新資料夾
+    with open(output_path, "wb") as output_file:
+        output_file.write(output_data)
+    
+    return output_path
+
+def load_previous_report(filename=CSV_FILENAME):
+    """讀取上一次的 CSV 報告，回傳各列的 dict (檔案不存在時回傳空列表)"""
+    if not os.path.exists(filename):
+        return []
+    with open(filename, 'r', newline='', encoding='utf-8') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+def main(resume=False, retry_failed=False):
     print(f"正在初始化 Gemini 模型: {GEMINI_MODEL_NAME}")
     model = genai.GenerativeModel(GEMINI_MODEL_NAME)
     
     print(f"正在讀取 Prompt 模板: {PROMPT_FILE}")
     prompt_template = load_prompt(PROMPT_FILE) # 假設 load_prompt 函式已定義
+    batch_instruction = load_prompt(BATCH_PROMPT_FILE)
+    sizer = BatchSizer()
 
     print(f"正在連接 Elasticsearch: {ES_HOST}")
     es = Elasticsearch(hosts=[ES_HOST])
@@ -71,69 +91,251 @@ def main():
     os.makedirs(PROCESSED_IMAGE_DIRECTORY, exist_ok=True)
     print(f"已確認處理後圖片儲存目錄: {PROCESSED_IMAGE_DIRECTORY}")
 
-    if es.indices.exists(index=INDEX_NAME):
-        print(f"發現舊索引 '{INDEX_NAME}'，正在刪除...")
-        es.indices.delete(index=INDEX_NAME)
-    print(f"正在建立新索引: {INDEX_NAME}")
-    es.indices.create(index=INDEX_NAME)
+    # 以圖片內容指紋作為文件 _id，增量模式下只處理新增或修改過的圖片
+    image_hashes = scan_image_directory(IMAGE_DIRECTORY)
+    # 導入日誌：每張圖片每完成一個階段就記錄一次，中斷後可以 --resume 接續
+    journal = IngestJournal("gemini")
+    journal.prune(image_hashes)
+    # --resume / --retry-failed 不重建索引：接續上次寫到一半的版本索引，或在目前的索引上增量處理
+    resuming = resume or retry_failed
+    target_index, pending, full_rebuild = prepare_index(es, INDEX_NAME, image_hashes, incremental=INCREMENTAL_MODE or resuming,
+                                                        resume_index=journal.unfinished_index() if resuming else None)
+    indexed_before = len(image_hashes) - len(pending)
+    # 索引中已有文件時 (增量處理或接續)，上一次報告中這次沒有重新處理的列原樣保留，FAILED 的紀錄才不會在下一次執行後消失
+    previous_rows = load_previous_report() if indexed_before else []
+    # --retry-failed 只重新處理上一次報告中 FAILED 的圖片
+    if retry_failed:
+        if indexed_before:
+            failed_names = {row["original_image_name"] for row in previous_rows if row.get("status") == "FAILED"}
+            pending = {h: name for h, name in pending.items() if name in failed_names}
+            print(f"只重新處理 {CSV_FILENAME} 中失敗的 {len(pending)} 張圖片")
+        else:
+            print("目前沒有可接續的索引，改為處理所有圖片")
+    # 感知雜湊索引：同一件衣服重複上傳時直接沿用之前的標籤
+    phash_index = PerceptualHashIndex("gemini")
+    phash_index.prune(image_hashes)
+    if resuming or not full_rebuild:
+        # 已標記為重複 (DUPLICATE_ACTION = "flag") 的圖片刻意不寫入索引，每次增量處理都會被當成新圖片；
+        # 原始圖片還在時不必重新去背與比對 (完整重建時才重新判定)
+        flagged = {h for h in journal.flagged_duplicates() if (phash_index.get(h) or {}).get("duplicate_of") in image_hashes}
+        pending = {h: name for h, name in pending.items() if h not in flagged}
+    # 已從資料夾刪除的圖片與這次要重新處理的圖片不保留舊的列
+    current_names = set(image_hashes.values())
+    reprocessed_names = set(pending.values())
+    previous_rows = [row for row in previous_rows
+                     if row["original_image_name"] in current_names and row["original_image_name"] not in reprocessed_names]
+    journal.start_run(target_index, full_rebuild)
+
+    def matting_stage():
+        # 去背在行程池中平行進行 (使用 rembg 並讀寫去背快取)，完成一張就交給下一階段
+        pending_paths = {os.path.join(IMAGE_DIRECTORY, name): (content_hash, name) for content_hash, name in pending.items()}
+        for (image_path, output_data, matting_error), wait_seconds in timed_iter("ingest_gemini.matting_wait", iter_remove_backgrounds(list(pending_paths))):
+            content_hash, image_name = pending_paths[image_path]
+            yield content_hash, image_name, output_data, matting_error, wait_seconds
+
+    # 與本次稍早排入、還在等 Gemini 回應的圖片重複者，等所有請求完成後才沿用原始圖片的標籤
+    deferred = []
+
+    def prepare_stage():
+        # 儲存去背圖片、比對重複並壓縮要上傳的圖片；只有 payload 不是 None 的項目才需要呼叫 Gemini
+        for content_hash, image_name, output_data, matting_error, wait_seconds in matting_stage():
+            stages = {"matting_wait": wait_seconds}
+            # 接續時，日誌中已標記完成的圖片直接沿用標籤，不再呼叫 Gemini
+            item = {"content_hash": content_hash, "output_data": output_data, "payload": None, "duplicate": None, "error": matting_error,
+                    "journal_tags": journal.tags_for(content_hash) if resuming else None,
+                    "row_data": {"original_image_name": image_name, "stages": stages}, "start_time": time.monotonic()}
+            journal.record(content_hash, image_name, "matting", matting_error)
+            if matting_error is None:
+                try:
+                    # 步驟 1: 儲存去背後的圖片
+                    with span("ingest_gemini.save_image", stages, image=image_name):
+                        item["row_data"]["processed_image_path"] = save_processed_image(image_name, output_data, PROCESSED_IMAGE_DIRECTORY)
+                    # 呼叫 Gemini 之前，先以感知雜湊找出是否為已標記過的衣服
+                    with span("ingest_gemini.dedup", stages, image=image_name):
+                        item["hashes"] = perceptual_hashes(output_data)
+                        item["duplicate"] = phash_index.find_duplicate(item["hashes"], exclude=content_hash)
+                        if item["duplicate"] is None:
+                            # 先登記雜湊 (標籤在 Gemini 回應後才補上)，同一批次或之後的相近圖片才找得到它，不會兩張都送去標記
+                            phash_index.add(content_hash, image_name, item["hashes"], item["journal_tags"])
+                    if item["duplicate"] is None and item["journal_tags"] is None:
+                        # 上傳縮圖後的 JPEG，而非完整的 PNG
+                        with span("ingest_gemini.encode_payload", stages, image=image_name):
+                            item["payload"] = encode_payload(output_data)
+                except Exception as e:
+                    item["error"] = e
+                journal.record(content_hash, image_name, "prepare", item["error"])
+            if item["duplicate"] is not None and item["duplicate"][1]["tags"] is None:
+                deferred.append(item)
+                continue
+            yield item
+
+    def tagging_stage(batch):
+        # 步驟 2: 呼叫 Gemini API，多張圖片合併成一個請求
+        entries = [(item["content_hash"], item["payload"]) for item in batch if item["payload"] is not None]
+        tag_results = {}
+        if entries:
+            names = ", ".join(item["row_data"]["original_image_name"] for item in batch)
+            print(f"  -> [Gemini] 開始處理 {len(entries)} 張圖片: {names}")
+            batch_timings = {}
+            with span("ingest_gemini.tagging", batch_timings, images=len(entries)):
+                tag_results = tag_batch(model, prompt_template, batch_instruction, entries, sizer)
+            # 同一批次的圖片一起等待回應，每張都記上整個批次的秒數
+            for item in batch:
+                if item["payload"] is not None:
+                    item["row_data"]["stages"]["tagging"] = batch_timings["tagging"]
+        return [finish_item(item, tag_results.get(item["content_hash"])) for item in batch]
+
+    def finish_item(item, tag_result):
+        content_hash, row_data, output_data = item["content_hash"], item["row_data"], item["output_data"]
+        doc = None
+        try:
+            if item["error"] is not None:
+                raise item["error"]
+
+            duplicate_of = None
+            if item["duplicate"] is not None:
+                duplicate_of, original, distance = item["duplicate"]
+                print(f"  -> [Gemini] {row_data['original_image_name']} 與 {original['image_name']} 重複 (漢明距離: {distance})")
+                # 比對時原始圖片可能還在等 Gemini 回應，以目前的紀錄為準
+                original = phash_index.get(duplicate_of)
+                if original is None or original["tags"] is None:
+                    raise RuntimeError("重複的原始圖片標記失敗，無法沿用標籤")
+                if DUPLICATE_ACTION == "flag":
+                    phash_index.add(content_hash, row_data["original_image_name"], item["hashes"], original["tags"], duplicate_of=duplicate_of)
+                    journal.record(content_hash, row_data["original_image_name"], "tagging", tags=original["tags"])
+                    journal.record(content_hash, row_data["original_image_name"], "indexing", status="duplicate")
+                    row_data["status"] = "DUPLICATE"
+                    row_data["error_message"] = f"與 {original['image_name']} 重複"
+                    return content_hash, row_data, None, item["start_time"]
+                tags_data = dict(original["tags"])
+                row_data["bytes_sent"] = 0
+            elif item["journal_tags"] is not None:
+                tags_data = item["journal_tags"]
+                row_data["bytes_sent"] = 0
+            else:
+                # 每張圖片分攤到的成本：所屬請求的 token 與耗時除以請求中的圖片數
+                row_data["bytes_sent"] = len(item["payload"])
+                row_data["batch_size"] = tag_result["batch_size"]
+                row_data["prompt_tokens"] = f"{tag_result['prompt_tokens']:.0f}"
+                row_data["output_tokens"] = f"{tag_result['output_tokens']:.0f}"
+                row_data["request_seconds"] = f"{tag_result['request_seconds']:.2f}"
+                row_data["queue_wait_seconds"] = f"{tag_result['queue_wait_seconds']:.2f}"
+                if "error" in tag_result:
+                    journal.record(content_hash, row_data["original_image_name"], "tagging", tag_result["error"])
+                    raise tag_result["error"]
+                tags_data = tag_result["tags"]
+                journal.record(content_hash, row_data["original_image_name"], "tagging", tags=tags_data)
+
+            doc = {"image_path": row_data["processed_image_path"], "content_hash": content_hash, "tags": tags_data, "duplicate_of": duplicate_of} # <--- 使用處理後的圖片路徑
+            # 顏色改由去背圖片本地計算，不採用模型回傳的顏色
+            with span("ingest_gemini.color_extraction", row_data["stages"], image=row_data["original_image_name"]):
+                apply_extracted_colors(doc, output_data)
+            phash_index.add(content_hash, row_data["original_image_name"], item["hashes"], tags_data, duplicate_of=duplicate_of)
+
+            for key, value in tags_data.items():
+                row_data[key] = ", ".join(value) if isinstance(value, list) else value
+
+        except Exception as e:
+            row_data["status"] = "FAILED"
+            row_data["error_message"] = str(e)
+            # 移除預先登記的雜湊，之後相近的圖片才不會去沿用一筆沒有標籤的紀錄
+            if item["duplicate"] is None:
+                phash_index.discard(content_hash)
+
+        return content_hash, row_data, doc, item["start_time"]
 
     with open(CSV_FILENAME, 'w', newline='', encoding='utf-8') as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(CSV_HEADERS)
+        for row_data in previous_rows:
+            csv_writer.writerow([row_data.get(h, '') for h in CSV_HEADERS])
         print(f"已建立報告檔案: {CSV_FILENAME}")
 
-        image_files = [f for f in os.listdir(IMAGE_DIRECTORY) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-        
-        for image_name in image_files:
-            print(f"\n{'='*20} 正在處理圖片: {image_name} {'='*20}")
-            
-            row_data = {"original_image_name": image_name}
-            start_time = time.monotonic()
-
-            try:
-                # 步驟 1: 圖片預處理與儲存
-                pil_image, processed_path = process_and_save_image(image_name, IMAGE_DIRECTORY, PROCESSED_IMAGE_DIRECTORY)
-                row_data["processed_image_path"] = processed_path
-                print(f"  -> 圖片已去背並儲存至: {processed_path}")
-                
-                # 步驟 2: 呼叫 Gemini API
-                response = model.generate_content([prompt_template, pil_image])
-                
-                # 步驟 3: 清理並解析 JSON
-                cleaned_response = response.text.strip()
-                if cleaned_response.startswith("```json"):
-                    cleaned_response = cleaned_response[7:-3].strip()
-                
-                tags_data = json.loads(cleaned_response)
-                
-                # 步驟 4: 寫入 Elasticsearch (使用處理後的圖片路徑)
-                doc = {"image_path": processed_path, "tags": tags_data} # <--- 使用新的路徑
-                es.index(index=INDEX_NAME, document=doc)
-                
-                row_data["status"] = "SUCCESS"
-                row_data["error_message"] = ""
-                for key, value in tags_data.items():
-                    row_data[key] = ", ".join(value) if isinstance(value, list) else value
-
-                print(f"  -> 處理成功！")
-
-            except Exception as e:
-                print(f"  !!! 處理時發生錯誤: {e}")
-                row_data["status"] = "FAILED"
-                row_data["error_message"] = str(e)
-            
+        run_start = time.monotonic()
+        completed = 0
+        pending_rows = {}
+
+        def write_row(row_data):
+            nonlocal completed
+            if row_data["status"] == "FAILED":
+                print(f"  !!! 圖片 {row_data['original_image_name']} 處理時發生錯誤: {row_data['error_message']}")
+            elif row_data["status"] == "DUPLICATE":
+                print(f"  -> 圖片 {row_data['original_image_name']} {row_data['error_message']}，不寫入索引")
+            else:
+                print(f"  -> 圖片 {row_data['original_image_name']} 處理成功！已去背並儲存至: {row_data['processed_image_path']}")
+
+            # 步驟 5: 將結果寫入 CSV 報告
+            csv_writer.writerow([row_data.get(h, '') for h in CSV_HEADERS])
+            csvfile.flush()
+            completed += 1
+
+        def report_result(doc_id, error):
+            # bulk 請求送出後才知道每筆文件是否寫入成功
+            row_data = pending_rows.pop(doc_id)
+            journal.record(doc_id, row_data["original_image_name"], "indexing", error)
+            row_data["status"] = "SUCCESS" if error is None else "FAILED"
+            row_data["error_message"] = "" if error is None else error
+            write_row(row_data)
+
+        def write_stage(results):
+            for result in results:
+                write_result(result)
+
+        def write_result(result):
+            content_hash, row_data, doc, start_time = result
             end_time = time.monotonic()
             duration = end_time - start_time
             row_data["processing_time_seconds"] = f"{duration:.2f}"
-            
-            # 步驟 5: 將結果寫入 CSV 報告
-            csv_writer.writerow([row_data.get(h, '') for h in CSV_HEADERS])
-            print(f"  -> 結果已寫入 CSV (耗時: {duration:.2f} 秒)")
+            row_data["completed_at_seconds"] = f"{end_time - run_start:.2f}"
+            for stage, seconds in row_data["stages"].items():
+                row_data[f"{stage}_seconds"] = f"{seconds:.3f}"
+            print(f"\n{'='*20} 圖片處理完成: {row_data['original_image_name']} (耗時: {duration:.2f} 秒) {'='*20}")
+
+            if doc is None:
+                write_row(row_data)
+            else:
+                # 步驟 4: 放入 Elasticsearch 批次寫入佇列，結果由 report_result 寫入 CSV
+                pending_rows[content_hash] = row_data
+                writer.add(content_hash, doc)
+
+        # 去背、Gemini 呼叫與寫入三個階段同時進行，LLM_CONCURRENCY 控制同時進行中的 API 請求數 (每個請求最多 GEMINI_BATCH_MAX_IMAGES 張圖片)
+        # 完整重建時暫停 refresh，全部寫完後再 refresh 一次
+        with refresh_disabled(es, target_index) if full_rebuild else nullcontext():
+            with BulkWriter(es, target_index, on_result=report_result) as writer:
+                batches = iter_batches(prepare_stage(), sizer, lambda item: len(item["payload"]) if item["payload"] is not None else None)
+                run_pipeline(batches, tagging_stage, write_stage, workers=LLM_CONCURRENCY, queue_size=PIPELINE_QUEUE_SIZE)
+                # 所有 Gemini 請求都完成後，原始圖片的標籤已經確定
+                write_stage([finish_item(item, None) for item in deferred])
+
+        # 完整重建時，新索引通過驗證後才把別名切換過去，查詢端不會看到空的或寫到一半的索引
+        # (接續的版本索引中還有之前寫入的文件，一併計入預期的文件數)
+        published = publish_index(es, INDEX_NAME, target_index, indexed_before + writer.indexed) if full_rebuild else False
+        journal.finish_run(published)
+        journal.close()
+        # 使用內嵌索引時 (快照已存在)，同步更新快照
+        sync_snapshot(es, INDEX_NAME)
+        phash_index.save()
+        write_cluster_report(phash_index)
+
+        total_time = time.monotonic() - run_start
+        if completed:
+            print(f"\n共處理 {completed} 張圖片，總耗時 {total_time:.2f} 秒 (吞吐量: 每張 {total_time / completed:.2f} 秒)")
 
 # 假設 load_prompt 函式
 def load_prompt(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         return f.read()
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="以 Gemini 標記衣物並寫入 Elasticsearch")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--resume", action="store_true", help="接續上次中斷的導入：略過已完成的圖片，只重試失敗或未完成的")
+    mode.add_argument("--retry-failed", action="store_true", help=f"只重新處理 {CSV_FILENAME} 中 FAILED 的圖片")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    with span("ingest_gemini.main"):
+        main(resume=args.resume, retry_failed=args.retry_failed)
+    export_trace()
+    print_cache_stats()
\ No newline at end of file
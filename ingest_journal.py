@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+
+# --- 1. 設定 ---
+INGEST_JOURNAL_PATH = "./.ingest_journal_{script}.jsonl"  # <--- 每個導入腳本各自一份 (兩種模型的標籤不能混用)
+INGEST_STAGES = ("matting", "prepare", "tagging", "indexing")  # prepare: 儲存去背圖片、感知雜湊與壓縮上傳圖片
+
+# --- 2. 導入日誌 ---
+class IngestJournal:
+    """只附加的導入日誌：每張圖片每完成 (或失敗) 一個階段就寫入一行 JSON 並 fsync
+
+    程式中途被中斷時，最後一行可能只寫了一半，載入時會截斷；
+    --resume 依日誌略過已完成的工作 (標記好的標籤直接沿用)，並接續寫入尚未切換別名的版本索引。
+    """
+    def __init__(self, script, path=None):
+        self.path = path or INGEST_JOURNAL_PATH.format(script=script)
+        self._lock = threading.Lock()
+        self.items = {}   # content_hash -> {"image_name", "stages": {階段: "done"/"failed"/"duplicate"}, "tags", "errors": {階段: 錯誤訊息}}
+        self.runs = []    # 每次執行的 run_start / run_end 紀錄
+        if os.path.exists(self.path):
+            self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        """重播日誌；遇到寫到一半的最後一行就把檔案截斷在它之前，之後附加的紀錄才不會接在殘缺的行後面"""
+        valid_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    self._apply(json.loads(line))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                valid_bytes += len(line)
+        if valid_bytes < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_bytes)
+
+    def _apply(self, record):
+        if record["type"] in ("run_start", "run_end"):
+            self.runs.append(record)
+            return
+        item = self.items.setdefault(record["content_hash"], {"image_name": record["image_name"], "stages": {}, "tags": None, "errors": {}})
+        item["stages"][record["stage"]] = record["status"]
+        # 錯誤訊息依階段保存，某個階段成功不會清掉另一個仍然失敗的階段的錯誤
+        if record.get("error") is not None:
+            item["errors"][record["stage"]] = record["error"]
+        else:
+            item["errors"].pop(record["stage"], None)
+        if record["stage"] == "tagging":
+            item["tags"] = record.get("tags")
+        if record["status"] == "done" and record["stage"] == "matting":
+            # 重新處理同一張圖片時，之後階段的舊結果不再有效
+            for stage in INGEST_STAGES[1:]:
+                if item["stages"].get(stage) == "failed":
+                    del item["stages"][stage]
+                    item["errors"].pop(stage, None)
+
+    def _append(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._apply(record)
+
+    # 執行紀錄
+    def start_run(self, target_index, full_rebuild):
+        self._append({"type": "run_start", "time": time.time(), "target_index": target_index, "full_rebuild": full_rebuild})
+
+    def finish_run(self, published):
+        self._append({"type": "run_end", "time": time.time(), "published": published})
+        self.compact()
+
+    def unfinished_index(self):
+        """上一次執行是完整重建且沒有正常結束時，回傳它寫到一半的版本索引名稱"""
+        if not self.runs or self.runs[-1]["type"] != "run_start":
+            return None
+        last = self.runs[-1]
+        return last["target_index"] if last["full_rebuild"] else None
+
+    # 圖片紀錄
+    def record(self, content_hash, image_name, stage, error=None, tags=None, status=None):
+        """status 預設依 error 決定 (done / failed)；DUPLICATE_ACTION 為 flag 時，重複的圖片以 indexing 階段的 "duplicate" 結束"""
+        if status is None:
+            status = "done" if error is None else "failed"
+        record = {"type": "stage", "time": time.time(), "content_hash": content_hash, "image_name": image_name,
+                  "stage": stage, "status": status}
+        if error is not None:
+            record["error"] = str(error)
+        if tags is not None:
+            record["tags"] = tags
+        self._append(record)
+
+    def tags_for(self, content_hash):
+        """已標記完成的圖片回傳日誌中的標籤，否則回傳 None"""
+        item = self.items.get(content_hash)
+        if item is None or item["stages"].get("tagging") != "done":
+            return None
+        return item["tags"]
+
+    def failed(self):
+        """{content_hash: 圖片名稱}，任一階段最後的狀態是失敗的圖片"""
+        return {h: item["image_name"] for h, item in self.items.items() if "failed" in item["stages"].values()}
+
+    def flagged_duplicates(self):
+        """已標記為重複、刻意不寫入索引的圖片 (content_hash 集合)，--resume 時不必重新處理"""
+        return {h for h, item in self.items.items() if item["stages"].get("indexing") == "duplicate"}
+
+    def compact(self):
+        """正常結束後把日誌改寫成每張圖片一行的最新狀態，避免檔案無限成長"""
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in self.runs[-1:]:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                for content_hash, item in self.items.items():
+                    for stage, status in item["stages"].items():
+                        record = {"type": "stage", "time": time.time(), "content_hash": content_hash,
+                                  "image_name": item["image_name"], "stage": stage, "status": status}
+                        if status == "failed" and item["errors"].get(stage):
+                            record["error"] = item["errors"][stage]
+                        if stage == "tagging" and item["tags"] is not None:
+                            record["tags"] = item["tags"]
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def prune(self, valid_hashes):
+        """移除已不在衣櫃資料夾中的圖片 (下次 compact 時才會從檔案中消失)"""
+        with self._lock:
+            for content_hash in [h for h in self.items if h not in valid_hashes]:
+                del self.items[content_hash]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
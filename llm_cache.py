@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from langchain_core.messages import AIMessage
+from llm_client import get_client, print_client_stats
+
+# --- 1. 設定 ---
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"  # <--- 設定環境變數 LLM_CACHE=0 可停用快取
+LLM_CACHE_PATH = "./.llm_cache.sqlite3"
+LLM_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60  # <--- 快取有效期限 (30 天)
+LLM_CACHE_MAX_ENTRIES = 5000               # <--- 超過時淘汰最久未使用的回應
+
+# --- 2. 快取本體 ---
+class ResponseCache:
+    """以 SQLite 儲存的 LLM 回應快取，鍵為 (模型, temperature, prompt 指紋, 圖片指紋)"""
+    def __init__(self, path=LLM_CACHE_PATH, ttl_seconds=LLM_CACHE_TTL_SECONDS, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL, last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model_name, temperature, prompt_texts, image_hashes, options=None):
+        prompt_hash = hashlib.sha256("\n".join(prompt_texts).encode("utf-8")).hexdigest()
+        payload = json.dumps([model_name, temperature, prompt_hash, image_hashes, options], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model_name, response):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, response, now, now),
+            )
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+    def stats_line(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return f"LLM 回應快取：命中 {self.hits} 次，未命中 {self.misses} 次 (命中率 {hit_rate:.1f}%)"
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
+
+def print_cache_stats():
+    """在腳本結束時印出本次執行的命中率 (沒有用到快取時不印)，以及實際送出請求的排隊與服務時間"""
+    if _cache is not None:
+        print(f"\n{_cache.stats_line()}")
+    print_client_stats()
+
+# --- 3. 輔助函式 ---
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _split_langchain_messages(messages):
+    """把 LangChain 訊息拆成文字與圖片指紋兩部分"""
+    texts, image_hashes = [], []
+    for message in messages if isinstance(messages, list) else [messages]:
+        content = getattr(message, "content", message)
+        for part in content if isinstance(content, list) else [content]:
+            if isinstance(part, str):
+                texts.append(part)
+            elif part.get("type") == "image_url":
+                url = part["image_url"]
+                url = url["url"] if isinstance(url, dict) else url
+                image_hashes.append(_sha256(url.encode("utf-8")))
+            else:
+                texts.append(part.get("text", ""))
+    return texts, image_hashes
+
+def _split_gemini_contents(contents):
+    """把 Gemini 的 contents (文字、PIL 圖片、inline blob) 拆成文字與圖片指紋兩部分"""
+    texts, image_hashes = [], []
+    for part in contents if isinstance(contents, list) else [contents]:
+        if isinstance(part, str):
+            texts.append(part)
+        elif isinstance(part, dict) and "data" in part:
+            image_hashes.append(_sha256(part["data"]))
+        elif isinstance(part, bytes):
+            image_hashes.append(_sha256(part))
+        elif hasattr(part, "tobytes"):  # PIL Image：以像素內容計算指紋，不需重新編碼
+            header = f"{part.mode}:{part.size}".encode("utf-8")
+            image_hashes.append(_sha256(header + part.tobytes()))
+        else:
+            texts.append(str(part))
+    return texts, image_hashes
+
+# --- 4. 包裝呼叫 ---
+def cached_invoke(llm, messages):
+    """包裝 ChatOllama.invoke：相同模型、溫度、prompt 與圖片的請求直接回傳快取的回應
+
+    未命中時經由 llm_client 送出 (併發上限、限速與重試)。
+    """
+    client = get_client("ollama")
+    if not LLM_CACHE_ENABLED:
+        return client.call(llm.invoke, messages)
+    cache = get_cache()
+    texts, image_hashes = _split_langchain_messages(messages)
+    options = {"format": getattr(llm, "format", None)}
+    key = cache.make_key(llm.model, llm.temperature, texts, image_hashes, options)
+    cached = cache.get(key)
+    if cached is not None:
+        return AIMessage(content=cached)
+    message = client.call(llm.invoke, messages)
+    cache.put(key, llm.model, message.content)
+    return message
+
+def cached_generate_content(model, contents, **kwargs):
+    """包裝 GenerativeModel.generate_content：命中快取時回傳只有 .text 屬性的回應物件
+
+    未命中時經由 llm_client 送出 (併發上限、限速與重試)。
+    """
+    client = get_client("gemini")
+    if not LLM_CACHE_ENABLED:
+        return client.call(model.generate_content, contents, **kwargs)
+    cache = get_cache()
+    texts, image_hashes = _split_gemini_contents(contents)
+    generation_config = kwargs.get("generation_config") or getattr(model, "_generation_config", None) or {}
+    temperature = generation_config.get("temperature") if isinstance(generation_config, dict) else None
+    key = cache.make_key(model.model_name, temperature, texts, image_hashes, {"config": repr(generation_config)})
+    cached = cache.get(key)
+    if cached is not None:
+        return SimpleNamespace(text=cached)
+    response = client.call(model.generate_content, contents, **kwargs)
+    cache.put(key, model.model_name, response.text)
+    return response
@@ -0,0 +1,138 @@
+import os
+import random
+import threading
+import time
+
+# --- 1. 設定 ---
+# 每個後端的速率與併發上限；可用環境變數調整，例如 GEMINI_RPM=150 GEMINI_CONCURRENCY=8
+BACKEND_LIMITS = {
+    "gemini": {
+        "requests_per_minute": float(os.getenv("GEMINI_RPM", "60")),       # <--- 依 API 配額設定
+        "max_concurrency": int(os.getenv("GEMINI_CONCURRENCY", "4")),      # <--- 同時進行中的請求數
+    },
+    "ollama": {
+        "requests_per_minute": float(os.getenv("OLLAMA_RPM", "0")),        # <--- 0 表示不限速 (本機模型)
+        "max_concurrency": int(os.getenv("OLLAMA_CONCURRENCY", "1")),      # <--- 本機 GPU 一次只跑一個請求最快
+    },
+}
+LLM_MAX_RETRIES = 4             # <--- 可重試的錯誤最多重試幾次
+LLM_BACKOFF_BASE_SECONDS = 1.0  # <--- 第 n 次重試前最多等待 base * 2^n 秒 (full jitter)
+LLM_BACKOFF_MAX_SECONDS = 30.0
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# google.api_core 的例外沒有共同的狀態碼屬性名稱，以類別名稱判斷，不必匯入 Google 套件
+RETRYABLE_ERROR_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+                         "InternalServerError", "DeadlineExceeded", "GatewayTimeout"}
+
+# --- 2. 速率限制 ---
+class TokenBucket:
+    """權杖桶：每秒補充 rate 個權杖，最多累積 capacity 個；rate 為 0 表示不限速"""
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def is_retryable(error):
+    """429、5xx、逾時與連線錯誤可以重試；格式錯誤、認證失敗等則直接失敗"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    for attribute in ("status_code", "code"):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int) and status in RETRYABLE_STATUS_CODES:
+            return True
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES or "ConnectError" in type(error).__name__
+
+# --- 3. 後端用戶端 ---
+class BackendClient:
+    """單一後端 (gemini / ollama) 的呼叫入口：併發上限 + 權杖桶限速 + 指數退避重試
+
+    排隊時間 (等待併發名額與權杖) 與服務時間 (實際呼叫 API) 分開統計。
+    """
+    def __init__(self, name, requests_per_minute, max_concurrency):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        # 容量設為併發數，讓剛開始的幾個請求不必排隊
+        self._bucket = TokenBucket(requests_per_minute / 60, capacity=max(1, max_concurrency))
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.queue_wait_seconds = 0.0
+        self.service_seconds = 0.0
+
+    def call(self, fn, *args, **kwargs):
+        queue_wait = service = 0.0
+        try:
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                wait_start = time.monotonic()
+                with self._slots:
+                    self._bucket.acquire()
+                    service_start = time.monotonic()
+                    queue_wait += service_start - wait_start
+                    try:
+                        return fn(*args, **kwargs)
+                    except Exception as e:
+                        error = e
+                    finally:
+                        service += time.monotonic() - service_start
+                if attempt == LLM_MAX_RETRIES or not is_retryable(error):
+                    with self._lock:
+                        self.failures += 1
+                    raise error
+                delay = random.uniform(0, min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * 2 ** attempt))
+                print(f"  -> [{self.name}] 暫時性錯誤 ({type(error).__name__})，{delay:.1f} 秒後第 {attempt + 1} 次重試")
+                with self._lock:
+                    self.retries += 1
+                # 退避等待也算在排隊時間內
+                time.sleep(delay)
+                queue_wait += delay
+        finally:
+            with self._lock:
+                self.calls += 1
+                self.queue_wait_seconds += queue_wait
+                self.service_seconds += service
+            self._local.timing = (queue_wait, service)
+
+    def take_last_timing(self):
+        """取出目前執行緒最近一次呼叫的 (排隊秒數, 服務秒數)，之後重設為 (0, 0)"""
+        timing = getattr(self._local, "timing", (0.0, 0.0))
+        self._local.timing = (0.0, 0.0)
+        return timing
+
+    def stats_line(self):
+        average_wait = self.queue_wait_seconds / self.calls if self.calls else 0.0
+        average_service = self.service_seconds / self.calls if self.calls else 0.0
+        return (f"{self.name} 呼叫 {self.calls} 次 (重試 {self.retries} 次，失敗 {self.failures} 次)，"
+                f"平均排隊 {average_wait:.2f} 秒，平均服務 {average_service:.2f} 秒")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(backend):
+    with _clients_lock:
+        if backend not in _clients:
+            _clients[backend] = BackendClient(backend, **BACKEND_LIMITS[backend])
+        return _clients[backend]
+
+def print_client_stats():
+    for client in _clients.values():
+        if client.calls:
+            print(f"LLM 用戶端：{client.stats_line()}")
@@ -0,0 +1,204 @@
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image, ImageOps
+from rembg import new_session, remove
+
+# --- 1. 設定 ---
+MATTING_CACHE_DIRECTORY = "./.matting_cache"  # <--- 去背結果的共用快取資料夾
+MATTING_CACHE_MAX_BYTES = 512 * 1024 * 1024   # <--- 快取上限 (512MB)，超過時淘汰最久未使用的檔案
+# 去背模式：quality 使用完整的 U²-Net；fast 使用輕量模型，在低解析度下推論遮罩後再放大回原尺寸
+MATTING_MODES = {
+    "quality": {"model": "u2net", "inference_edge": None},
+    "fast": {"model": "u2netp", "inference_edge": 320},
+}
+MATTING_MODE = os.environ.get("MATTING_MODE", "quality")  # <--- 可用環境變數 MATTING_MODE=fast 切換
+if MATTING_MODE not in MATTING_MODES:
+    raise ValueError(f"錯誤：環境變數 MATTING_MODE='{MATTING_MODE}' 無效，可用的去背模式: {', '.join(MATTING_MODES)}")
+REMBG_MODEL = MATTING_MODES[MATTING_MODE]["model"]
+REMBG_SETTINGS = {"alpha_matting": False}
+MATTING_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # <--- 去背行程池的大小，設為 1 則在主行程依序處理
+ONNX_PROVIDERS = ["CPUExecutionProvider"]  # <--- 去背主機沒有 GPU，明確指定 CPU 避免 onnxruntime-gpu 嘗試載入 CUDA
+MATTING_MAX_EDGE = 1024    # <--- 去背前先把長邊縮到此像素數，手機原圖不必以全解析度去背
+PAYLOAD_MAX_EDGE = 768     # <--- 送給視覺模型的圖片長邊上限
+PAYLOAD_JPEG_QUALITY = 85  # <--- 送給視覺模型的 JPEG 品質
+PAYLOAD_MIME_TYPE = "image/jpeg"
+
+# --- 2. 快取 ---
+def _settings_fingerprint(model_name, settings, max_edge):
+    payload = json.dumps({"model": model_name, "settings": settings, "max_edge": max_edge}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
+
+def cache_path_for(input_data, mode=MATTING_MODE, settings=None, max_edge=MATTING_MAX_EDGE):
+    """快取檔案路徑：以原圖內容指紋加上模型、參數與縮圖尺寸組成，任何一項改變都會對應到新的檔案"""
+    model_name = MATTING_MODES[mode]["model"]
+    settings = dict(REMBG_SETTINGS if settings is None else settings,
+                    inference_edge=MATTING_MODES[mode]["inference_edge"])
+    input_hash = hashlib.sha256(input_data).hexdigest()
+    file_name = f"{input_hash}_{_settings_fingerprint(model_name, settings, max_edge)}.png"
+    return os.path.join(MATTING_CACHE_DIRECTORY, file_name)
+
+def read_cache(cache_path):
+    """讀取快取；命中時更新檔案時間，作為 LRU 淘汰的依據"""
+    try:
+        with open(cache_path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    os.utime(cache_path)
+    return data
+
+def write_cache(cache_path, output_data):
+    """先寫入暫存檔再改名，避免中斷時留下不完整的 PNG"""
+    os.makedirs(MATTING_CACHE_DIRECTORY, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(output_data)
+    os.replace(tmp_path, cache_path)
+    evict_cache()
+
+def evict_cache(max_bytes=MATTING_CACHE_MAX_BYTES):
+    """快取總大小超過上限時，從最久未使用的檔案開始刪除"""
+    entries = []
+    with os.scandir(MATTING_CACHE_DIRECTORY) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# --- 3. 去背 ---
+_sessions = {}
+
+def get_session(model_name=REMBG_MODEL):
+    """每個行程每種模型只建立一次 rembg (onnxruntime) session，之後重複使用"""
+    if model_name not in _sessions:
+        # rembg 會依 OMP_NUM_THREADS 設定 onnxruntime 的 intra/inter-op 執行緒數；未指定時使用全部核心
+        os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count() or 1))
+        _sessions[model_name] = new_session(model_name, providers=ONNX_PROVIDERS)
+    return _sessions[model_name]
+
+def _init_worker(threads_per_worker):
+    # 每個工作行程分到固定的執行緒數，避免多個行程互搶 CPU
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    get_session()
+
+def predict_mask(image, mode=MATTING_MODE):
+    """回傳與 image 同尺寸的 L 模式遮罩；fast 模式先縮到 inference_edge 推論，再把遮罩放大回來"""
+    settings = MATTING_MODES[mode]
+    session = get_session(settings["model"])
+    inference_edge = settings["inference_edge"]
+    if inference_edge is None or max(image.size) <= inference_edge:
+        return remove(image, session=session, only_mask=True, **REMBG_SETTINGS)
+    small = image.copy()
+    small.thumbnail((inference_edge, inference_edge), Image.BILINEAR)
+    mask = remove(small, session=session, only_mask=True, **REMBG_SETTINGS)
+    return mask.resize(image.size, Image.BILINEAR)
+
+def _matte(input_data, max_edge=MATTING_MAX_EDGE, mode=MATTING_MODE):
+    """解碼一次 -> 縮圖 -> 去背 -> 裁切到衣物的範圍，回傳 PNG bytes"""
+    with Image.open(io.BytesIO(input_data)) as source:
+        # 手機照片的方向記錄在 EXIF 中，縮圖前先轉正
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    matted = image.convert("RGBA")
+    matted.putalpha(predict_mask(image, mode))
+    # 只保留不透明像素的外框，去掉四周大片透明區域
+    bbox = matted.getchannel("A").getbbox()
+    if bbox:
+        matted = matted.crop(bbox)
+    buffer = io.BytesIO()
+    matted.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def _remove_file(image_path):
+    with open(image_path, "rb") as input_file:
+        return _matte(input_file.read())
+
+def remove_background(input_data):
+    """移除背景並回傳 PNG bytes；相同的原圖與設定只會計算一次"""
+    cache_path = cache_path_for(input_data)
+    output_data = read_cache(cache_path)
+    if output_data is None:
+        output_data = _matte(input_data)
+        write_cache(cache_path, output_data)
+    return output_data
+
+def remove_background_file(image_path):
+    """讀取圖片檔並移除背景"""
+    with open(image_path, "rb") as input_file:
+        return remove_background(input_file.read())
+
+def iter_remove_backgrounds(image_paths, workers=MATTING_WORKERS):
+    """批次去背：快取命中的圖片立即交出，其餘分散到行程池，完成一張就交出一張
+
+    產生 (image_path, output_data, error)，順序依完成先後而定；
+    單張圖片失敗時 output_data 為 None、error 為例外物件，不會中斷整批處理。
+    """
+    misses = []
+    for image_path in image_paths:
+        try:
+            with open(image_path, "rb") as input_file:
+                cache_path = cache_path_for(input_file.read())
+        except OSError as e:
+            yield image_path, None, e
+            continue
+        output_data = read_cache(cache_path)
+        if output_data is None:
+            misses.append((image_path, cache_path))
+        else:
+            yield image_path, output_data, None
+
+    if not misses:
+        return
+    workers = min(workers, len(misses))
+    if workers <= 1:
+        for image_path, cache_path in misses:
+            try:
+                output_data = _remove_file(image_path)
+            except Exception as e:
+                yield image_path, None, e
+                continue
+            write_cache(cache_path, output_data)
+            yield image_path, output_data, None
+        return
+
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+    print(f"  -> 正在以 {workers} 個行程平行去背 {len(misses)} 張圖片...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        futures = {pool.submit(_remove_file, image_path): (image_path, cache_path) for image_path, cache_path in misses}
+        for future in as_completed(futures):
+            image_path, cache_path = futures[future]
+            try:
+                output_data = future.result()
+            except Exception as e:
+                yield image_path, None, e
+                continue
+            # 只由主行程寫入快取，LRU 淘汰不會與工作行程互相競爭
+            write_cache(cache_path, output_data)
+            yield image_path, output_data, None
+
+# --- 4. 模型輸入 ---
+def encode_payload(output_data, max_edge=PAYLOAD_MAX_EDGE, quality=PAYLOAD_JPEG_QUALITY):
+    """把去背結果轉成送給視覺模型的壓縮圖片：貼在白底上、縮到 max_edge 並存成 JPEG
+
+    模型只需要看清楚衣物本身，不需要透明通道與原始解析度；回傳 JPEG bytes (MIME 為 PAYLOAD_MIME_TYPE)。
+    """
+    with Image.open(io.BytesIO(output_data)) as matted:
+        matted = matted.convert("RGBA")
+    matted.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    canvas = Image.new("RGB", matted.size, (255, 255, 255))
+    canvas.paste(matted, mask=matted.getchannel("A"))
+    buffer = io.BytesIO()
+    canvas.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import time
+import ollama
+
+# --- 1. 設定 ---
+OLLAMA_KEEP_ALIVE = "30m"                           # <--- 階段進行中讓模型常駐，避免每張圖片都重新載入
+VISION_DESCRIPTIONS_PATH = "./.vision_descriptions.json"  # <--- 視覺模型的描述先存檔，第二階段 (或中斷後重跑) 直接讀取
+
+# --- 2. 模型載入與卸載 ---
+def load_model(base_url, model_name, keep_alive=OLLAMA_KEEP_ALIVE):
+    """送出空白 prompt 讓 Ollama 把模型載入記憶體 (不產生任何文字)，回傳載入秒數"""
+    start_time = time.monotonic()
+    response = ollama.Client(host=base_url).generate(model=model_name, prompt="", keep_alive=keep_alive)
+    load_duration = getattr(response, "load_duration", None)
+    return load_duration / 1e9 if load_duration else time.monotonic() - start_time
+
+def unload_model(base_url, model_name):
+    """keep_alive=0 讓 Ollama 立刻釋放模型，下一階段的模型才有足夠的記憶體"""
+    ollama.Client(host=base_url).generate(model=model_name, prompt="", keep_alive=0)
+
+def _durations(message, wall_seconds):
+    """從 Ollama 回應的 metadata 拆出 (載入秒數, 推論秒數)；快取命中的回應沒有 metadata"""
+    metadata = getattr(message, "response_metadata", None) or {}
+    total = metadata.get("total_duration")
+    if not total:
+        return 0.0, wall_seconds
+    load = metadata.get("load_duration") or 0
+    return load / 1e9, (total - load) / 1e9
+
+# --- 3. 描述存檔 ---
+class DescriptionStore:
+    """(模型, 圖片指紋) -> 視覺模型的描述，每寫入一筆就存檔一次
+
+    每筆描述附上產生它的 prompt 指紋 (與 llm_cache.ResponseCache 相同以 SHA-256 計算)；
+    描述 prompt 修改後，舊的描述不再沿用，重新描述時直接覆蓋。
+    """
+    def __init__(self, prompt, path=VISION_DESCRIPTIONS_PATH):
+        self.path = path
+        self.prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+
+    def get(self, model_name, content_hash):
+        entry = self._entries.get(f"{model_name}:{content_hash}")
+        # 舊格式的紀錄只有描述文字，不知道是哪個 prompt 產生的，視同沒有描述
+        if not isinstance(entry, dict) or entry.get("prompt_hash") != self.prompt_hash:
+            return None
+        return entry["description"]
+
+    def put(self, model_name, content_hash, description):
+        self._entries[f"{model_name}:{content_hash}"] = {"prompt_hash": self.prompt_hash, "description": description}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+# --- 4. 分階段執行 ---
+def run_phase(label, base_url, model_name, keys, call):
+    """同一個模型連續處理所有 keys：先載入 (暖機)，全部跑完再卸載
+
+    call(key) 回傳 LangChain 的訊息物件；回傳 ({key: 訊息或例外}, 統計)，
+    統計中模型載入時間與推論時間分開記錄 (durations 為每個 key 的 (載入秒數, 推論秒數))，單筆失敗不會中斷整個階段。
+    """
+    results = {}
+    stats = {"model": model_name, "load_seconds": 0.0, "inference_seconds": 0.0, "calls": 0, "failures": 0, "durations": {}}
+    if not keys:
+        return results, stats
+    print(f"\n--- [{label}] 正在載入 {model_name} ...")
+    try:
+        stats["load_seconds"] = load_model(base_url, model_name)
+        print(f"  -> {model_name} 載入完成 ({stats['load_seconds']:.2f} 秒)，開始處理 {len(keys)} 張圖片")
+    except Exception as e:
+        # 暖機失敗時照常執行，第一個請求會自行載入模型
+        print(f"  !!! {model_name} 暖機失敗 ({e})")
+
+    try:
+        for key in keys:
+            start_time = time.monotonic()
+            try:
+                message = call(key)
+            except Exception as e:
+                results[key] = e
+                stats["failures"] += 1
+                continue
+            load_seconds, inference_seconds = _durations(message, time.monotonic() - start_time)
+            # 模型被意外換出時，這次請求的重新載入時間也計入載入時間
+            stats["load_seconds"] += load_seconds
+            stats["inference_seconds"] += inference_seconds
+            stats["calls"] += 1
+            stats["durations"][key] = (load_seconds, inference_seconds)
+            results[key] = message
+    finally:
+        try:
+            unload_model(base_url, model_name)
+        except Exception as e:
+            print(f"  !!! 卸載 {model_name} 失敗 ({e})")
+    print(f"--- [{label}] 完成：載入 {stats['load_seconds']:.2f} 秒，推論 {stats['inference_seconds']:.2f} 秒 "
+          f"({stats['calls']} 次成功，{stats['failures']} 次失敗)")
+    return results, stats
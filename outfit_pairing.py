@@ -0,0 +1,127 @@
+import numpy as np
+from closet_schema import CLOSET_VOCABULARY, COLOR_VOCABULARY, NEUTRAL_COLORS
+from search_utils import as_list
+
+# --- 1. 設定 ---
+CANDIDATE_POOL_SIZE = 50  # <--- 上衣與下著各取幾件候選，最多評分 50 x 50 種組合
+PAIRING_WEIGHTS = {       # <--- 各項分數的權重
+    "color": 0.35,
+    "style": 0.2,
+    "occasion": 0.15,
+    "season": 0.1,
+    "relevance": 0.2,
+}
+
+# 明顯撞色的組合 (不分順序)
+CLASHING_COLORS = [("紅色", "綠色"), ("紅色", "粉紅色"), ("紅色", "橘色"), ("橘色", "紫色"),
+                   ("綠色", "紫色"), ("黃色", "紫色"), ("粉紅色", "橘色")]
+OTHER_COLOR = len(COLOR_VOCABULARY)  # 不在色表中的顏色
+
+# --- 2. 顏色和諧矩陣 ---
+def build_color_harmony_matrix():
+    """(色數+1) x (色數+1) 的對稱矩陣，最後一列/欄代表未知顏色"""
+    size = len(COLOR_VOCABULARY) + 1
+    matrix = np.full((size, size), 0.5, dtype=np.float32)
+    neutral = np.zeros(size, dtype=bool)
+    neutral[[COLOR_VOCABULARY.index(c) for c in NEUTRAL_COLORS]] = True
+    # 中性色幾乎百搭；兩件都是中性色且不同色最安全
+    matrix[neutral, :] = 0.8
+    matrix[:, neutral] = 0.8
+    matrix[np.ix_(neutral, neutral)] = 0.9
+    # 上下同一個鮮豔色顯得單調
+    diagonal = np.arange(len(COLOR_VOCABULARY))
+    matrix[diagonal, diagonal] = np.where(neutral[:-1], 0.7, 0.4)
+    for a, b in CLASHING_COLORS:
+        i, j = COLOR_VOCABULARY.index(a), COLOR_VOCABULARY.index(b)
+        matrix[i, j] = matrix[j, i] = 0.15
+    matrix[OTHER_COLOR, :] = matrix[:, OTHER_COLOR] = 0.5
+    return matrix
+
+COLOR_HARMONY = build_color_harmony_matrix()
+
+def color_index(name):
+    """把模型回傳的顏色對應到色表：先精確比對，再以色名主字比對 (例如「淺藍色」-> 藍色)"""
+    if not isinstance(name, str):
+        return OTHER_COLOR
+    if name in COLOR_VOCABULARY:
+        return COLOR_VOCABULARY.index(name)
+    # 由長到短比對，避免「粉紅色」被當成「紅色」
+    for color in sorted(COLOR_VOCABULARY, key=len, reverse=True):
+        if color.rstrip("色") in name:
+            return COLOR_VOCABULARY.index(color)
+    return OTHER_COLOR
+
+# --- 3. 編碼 ---
+def _multi_hot(items, field):
+    vocabulary = CLOSET_VOCABULARY[field]
+    matrix = np.zeros((len(items), len(vocabulary)), dtype=np.float32)
+    for row, item in enumerate(items):
+        for value in as_list(item.get("tags", {}).get(field)):
+            if value in vocabulary:
+                matrix[row, vocabulary.index(value)] = 1.0
+    return matrix
+
+def encode_items(items):
+    """把搜尋結果編碼成向量：主色索引、風格/場合/季節 multi-hot，以及正規化後的 ES 分數"""
+    scores = np.array([item.get("_score") or 0.0 for item in items], dtype=np.float32)
+    max_score = scores.max() if len(scores) else 0.0
+    return {
+        "color": np.array([color_index(item.get("tags", {}).get("main_color")) for item in items], dtype=np.int64),
+        "style": _multi_hot(items, "style_tags"),
+        "occasion": _multi_hot(items, "occasion_tags"),
+        "season": _multi_hot(items, "suitable_seasons"),
+        "relevance": scores / max_score if max_score > 0 else np.ones_like(scores),
+    }
+
+def _cosine_matrix(a, b):
+    """兩組 multi-hot 向量兩兩之間的餘弦相似度；任一邊沒有標籤時給中間值 0.5"""
+    norm_a = np.linalg.norm(a, axis=1)
+    norm_b = np.linalg.norm(b, axis=1)
+    denominator = np.outer(norm_a, norm_b)
+    similarity = np.divide(a @ b.T, denominator, out=np.full(denominator.shape, 0.5, dtype=np.float32),
+                           where=denominator > 0)
+    return similarity
+
+# --- 4. 評分與挑選 ---
+def score_pairs(tops, bottoms, weights=PAIRING_WEIGHTS):
+    """回傳 len(tops) x len(bottoms) 的分數矩陣，每一格是一套上衣+下著的搭配分數"""
+    t, b = encode_items(tops), encode_items(bottoms)
+    return (weights["color"] * COLOR_HARMONY[np.ix_(t["color"], b["color"])]
+            + weights["style"] * _cosine_matrix(t["style"], b["style"])
+            + weights["occasion"] * _cosine_matrix(t["occasion"], b["occasion"])
+            + weights["season"] * _cosine_matrix(t["season"], b["season"])
+            + weights["relevance"] * (t["relevance"][:, None] + b["relevance"][None, :]) / 2)
+
+def pair_outfits(tops, bottoms, k=3, max_reuse=1):
+    """從所有上衣 x 下著組合中挑出分數最高、且彼此不重複的 k 套
+
+    每件衣服最多出現在 max_reuse 套搭配中，避免前幾名都是同一件白 T 配不同褲子；
+    若衣櫃太小湊不滿 k 套，才放寬限制補上剩下的組合。回傳 [(top, bottom, score), ...]。
+    """
+    if not tops or not bottoms:
+        return []
+    scores = score_pairs(tops, bottoms)
+    flat = scores.ravel()
+    # 只需要排序前面一小段即可挑出 k 套，大衣櫃時避免對全部組合排序
+    limit = min(flat.size, max(k * (max_reuse + 1) * max(len(tops), len(bottoms)), k))
+    candidates = np.argpartition(-flat, limit - 1)[:limit] if limit < flat.size else np.arange(flat.size)
+    candidates = candidates[np.argsort(-flat[candidates], kind="stable")]
+
+    chosen, top_uses, bottom_uses = [], {}, {}
+    for index in candidates:
+        i, j = divmod(int(index), scores.shape[1])
+        if top_uses.get(i, 0) >= max_reuse or bottom_uses.get(j, 0) >= max_reuse:
+            continue
+        chosen.append((i, j))
+        top_uses[i] = top_uses.get(i, 0) + 1
+        bottom_uses[j] = bottom_uses.get(j, 0) + 1
+        if len(chosen) == k:
+            break
+    if len(chosen) < k:
+        for index in candidates:
+            pair = divmod(int(index), scores.shape[1])
+            if pair not in chosen:
+                chosen.append(pair)
+                if len(chosen) == k:
+                    break
+    return [(tops[i], bottoms[j], float(scores[i, j])) for i, j in chosen]
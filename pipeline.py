@@ -0,0 +1,57 @@
+import queue
+import threading
+
+# 佇列中的結束標記
+_DONE = object()
+
+class _StageError:
+    """把工作執行緒中的例外帶回呼叫端執行緒再拋出"""
+    def __init__(self, error):
+        self.error = error
+
+def run_pipeline(source, worker, sink, workers=4, queue_size=8):
+    """三段式管線：source 產生工作 -> workers 個執行緒並行執行 worker -> 呼叫端執行緒依完成順序執行 sink
+
+    - source 在獨立執行緒中迭代 (例如 CPU 密集的去背行程池)，worker 適合網路密集的 LLM 呼叫，
+      sink 則負責寫入 Elasticsearch 與 CSV 這類需要依序進行的動作。
+    - 兩個佇列都有上限 queue_size，下游跟不上時上游會被阻塞 (backpressure)，避免圖片在記憶體中堆積。
+    - worker 應自行處理單筆工作的錯誤；未被處理的例外會在呼叫端重新拋出。
+    """
+    work_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+
+    def produce():
+        try:
+            for item in source:
+                work_queue.put(item)
+        except Exception as e:
+            result_queue.put(_StageError(e))
+        finally:
+            for _ in range(workers):
+                work_queue.put(_DONE)
+
+    def consume():
+        while True:
+            item = work_queue.get()
+            if item is _DONE:
+                result_queue.put(_DONE)
+                return
+            try:
+                result_queue.put(worker(item))
+            except Exception as e:
+                result_queue.put(_StageError(e))
+
+    threads = [threading.Thread(target=produce, name="pipeline-source", daemon=True)]
+    threads += [threading.Thread(target=consume, name=f"pipeline-worker-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    finished = 0
+    while finished < workers:
+        result = result_queue.get()
+        if result is _DONE:
+            finished += 1
+        elif isinstance(result, _StageError):
+            raise result.error
+        else:
+            sink(result)
@@ -0,0 +1,140 @@
+import atexit
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+# --- 1. 設定 ---
+QUERY_CACHE_PATH = "./.query_cache.json"
+QUERY_CACHE_MAX_ENTRIES = 500              # <--- 超過時淘汰最久未使用的翻譯
+QUERY_CACHE_SIMILARITY_THRESHOLD = 0.85    # <--- 字元 n-gram 餘弦相似度達到此值才視為「同一種說法」
+QUERY_CACHE_NGRAM_SIZES = (1, 2)           # <--- 中文請求很短，同時使用單字與雙字 n-gram
+
+_PUNCTUATION = re.compile(r"[\s\W_]+", re.UNICODE)
+
+# --- 2. 文字正規化與向量 ---
+def normalize_request(text):
+    """全形轉半形、轉小寫並移除空白與標點，讓「我明天要去郊外踏青！」與「我明天要去郊外踏青」視為相同"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _PUNCTUATION.sub("", text)
+
+def ngram_vector(text, sizes=QUERY_CACHE_NGRAM_SIZES):
+    grams = Counter()
+    for n in sizes:
+        grams.update(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+def cosine_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+def is_valid_query_pair(queries):
+    """只快取結構正確的結果：必須同時有 top_query 與 bottom_query 兩個查詢物件"""
+    return (isinstance(queries, dict)
+            and isinstance(queries.get("top_query"), dict)
+            and isinstance(queries.get("bottom_query"), dict))
+
+# --- 3. 快取 ---
+class QueryTranslationCache:
+    """自然語言請求 -> ES 查詢的翻譯快取：先精確比對正規化後的文字，再以 n-gram 相似度找相近的說法
+
+    每筆翻譯都記錄產生它的 prompt 指紋，prompt 檔案修改後舊的翻譯不會再被使用。
+    只有新增 (與淘汰) 時立刻存檔；命中只更新記憶體中的最後使用時間，程式結束時 (flush) 才寫回，查詢路徑上沒有磁碟 I/O。
+    """
+    def __init__(self, path=QUERY_CACHE_PATH, max_entries=QUERY_CACHE_MAX_ENTRIES,
+                 similarity_threshold=QUERY_CACHE_SIMILARITY_THRESHOLD):
+        self.path = path
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        self._vectors = {key: ngram_vector(key) for key in self._entries}
+
+    def lookup(self, user_request, prompt_hash):
+        """回傳 (queries, similarity)，找不到時回傳 (None, 最佳相似度)"""
+        key = normalize_request(user_request)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["prompt_hash"] == prompt_hash:
+                self.exact_hits += 1
+                return self._touch(entry), 1.0
+
+            vector = ngram_vector(key)
+            best_key, best_score = None, 0.0
+            for other_key, other_vector in self._vectors.items():
+                if self._entries[other_key]["prompt_hash"] != prompt_hash:
+                    continue
+                score = cosine_similarity(vector, other_vector)
+                if score > best_score:
+                    best_key, best_score = other_key, score
+            if best_key is not None and best_score >= self.similarity_threshold:
+                self.similar_hits += 1
+                return self._touch(self._entries[best_key]), best_score
+            self.misses += 1
+            return None, best_score
+
+    def store(self, user_request, prompt_hash, queries):
+        if not is_valid_query_pair(queries):
+            return
+        key = normalize_request(user_request)
+        with self._lock:
+            self._entries[key] = {"request": user_request, "prompt_hash": prompt_hash,
+                                  "queries": queries, "last_used": time.time()}
+            self._vectors[key] = ngram_vector(key)
+            if len(self._entries) > self.max_entries:
+                by_age = sorted(self._entries, key=lambda k: self._entries[k]["last_used"])
+                for old_key in by_age[:len(self._entries) - self.max_entries]:
+                    del self._entries[old_key]
+                    del self._vectors[old_key]
+            self._save()
+
+    def _touch(self, entry):
+        entry["last_used"] = time.time()
+        self._dirty = True
+        return entry["queries"]
+
+    def flush(self):
+        """把命中後更新的最後使用時間寫回檔案 (沒有變更時不寫)"""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def stats_line(self):
+        total = self.exact_hits + self.similar_hits + self.misses
+        hit_rate = (self.exact_hits + self.similar_hits) / total * 100 if total else 0.0
+        return (f"查詢翻譯快取：精確命中 {self.exact_hits} 次，相似命中 {self.similar_hits} 次，"
+                f"未命中 {self.misses} 次 (命中率 {hit_rate:.1f}%)")
+
+_cache = None
+
+def get_query_cache():
+    global _cache
+    if _cache is None:
+        _cache = QueryTranslationCache()
+        atexit.register(_cache.flush)
+    return _cache
+
+def print_query_cache_stats():
+    if _cache is not None:
+        print(f"\n{_cache.stats_line()}")
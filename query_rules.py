@@ -0,0 +1,77 @@
+import datetime
+import re
+
+# --- 1. 設定 ---
+RULE_CONFIDENCE_THRESHOLD = 0.5  # <--- 信心度達到此值才直接使用規則產生的查詢，否則交給 LLM
+
+# 關鍵字 / 同義詞 -> 封閉詞彙中的標籤 (一個關鍵字可以對應多個欄位)
+OCCASION_KEYWORDS = {
+    "上班通勤": ["上班", "通勤", "辦公", "公司", "工作"],
+    "商務會議": ["開會", "會議", "簡報", "客戶", "面試", "商務"],
+    "約會": ["約會", "見面", "看電影", "男友", "女友", "男朋友", "女朋友"],
+    "派對晚宴": ["派對", "晚宴", "婚禮", "喜宴", "尾牙", "聚會", "趴"],
+    "戶外運動": ["運動", "健身", "跑步", "爬山", "登山", "踏青", "露營", "打球", "騎車", "健行"],
+    "旅行度假": ["旅行", "旅遊", "度假", "出遊", "出國", "海邊", "郊外", "郊遊", "踏青"],
+    "居家": ["在家", "居家", "宅", "耍廢"],
+}
+STYLE_KEYWORDS = {
+    "日常休閒": ["休閒", "輕鬆", "日常", "逛街", "踏青", "郊遊", "出遊", "隨興"],
+    "商務休閒": ["上班", "辦公", "商務休閒", "通勤"],
+    "正式": ["正式", "婚禮", "面試", "晚宴", "典禮", "喜宴"],
+    "街頭潮流": ["街頭", "潮流", "很潮"],
+    "運動機能": ["運動", "健身", "跑步", "登山", "爬山", "健行"],
+    "簡約": ["簡約", "簡單", "低調"],
+    "甜美": ["甜美", "可愛", "約會"],
+    "復古": ["復古", "古著", "懷舊"],
+}
+SEASON_KEYWORDS = {
+    "春季": ["春天", "春季"],
+    "夏季": ["夏天", "夏季", "很熱", "炎熱", "好熱"],
+    "秋季": ["秋天", "秋季"],
+    "冬季": ["冬天", "冬季", "很冷", "寒冷", "好冷", "寒流"],
+}
+DAY_OFFSET_KEYWORDS = {"今天": 0, "明天": 1, "後天": 2, "下週": 7, "下禮拜": 7}
+
+# 規則無法正確表達的說法 (否定句、指定顏色)，出現時一律交給 LLM
+UNSUPPORTED_PATTERN = re.compile(r"不要|不想|不穿|別穿|[紅橙黃綠藍紫黑白灰粉棕咖米卡]色|顏色")
+
+# --- 2. 規則比對 ---
+def _match_keywords(text, keyword_map):
+    return [tag for tag, keywords in keyword_map.items() if any(k in text for k in keywords)]
+
+def season_for_date(date):
+    """依月份推算季節 (北半球)：12-2 月為冬季，3-5 月為春季，依此類推"""
+    return ["冬季", "春季", "夏季", "秋季"][(date.month % 12) // 3]
+
+def infer_target_date(text, today=None):
+    today = today or datetime.date.today()
+    offsets = [offset for keyword, offset in DAY_OFFSET_KEYWORDS.items() if keyword in text]
+    return today + datetime.timedelta(days=max(offsets) if offsets else 0)
+
+def _build_query(primary_category, tags):
+    should = [{"match": {f"tags.{field}": value}} for field, values in tags.items() for value in values]
+    return {"bool": {"must": [{"match": {"tags.primary_category": primary_category}}], "should": should}}
+
+def extract_queries_by_rules(user_request, today=None):
+    """以關鍵字詞典直接產生 top_query / bottom_query，回傳 (queries, confidence, tags)
+
+    信心度的估算：明確的場合 +0.5、風格每個 +0.25、明確提到季節 +0.25，上限 1.0；
+    出現否定或指定顏色等規則無法處理的說法時信心度為 0。
+    """
+    occasions = _match_keywords(user_request, OCCASION_KEYWORDS)
+    styles = _match_keywords(user_request, STYLE_KEYWORDS)
+    seasons = _match_keywords(user_request, SEASON_KEYWORDS)
+    explicit_season = bool(seasons)
+    if not seasons:
+        seasons = [season_for_date(infer_target_date(user_request, today))]
+
+    tags = {"occasion_tags": occasions, "style_tags": styles, "suitable_seasons": seasons}
+    queries = {
+        "top_query": _build_query("上衣", tags),
+        "bottom_query": _build_query("下著", tags),
+    }
+
+    if UNSUPPORTED_PATTERN.search(user_request):
+        return queries, 0.0, tags
+    confidence = 0.5 * bool(occasions) + 0.25 * len(styles) + 0.25 * explicit_season
+    return queries, min(confidence, 1.0), tags
@@ -0,0 +1,34 @@
+import csv
+import datetime
+import os
+
+# --- 1. 設定 ---
+LATENCY_CSV_FILENAME = "recommendation_latency_report.csv"
+LATENCY_CSV_HEADERS = [
+    "timestamp", "backend", "model", "user_request", "streaming",
+    "outfits_ready_seconds", "time_to_first_token_seconds", "text_generation_seconds", "total_latency_seconds",
+]
+
+# --- 2. 記錄 ---
+def record_request_latency(backend, model, user_request, streaming, outfits_ready, first_token, text_generation, total):
+    """每一次推薦請求附加一列延遲紀錄；所有時間都是從收到請求開始計算的秒數 (文案生成時間除外)"""
+    is_new_file = not os.path.exists(LATENCY_CSV_FILENAME)
+    row = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "backend": backend,
+        "model": model,
+        "user_request": user_request,
+        "streaming": streaming,
+        "outfits_ready_seconds": _format_seconds(outfits_ready),
+        "time_to_first_token_seconds": _format_seconds(first_token),
+        "text_generation_seconds": _format_seconds(text_generation),
+        "total_latency_seconds": _format_seconds(total),
+    }
+    with open(LATENCY_CSV_FILENAME, "a", newline="", encoding="utf-8") as csvfile:
+        csv_writer = csv.writer(csvfile)
+        if is_new_file:
+            csv_writer.writerow(LATENCY_CSV_HEADERS)
+        csv_writer.writerow([row[h] for h in LATENCY_CSV_HEADERS])
+
+def _format_seconds(value):
+    return "" if value is None else f"{value:.2f}"
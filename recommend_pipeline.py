@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import time
+from functools import lru_cache
+from closet_search import search_categories
+from query_cache import get_query_cache
+from query_rules import extract_queries_by_rules, RULE_CONFIDENCE_THRESHOLD
+from outfit_pairing import pair_outfits, CANDIDATE_POOL_SIZE
+from recommend_metrics import record_request_latency
+from tracing import span
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+
+# --- 推薦流程：recommend_outfits.py (Ollama) 與 recommend_outfits_gemini.py (Gemini) 共用，兩者只差在使用的 LLM ---
+
+# --- 1. 設定 ---
+INDEX_NAME = "virtual_closet"
+PROMPT_FOLDER = "./prompts"
+STREAM_OUTPUT = True  # <--- 邊生成邊印出推薦文案；設為 False 則等整段文字完成才印出
+
+# --- 2. 輔助函式 ---
+def load_prompt(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+@lru_cache(maxsize=None)
+def load_query_prompt():
+    """讀取並解析查詢 prompt，整個程式只讀檔一次；同時回傳 prompt 指紋供快取比對"""
+    prompt_template_str = load_prompt(os.path.join(PROMPT_FOLDER, "3_rag_query_prompt.txt"))
+    prompt_hash = hashlib.sha256(prompt_template_str.encode("utf-8")).hexdigest()
+    return ChatPromptTemplate.from_template(prompt_template_str), prompt_hash
+
+# --- 3. 推薦步驟 ---
+def generate_es_queries(user_request: str, llm) -> dict:
+    """步驟 1: 將自然語言轉換為 Elasticsearch 查詢"""
+    print(f"\n[1/4] 🧠 正在將 '{user_request}' 轉換為 ES 查詢...")
+
+    # 常見的說法直接以關鍵字規則產生查詢，不需要等待 LLM
+    rule_queries, confidence, rule_tags = extract_queries_by_rules(user_request)
+    if confidence >= RULE_CONFIDENCE_THRESHOLD:
+        print(f"  -> 規則引擎直接產生查詢 (信心度: {confidence:.2f}，標籤: {json.dumps(rule_tags, ensure_ascii=False)})")
+        return rule_queries
+
+    prompt_template, prompt_hash = load_query_prompt()
+
+    # 相同或相近的說法之前翻譯過，就直接使用已驗證過的查詢
+    query_cache = get_query_cache()
+    cached_queries, similarity = query_cache.lookup(user_request, prompt_hash)
+    if cached_queries is not None:
+        print(f"  -> 使用快取的查詢指令 (相似度: {similarity:.2f})")
+        return cached_queries
+
+    chain = prompt_template | llm | StrOutputParser()
+
+    try:
+        query_str = chain.invoke({"user_request": user_request})
+    except Exception as e:
+        # LLM 無法使用時，退回規則引擎的結果 (至少包含依日期推算的季節)
+        print(f"  !!! LLM 呼叫失敗 ({e})，改用規則引擎產生的查詢 (信心度: {confidence:.2f})")
+        return rule_queries
+    print(f"  -> 生成的查詢指令: {query_str}")
+
+    # 在解析 JSON 之前，先清理字串，移除可能的 Markdown 標記
+    if query_str.strip().startswith("```json"):
+        cleaned_query_str = query_str.strip()[7:-3].strip()
+    else:
+        cleaned_query_str = query_str
+
+    es_queries = json.loads(cleaned_query_str)
+    query_cache.store(user_request, prompt_hash, es_queries)
+    return es_queries
+
+def search_outfit_candidates(es_client, es_queries: dict, size: int = CANDIDATE_POOL_SIZE) -> dict:
+    """步驟 2: 以單一 _msearch 請求同時搜尋所有類別的候選衣物"""
+    category_queries = {name: query for name, query in es_queries.items() if name.endswith("_query")}
+    print(f"\n[2/4] 🔍 正在 Elasticsearch 中搜尋 ({', '.join(category_queries)})...")
+    results = search_categories(es_client, INDEX_NAME, category_queries, size)
+    for name, hits in results.items():
+        print(f"  -> {name}: 找到了 {len(hits)} 件相符的衣物。")
+    return results
+
+def generate_recommendation_text(outfits: list, user_request: str, llm, stream: bool = STREAM_OUTPUT) -> tuple:
+    """步驟 4: 生成人性化的推薦文案
+
+    串流模式下每收到一段文字就立刻印出；回傳 (完整文案, 收到第一段文字的 time.monotonic() 時間)。
+    非串流模式沒有首字延遲可言 (整段文字一起回來)，第二個值為 None，報告中的首字延遲留空。
+    """
+    context = f"使用者的需求是：'{user_request}'。\n"
+    context += "根據需求，我為他搭配了以下幾套穿搭：\n"
+    for i, (top, bottom, score) in enumerate(outfits):
+        context += f"\n套裝 {i+1}:\n"
+        context += f"- 上衣: {top['tags']['sub_category']} (風格: {', '.join(top['tags']['style_tags'])})\n"
+        context += f"- 下著: {bottom['tags']['sub_category']} (風格: {', '.join(bottom['tags']['style_tags'])})\n"
+
+    prompt = f"""
+    You are a friendly and professional fashion stylist.
+    Based on the following context, write a short, encouraging, and descriptive recommendation summary for the user.
+    Address the user directly and explain in 1-2 sentences why these combinations work for their request.
+    Keep the language natural and engaging. Speak in Traditional Chinese.
+
+    CONTEXT:
+    {context}
+
+    YOUR RECOMMENDATION:
+    """
+
+    if not stream:
+        text = llm.invoke(prompt).content
+        return text, None
+
+    chunks, first_token_at = [], None
+    for chunk in llm.stream(prompt):
+        if not chunk.content:
+            continue
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+        print(chunk.content, end="", flush=True)
+        chunks.append(chunk.content)
+    print()
+    return "".join(chunks), first_token_at
+
+# --- 4. 完整流程 ---
+def run_recommendation(user_request, llm, es, backend, model_name, stream=STREAM_OUTPUT):
+    """查詢翻譯 -> 搜尋 -> 搭配 -> 文案，並記錄首字延遲與總耗時；backend 與 model_name 只用於延遲報告"""
+    request_start = time.monotonic()
+    try:
+        with span("recommend.query_translation"):
+            es_queries = generate_es_queries(user_request, llm)
+
+        with span("recommend.search"):
+            candidates = search_outfit_candidates(es, es_queries)
+        top_results = candidates.get("top_query", [])
+        bottom_results = candidates.get("bottom_query", [])
+
+        if not top_results or not bottom_results:
+            print("\n❌ 抱歉，您的衣櫥中找不到足夠的衣物來進行搭配。")
+            return
+
+        # 以顏色、風格、場合、季節與相關度為所有上衣 x 下著組合評分，挑出最好且不重複的 3 套
+        with span("recommend.pairing", pairs=len(top_results) * len(bottom_results)):
+            outfits = pair_outfits(top_results, bottom_results, k=3)
+        print(f"\n[3/4] 👕👖 已從 {len(top_results)} x {len(bottom_results)} 種組合中挑出 {len(outfits)} 套穿搭。")
+
+        # 搭配一決定就先列出圖片，不必等文案生成
+        print("\n--- 推薦組合詳情 ---")
+        for i, (top, bottom, score) in enumerate(outfits):
+            print(f"\n組合 {i+1} (搭配分數: {score:.2f}):")
+            print(f"  - 上衣 👚: {top['image_path']}")
+            print(f"  - 下著 👖: {bottom['image_path']}")
+        outfits_ready = time.monotonic() - request_start
+
+        print(f"\n[4/4] ✍️ 正在生成推薦文案...")
+        print("\n" + "="*50)
+        print("✨ 為您專屬的穿搭建議 ✨")
+        print("="*50)
+        text_start = time.monotonic()
+        first_token_at = None
+        try:
+            with span("recommend.text_generation", streaming=stream):
+                recommendation_text, first_token_at = generate_recommendation_text(outfits, user_request, llm, stream)
+            if not stream:
+                print(recommendation_text)
+        except Exception as e:
+            # 文案只是錦上添花，LLM 無法使用時搭配組合已經列在上方
+            print(f"  !!! 推薦文案生成失敗 ({e})")
+            print("(目前無法生成推薦文案，請參考上方為您挑選的搭配組合)")
+        print("="*50)
+
+        # 記錄首字延遲與總耗時
+        request_end = time.monotonic()
+        first_token = first_token_at - request_start if first_token_at is not None else None
+        print(f"⏱️ 搭配完成: {outfits_ready:.2f} 秒" +
+              (f"，首字延遲: {first_token:.2f} 秒" if first_token is not None else "") +
+              f"，總耗時: {request_end - request_start:.2f} 秒")
+        record_request_latency(backend, model_name, user_request, stream, outfits_ready,
+                               first_token, request_end - text_start, request_end - request_start)
+
+    except Exception as e:
+        print(f"\n❌ 執行過程中發生錯誤: {e}")
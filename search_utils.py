@@ -0,0 +1,38 @@
+# --- Elasticsearch 查詢與 _source 的共用小工具 ---
+# closet_search (查詢改寫)、embedded_index (內嵌索引)、fake_services (模擬的 Elasticsearch) 與 outfit_pairing 共用，
+# 各處對 None、單一值與列表的處理才會一致。
+
+def as_list(value):
+    """查詢子句或欄位值轉為列表：列表原樣回傳，None 與空值回傳空列表，其餘包成單一元素的列表"""
+    if isinstance(value, list):
+        return value
+    return [value] if value else []
+
+def field_values(source, field):
+    """以點分隔的欄位路徑 (如 tags.style_tags，可帶 .keyword 子欄位) 取出 _source 中的值列表"""
+    value = source
+    for key in field.removesuffix(".keyword").split("."):
+        if not isinstance(value, dict):
+            return []
+        value = value.get(key)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def filter_source(source, fields):
+    """依 _source 參數 (欄位路徑列表) 只保留需要的欄位；None、True 與 False 回傳完整的 _source"""
+    if fields is None or fields is True or fields is False:
+        return source
+    filtered = {}
+    for field in fields:
+        value = source
+        for key in field.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is None:
+            continue
+        target = filtered
+        keys = field.split(".")
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+    return filtered
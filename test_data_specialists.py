@@ -4,7 +4,8 @@ import json
 import csv
 from langchain_ollama import ChatOllama
 from langchain_core.messages import HumanMessage
-from rembg import remove
+from llm_cache import print_cache_stats, cached_invoke
+from matting import remove_background
 
 # --- 1. 設定 ---
 TEST_IMAGE_DIRECTORY = "./my_clothes"
@@ -30,7 +31,7 @@ def load_prompt(file_path):
 def image_to_base64(image_path):
     with open(image_path, "rb") as input_file:
         input_data = input_file.read()
-        output_data = remove(input_data)
+        output_data = remove_background(input_data)
         return base64.b64encode(output_data).decode('utf-8')
 
 def get_schema_and_constraints():
@@ -79,7 +80,7 @@ def main():
             
             # --- 步驟 1: Llava 生成一次性的描述 ---
             print("\n--- 視覺專家 (Llava) 正在生成描述... ---")
-            vision_msg = vision_expert.invoke([HumanMessage(content=[
+            vision_msg = cached_invoke(vision_expert, [HumanMessage(content=[
                 {"type": "text", "text": vision_prompt},
                 {"type": "image_url", "image_url": f"data:image/png;base64,{image_base64}"}
             ])])
@@ -96,7 +97,7 @@ def main():
                     schema_and_constraints=schema_and_constraints
                 )
                 
-                json_msg = data_expert.invoke(final_prompt)
+                json_msg = cached_invoke(data_expert, final_prompt)
                 json_result_str = json_msg.content
 
                 # --- 步驟 3: 將結果寫入 CSV ---
@@ -116,4 +117,5 @@ def main():
                 print(f"--> {model_name} 的結果已寫入 {CSV_FILENAME}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+    print_cache_stats()
\ No newline at end of file
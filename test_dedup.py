@@ -0,0 +1,136 @@
+import argparse
+import csv
+import io
+import itertools
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+from closet_index import scan_image_directory
+from dedup import PerceptualHashIndex, perceptual_hashes, DUPLICATE_MAX_DISTANCE, DUPLICATE_MIN_COLOR_SIMILARITY
+
+# --- 1. 設定 ---
+TEST_IMAGE_DIRECTORY = "./my_clothes"   # <--- 資料夾中每張圖片都必須是不同的衣服
+CSV_FILENAME = "dedup_calibration_report.csv"
+REPORT_MAX_DISTANCE = 12                # <--- 報告中列出輪廓距離在此值以內的圖片組合
+
+# --- 2. 合成圖片 ---
+# 同一個 T 恤輪廓，分別填上不同的顏色或條紋
+T_SHIRT_OUTLINE = [(70, 40), (110, 30), (146, 30), (186, 40), (236, 90), (206, 120), (186, 100),
+                   (186, 226), (70, 226), (70, 100), (50, 120), (20, 90)]
+
+def synthetic_garment(fill, stripe=None, size=256):
+    """在透明背景上畫出 T 恤輪廓 (與去背後的 PNG 相同格式)；stripe 為條紋的顏色"""
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.polygon(T_SHIRT_OUTLINE, fill=fill)
+    if stripe is not None:
+        mask = Image.new("L", (size, size), 0)
+        ImageDraw.Draw(mask).polygon(T_SHIRT_OUTLINE, fill=255)
+        stripes = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        stripe_draw = ImageDraw.Draw(stripes)
+        for y in range(0, size, 12):
+            stripe_draw.rectangle((0, y, size, y + 5), fill=stripe)
+        image.paste(stripes, (0, 0), Image.composite(stripes, Image.new("RGBA", (size, size)), mask))
+    return _to_png(image)
+
+def _to_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def _reupload(png_data):
+    """模擬同一張照片重新上傳：縮小後再放大，並經過 JPEG 壓縮 (alpha 另外保留)"""
+    with Image.open(io.BytesIO(png_data)) as image:
+        image = image.convert("RGBA")
+    small = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.BILINEAR)
+    buffer = io.BytesIO()
+    small.convert("RGB").save(buffer, format="JPEG", quality=80)
+    with Image.open(buffer) as decoded:
+        rgb = decoded.convert("RGB")
+    rgba = rgb.copy()
+    rgba.putalpha(small.getchannel("A"))
+    return _to_png(rgba.resize(image.size, Image.BILINEAR))
+
+# --- 3. 測試 ---
+def test_same_silhouette_different_colour_or_pattern_is_not_duplicate(tmp_path="."):
+    """輪廓相同但顏色或條紋不同的衣服不能視為重複；同一件衣服重新上傳則要找得到"""
+    garments = {
+        "grey": synthetic_garment((128, 128, 128, 255)),
+        "yellow": synthetic_garment((240, 210, 60, 255)),
+        "red": synthetic_garment((200, 30, 40, 255)),
+        "navy_striped": synthetic_garment((245, 245, 245, 255), stripe=(30, 40, 80, 255)),
+    }
+    index = PerceptualHashIndex("test", path=os.path.join(str(tmp_path), ".phash_index_test.json"))
+    for name, png_data in garments.items():
+        duplicate = index.find_duplicate(perceptual_hashes(png_data))
+        assert duplicate is None, f"{name} 被誤判為 {duplicate[1]['image_name']} 的重複"
+        index.add(name, name, perceptual_hashes(png_data), {})
+
+    for name, png_data in garments.items():
+        duplicate = index.find_duplicate(perceptual_hashes(_reupload(png_data)))
+        assert duplicate is not None and duplicate[0] == name, f"重新上傳的 {name} 沒有找到原始圖片"
+
+# --- 4. 以衣櫃照片校準門檻 ---
+def load_matted_images(image_paths, fake_matting):
+    if fake_matting:
+        from fake_services import fake_remove_backgrounds
+        results = fake_remove_backgrounds(image_paths)
+    else:
+        from matting import iter_remove_backgrounds
+        results = iter_remove_backgrounds(image_paths)
+    matted = {}
+    for image_path, output_data, error in results:
+        if error is not None:
+            print(f"  !!! 去背 {image_path} 失敗: {error}")
+            continue
+        matted[os.path.basename(image_path)] = output_data
+    return matted
+
+def calibrate(fake_matting):
+    """資料夾中任兩件不同的衣服都不能被判為重複，列出最接近門檻的組合供調整 DUPLICATE_* 設定"""
+    # 內容完全相同的檔案本來就是重複 (導入時也只保留第一個檔名)，不列入比較
+    image_hashes = scan_image_directory(TEST_IMAGE_DIRECTORY)
+    if not image_hashes:
+        print(f"在 {TEST_IMAGE_DIRECTORY} 中找不到任何圖片。")
+        return True
+
+    matted = load_matted_images([os.path.join(TEST_IMAGE_DIRECTORY, name) for name in image_hashes.values()], fake_matting)
+    hashes = {name: perceptual_hashes(data) for name, data in matted.items()}
+
+    rows, false_matches = [], []
+    for a, b in itertools.combinations(hashes, 2):
+        distance = max(bin(hashes[a][0] ^ hashes[b][0]).count("1"), bin(hashes[a][1] ^ hashes[b][1]).count("1"))
+        similarity = float(np.dot(hashes[a][2] or 0, hashes[b][2] or 0))
+        matched = distance <= DUPLICATE_MAX_DISTANCE and similarity >= DUPLICATE_MIN_COLOR_SIMILARITY
+        if matched:
+            false_matches.append((a, b))
+        if distance <= REPORT_MAX_DISTANCE:
+            rows.append([a, b, distance, f"{similarity:.3f}", matched])
+
+    rows.sort(key=lambda row: row[2])
+    with open(CSV_FILENAME, 'w', newline='', encoding='utf-8') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(["image_a", "image_b", "hash_distance", "color_similarity", "flagged_duplicate"])
+        csv_writer.writerows(rows)
+
+    print(f"{len(hashes)} 張圖片，門檻: 漢明距離 <= {DUPLICATE_MAX_DISTANCE}，顏色相似度 >= {DUPLICATE_MIN_COLOR_SIMILARITY}")
+    if rows:
+        print(f"不同衣服之間最小的輪廓距離: {rows[0][2]} ({rows[0][0]} / {rows[0][1]})")
+    for a, b in false_matches:
+        print(f"  !!! {a} 與 {b} 是不同的衣服，卻被判為重複")
+    print(f"報告已寫入: {CSV_FILENAME}")
+    return not false_matches
+
+# --- 5. 主程式 ---
+def main():
+    parser = argparse.ArgumentParser(description="重複圖片判定的測試與門檻校準")
+    parser.add_argument("--fake-matting", action="store_true", help="以 fake_services 的白底去背代替 rembg (不需要下載模型)")
+    args = parser.parse_args()
+
+    test_same_silhouette_different_colour_or_pattern_is_not_duplicate()
+    print("合成圖片測試通過：輪廓相同但顏色或條紋不同的衣服不會被判為重複")
+    if not calibrate(args.fake_matting):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
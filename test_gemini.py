@@ -3,11 +3,17 @@ import base64
 import json
 import csv
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import google.generativeai as genai
 from langchain_ollama import ChatOllama
 from langchain_core.messages import HumanMessage
-from rembg import remove
+from llm_cache import print_cache_stats, cached_invoke, cached_generate_content
+from matting import remove_background
+from llm_client import BACKEND_LIMITS
+from ollama_phases import run_phase, OLLAMA_KEEP_ALIVE
+from closet_schema import build_json_schema, render_schema_prompt
+from gemini_batch import GEMINI_SINGLE_CONFIG
 from PIL import Image
 import io
 
@@ -30,7 +36,7 @@ GEMINI_MODEL = "gemini-2.5-pro"
 # 報告檔案
 CSV_FILENAME = "ollama_vs_gemini_comparison.csv"
 CSV_HEADERS = [
-    "image_name", "method", "processing_time_seconds", "primary_category", "sub_category", "main_color",
+    "image_name", "method", "processing_time_seconds", "model_load_seconds", "primary_category", "sub_category", "main_color",
     "secondary_colors", "pattern", "sleeve_length", "neckline", "fit",
     "material_guess", "suitable_seasons", "style_tags", "occasion_tags", "raw_json_output"
 ]
@@ -43,40 +49,50 @@ def load_prompt(file_path):
 def image_to_bytes(image_path):
     with open(image_path, "rb") as input_file:
         input_data = input_file.read()
-        return remove(input_data)
+        return remove_background(input_data)
 
 def get_schema_and_constraints():
-    # ... (此函式與您之前的版本完全相同，此處省略以保持簡潔)
-    return """
-    The output must be a single, valid JSON object... (略)
-    """
+    # 與導入腳本共用 closet_schema 產生的欄位說明，兩邊的比較才有意義
+    return render_schema_prompt()
 
 # --- 3. 核心處理流程 ---
-def process_with_ollama_chain(image_name, image_bytes, prompts):
-    print("\n--- 正在使用 Ollama 專家鏈處理 ---")
-    start_time = time.monotonic()
+def process_with_ollama_chain(images, prompts):
+    """分兩個階段執行 Ollama 專家鏈：先用 Llava 描述所有圖片，再用 Gemma 3 轉換所有描述
 
-    vision_expert = ChatOllama(model=VISION_MODEL, base_url=OLLAMA_BASE_URL, temperature=0)
-    data_expert = ChatOllama(model=DATA_MODEL, base_url=OLLAMA_BASE_URL, format="json", temperature=0)
-    
-    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+    每個階段內模型保持常駐，不會每張圖片都在兩個模型之間切換；
+    回傳 {image_name: (json 字串, 推論秒數, 模型載入秒數)}，載入時間不計入推論時間。
+    """
+    print("\n--- 正在使用 Ollama 專家鏈處理 ---")
+    vision_expert = ChatOllama(model=VISION_MODEL, base_url=OLLAMA_BASE_URL, temperature=0, keep_alive=OLLAMA_KEEP_ALIVE)
+    data_expert = ChatOllama(model=DATA_MODEL, base_url=OLLAMA_BASE_URL, format=build_json_schema(), temperature=0, keep_alive=OLLAMA_KEEP_ALIVE)
 
     # 步驟 1: Llava 生成描述
-    vision_msg = vision_expert.invoke([HumanMessage(content=[
-        {"type": "text", "text": prompts["vision"]},
-        {"type": "image_url", "image_url": f"data:image/png;base64,{image_base64}"}
-    ])])
-    description = vision_msg.content
-    
+    def describe(image_name):
+        image_base64 = base64.b64encode(images[image_name]).decode('utf-8')
+        return cached_invoke(vision_expert, [HumanMessage(content=[
+            {"type": "text", "text": prompts["vision"]},
+            {"type": "image_url", "image_url": f"data:image/png;base64,{image_base64}"}
+        ])])
+    vision_results, vision_stats = run_phase("Llava", OLLAMA_BASE_URL, VISION_MODEL, list(images), describe)
+    descriptions = {name: msg.content for name, msg in vision_results.items() if not isinstance(msg, Exception)}
+
     # 步驟 2: Gemma 3 轉換為 JSON
-    final_prompt = prompts["data"].format(
-        description_from_llava=description,
-        schema_and_constraints=prompts["schema"]
-    )
-    json_msg = data_expert.invoke(final_prompt)
-    
-    end_time = time.monotonic()
-    return json_msg.content, end_time - start_time
+    def structure(image_name):
+        final_prompt = prompts["data"].format(
+            description_from_llava=descriptions[image_name],
+            schema_and_constraints=prompts["schema"]
+        )
+        return cached_invoke(data_expert, final_prompt)
+    json_results, data_stats = run_phase("Gemma 3", OLLAMA_BASE_URL, DATA_MODEL, list(descriptions), structure)
+
+    results = {}
+    for image_name in images:
+        message = json_results.get(image_name, vision_results.get(image_name))
+        vision_load, vision_inference = vision_stats["durations"].get(image_name, (0.0, 0.0))
+        data_load, data_inference = data_stats["durations"].get(image_name, (0.0, 0.0))
+        json_str = str(message) if isinstance(message, Exception) else message.content
+        results[image_name] = (json_str, vision_inference + data_inference, vision_load + data_load)
+    return results
 
 def process_with_gemini(image_name, image_bytes, prompt):
     print("\n--- 正在使用 Gemini 2.5 Pro 處理 ---")
@@ -90,15 +106,11 @@ def process_with_gemini(image_name, image_bytes, prompt):
     model = genai.GenerativeModel(GEMINI_MODEL)
     
     # 建立多模態請求
-    response = model.generate_content([prompt, image_pil])
+    # response_schema 強制輸出純 JSON，不需要再清理 Markdown
+    response = cached_generate_content(model, [prompt, image_pil], generation_config=GEMINI_SINGLE_CONFIG)
     
     end_time = time.monotonic()
-    # Gemini 可能會在回應中加入 Markdown，我們需要清理它
-    cleaned_response = response.text.strip()
-    if cleaned_response.startswith("```json"):
-        cleaned_response = cleaned_response[7:-3].strip()
-        
-    return cleaned_response, end_time - start_time
+    return response.text.strip(), end_time - start_time
 
 def main():
     if not GOOGLE_API_KEY:
@@ -120,33 +132,45 @@ def main():
         csv_writer.writerow(CSV_HEADERS)
         print(f"已建立報告檔案: {CSV_FILENAME}")
 
+        images = {}
         for image_name in test_image_files:
-            print(f"\n{'='*20} 正在處理圖片: {image_name} {'='*20}")
+            print(f"正在去背: {image_name}")
             image_path = os.path.join(TEST_IMAGE_DIRECTORY, image_name)
-            image_bytes = image_to_bytes(image_path) # 移除背景後的圖片 bytes
-            
-            # 執行兩個流程
-            all_results = {
-                "ollama_chain": process_with_ollama_chain(image_name, image_bytes, prompts),
-                "gemini_api": process_with_gemini(image_name, image_bytes, prompts["gemini"])
-            }
-            
-            # 將結果寫入 CSV
-            for method, (json_str, duration) in all_results.items():
-                row_data = {"image_name": image_name, "method": method, "processing_time_seconds": f"{duration:.2f}", "raw_json_output": json_str}
-                try:
-                    parsed_json = json.loads(json_str)
-                    for header in CSV_HEADERS:
-                        if header not in row_data:
-                            value = parsed_json.get(header, 'N/A')
-                            row_data[header] = ", ".join(value) if isinstance(value, list) else value
-                except (json.JSONDecodeError, AttributeError):
-                    for header in CSV_HEADERS:
-                        if header not in row_data:
-                            row_data[header] = "INVALID_JSON"
-                
-                csv_writer.writerow([row_data.get(h, '') for h in CSV_HEADERS])
-                print(f"--> {method} 的結果已寫入 CSV (耗時: {duration:.2f} 秒)")
+            images[image_name] = image_to_bytes(image_path) # 移除背景後的圖片 bytes
+
+        # Gemini 與 Ollama 是不同的後端，Gemini 請求在背景執行緒中進行，同時 Ollama 依階段處理
+        with ThreadPoolExecutor(max_workers=BACKEND_LIMITS["gemini"]["max_concurrency"]) as pool:
+            gemini_futures = {name: pool.submit(process_with_gemini, name, data, prompts["gemini"]) for name, data in images.items()}
+            ollama_results = process_with_ollama_chain(images, prompts)
+
+            for image_name in test_image_files:
+                json_str, duration, load_seconds = ollama_results[image_name]
+                gemini_json, gemini_duration = gemini_futures[image_name].result()
+                all_results = {
+                    "ollama_chain": (json_str, duration, load_seconds),
+                    "gemini_api": (gemini_json, gemini_duration, 0.0)
+                }
+                write_results(csv_writer, image_name, all_results)
+
+def write_results(csv_writer, image_name, all_results):
+    """將兩種方法的結果寫入 CSV"""
+    for method, (json_str, duration, load_seconds) in all_results.items():
+        row_data = {"image_name": image_name, "method": method, "processing_time_seconds": f"{duration:.2f}",
+                    "model_load_seconds": f"{load_seconds:.2f}", "raw_json_output": json_str}
+        try:
+            parsed_json = json.loads(json_str)
+            for header in CSV_HEADERS:
+                if header not in row_data:
+                    value = parsed_json.get(header, 'N/A')
+                    row_data[header] = ", ".join(value) if isinstance(value, list) else value
+        except (json.JSONDecodeError, AttributeError):
+            for header in CSV_HEADERS:
+                if header not in row_data:
+                    row_data[header] = "INVALID_JSON"
+        
+        csv_writer.writerow([row_data.get(h, '') for h in CSV_HEADERS])
+        print(f"--> {method} 的結果已寫入 CSV (耗時: {duration:.2f} 秒)")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+    print_cache_stats()
\ No newline at end of file
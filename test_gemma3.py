@@ -3,7 +3,8 @@ import base64
 import json
 from langchain_ollama import ChatOllama
 from langchain_core.messages import HumanMessage
-from rembg import remove
+from llm_cache import print_cache_stats, cached_invoke
+from matting import remove_background
 
 # --- 1. 設定 ---
 TEST_IMAGE_DIRECTORY = "./my_clothes"  # 使用我們之前建立的測試圖片資料夾
@@ -19,7 +20,7 @@ def load_prompt(file_path):
 def image_to_base64(image_path):
     with open(image_path, "rb") as input_file:
         input_data = input_file.read()
-        output_data = remove(input_data)
+        output_data = remove_background(input_data)
         return base64.b64encode(output_data).decode('utf-8')
 
 def main():
@@ -44,7 +45,7 @@ def main():
         image_base64 = image_to_base64(image_path)
         
         try:
-            msg = llm.invoke(
+            msg = cached_invoke(llm,
                 [
                     HumanMessage(
                         content=[
@@ -71,4 +72,5 @@ def main():
             print(f"!!! 處理圖片時發生未知錯誤: {e}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+    print_cache_stats()
\ No newline at end of file
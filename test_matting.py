@@ -0,0 +1,72 @@
+import csv
+import os
+import time
+import numpy as np
+from PIL import Image, ImageOps
+from matting import predict_mask, MATTING_MAX_EDGE
+
+# --- 1. 設定 ---
+TEST_IMAGE_DIRECTORY = "./test_pic"
+CSV_FILENAME = "matting_quality_report.csv"
+REFERENCE_MODE = "quality"
+CANDIDATE_MODE = "fast"
+MASK_THRESHOLD = 128     # <--- 遮罩值大於此值視為衣物
+MIN_ACCEPTABLE_IOU = 0.9 # <--- 所有圖片的 IoU 都達到此值，才建議改用 fast 模式
+
+# --- 2. 輔助函式 ---
+def load_image(image_path):
+    """與 matting._matte 相同的前處理：轉正並縮到 MATTING_MAX_EDGE"""
+    with Image.open(image_path) as source:
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    image.thumbnail((MATTING_MAX_EDGE, MATTING_MAX_EDGE), Image.LANCZOS)
+    return image
+
+def timed_mask(image, mode):
+    start_time = time.monotonic()
+    mask = predict_mask(image, mode)
+    return np.asarray(mask) > MASK_THRESHOLD, time.monotonic() - start_time
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+# --- 3. 主程式 ---
+def main():
+    image_files = sorted(f for f in os.listdir(TEST_IMAGE_DIRECTORY) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+    if not image_files:
+        print(f"在 {TEST_IMAGE_DIRECTORY} 中找不到任何圖片。")
+        return
+
+    # 先各跑一次，讓模型載入時間不計入第一張圖片
+    warmup = load_image(os.path.join(TEST_IMAGE_DIRECTORY, image_files[0]))
+    predict_mask(warmup, REFERENCE_MODE)
+    predict_mask(warmup, CANDIDATE_MODE)
+
+    rows = []
+    for image_name in image_files:
+        image = load_image(os.path.join(TEST_IMAGE_DIRECTORY, image_name))
+        reference_mask, reference_seconds = timed_mask(image, REFERENCE_MODE)
+        candidate_mask, candidate_seconds = timed_mask(image, CANDIDATE_MODE)
+        iou = mask_iou(reference_mask, candidate_mask)
+        print(f"  -> {image_name}: IoU {iou:.3f}，{REFERENCE_MODE} {reference_seconds:.2f} 秒 / {CANDIDATE_MODE} {candidate_seconds:.2f} 秒")
+        rows.append([image_name, f"{iou:.4f}", f"{reference_seconds:.3f}", f"{candidate_seconds:.3f}"])
+
+    with open(CSV_FILENAME, 'w', newline='', encoding='utf-8') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(["image_name", "mask_iou", f"{REFERENCE_MODE}_seconds", f"{CANDIDATE_MODE}_seconds"])
+        csv_writer.writerows(rows)
+
+    ious = [float(row[1]) for row in rows]
+    reference_total = sum(float(row[2]) for row in rows)
+    candidate_total = sum(float(row[3]) for row in rows)
+    print(f"\n平均 IoU: {np.mean(ious):.3f}，最低 IoU: {min(ious):.3f}")
+    print(f"總耗時: {REFERENCE_MODE} {reference_total:.2f} 秒 / {CANDIDATE_MODE} {candidate_total:.2f} 秒 "
+          f"(加速 {reference_total / candidate_total if candidate_total else 0:.1f} 倍)")
+    if min(ious) >= MIN_ACCEPTABLE_IOU:
+        print(f"✅ 所有圖片的 IoU 都達到 {MIN_ACCEPTABLE_IOU}，可以設定 MATTING_MODE={CANDIDATE_MODE}")
+    else:
+        print(f"⚠️ 有圖片的 IoU 低於 {MIN_ACCEPTABLE_IOU}，建議繼續使用 {REFERENCE_MODE} 模式")
+    print(f"詳細結果已寫入: {CSV_FILENAME}")
+
+if __name__ == "__main__":
+    main()
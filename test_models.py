@@ -3,7 +3,8 @@ import base64
 import json
 from langchain_ollama import ChatOllama
 from langchain_core.messages import HumanMessage
-from rembg import remove
+from llm_cache import print_cache_stats, cached_invoke
+from matting import remove_background
 
 # --- 1. 設定 ---
 TEST_IMAGE_DIRECTORY = "./my_clothes"
@@ -35,7 +36,7 @@ def load_prompt(file_path):
 def image_to_base64(image_path):
     with open(image_path, "rb") as input_file:
         input_data = input_file.read()
-        output_data = remove(input_data)
+        output_data = remove_background(input_data)
         return base64.b64encode(output_data).decode('utf-8')
 
 def main():
@@ -81,7 +82,7 @@ def main():
         
         # --- 步驟 1: 視覺專家 (Llava) 進行描述 ---
         print("\n--- 視覺專家 (Llava) 正在描述圖片... ---")
-        vision_msg = vision_expert.invoke([HumanMessage(content=[
+        vision_msg = cached_invoke(vision_expert, [HumanMessage(content=[
             {"type": "text", "text": vision_prompt},
             {"type": "image_url", "image_url": f"data:image/png;base64,{image_base64}"}
         ])])
@@ -94,9 +95,10 @@ def main():
             description_from_llava=description,
             schema_and_constraints=schema_and_constraints
         )
-        json_msg = data_expert.invoke(final_prompt)
+        json_msg = cached_invoke(data_expert, final_prompt)
         final_json = json_msg.content
         print(final_json)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+    print_cache_stats()
\ No newline at end of file
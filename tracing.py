@@ -0,0 +1,154 @@
+import csv
+import itertools
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# --- 1. 設定 ---
+TRACING_ENABLED = os.getenv("CLOSET_TRACE", "0") != "0"  # <--- 設定環境變數 CLOSET_TRACE=1 啟用追蹤
+TRACE_PATH = "./closet_trace.jsonl"                       # <--- 每個 span 一行 JSON
+TRACE_SUMMARY_FILENAME = "closet_trace_summary.csv"       # <--- 各階段的次數、總秒數與 p50/p95/max
+
+# --- 2. Span ---
+_spans = []
+_spans_lock = threading.Lock()
+_ids = itertools.count(1)
+_local = threading.local()
+# perf_counter 沒有絕對時間，以啟動時的對照換算成 Unix 時間
+_CLOCK_OFFSET = time.time() - time.perf_counter()
+
+class Span:
+    """一段計時區間；timings 不是 None 時，結束後把秒數累加到 timings[階段名稱] (CSV 報告的每階段欄位)"""
+    __slots__ = ("name", "attrs", "timings", "start", "duration", "span_id", "parent_id")
+
+    def __init__(self, name, timings, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.timings = timings
+        self.duration = None
+        self.span_id = None
+        self.parent_id = None
+
+    def set(self, **attrs):
+        """在 span 進行中補上屬性 (例如回應的 token 數)"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        if TRACING_ENABLED:
+            stack = _stack()
+            self.span_id = next(_ids)
+            self.parent_id = stack[-1].span_id if stack else None
+            stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if self.timings is not None:
+            stage = self.name.rsplit(".", 1)[-1]
+            self.timings[stage] = self.timings.get(stage, 0.0) + self.duration
+        if self.span_id is not None:
+            _stack().pop()
+            _record(self.name, self.span_id, self.parent_id, self.start, self.duration, self.attrs, exc)
+        return False
+
+def _record(name, span_id, parent_id, start, duration, attrs, error=None):
+    record = {"name": name, "span_id": span_id, "parent_id": parent_id, "thread": threading.current_thread().name,
+              "start": round(_CLOCK_OFFSET + start, 6), "duration": round(duration, 6),
+              "error": None if error is None else repr(error)}
+    if attrs:
+        record["attrs"] = attrs
+    with _spans_lock:
+        _spans.append(record)
+
+class _NullSpan:
+    """停用追蹤且不需要秒數時使用的共用物件，進出都不做任何事"""
+    duration = None
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def span(name, timings=None, **attrs):
+    """with span("ingest_gemini.encode_payload", image=name): ...
+
+    名稱以「元件.階段」命名；停用追蹤又沒有 timings 時直接回傳共用的空物件，幾乎沒有額外成本。
+    """
+    if not TRACING_ENABLED and timings is None:
+        return _NULL_SPAN
+    return Span(name, timings, attrs)
+
+def timed_iter(name, iterable):
+    """逐筆取出 iterable，等待每一筆的時間各記為一個 span，yield (值, 秒數)
+
+    適合包在行程池這類產生器外面：真正的工作在其他行程中，這裡量到的是等待結果的時間。
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            value = next(iterator)
+        except StopIteration:
+            return
+        duration = time.perf_counter() - start
+        if TRACING_ENABLED:
+            stack = _stack()
+            _record(name, next(_ids), stack[-1].span_id if stack else None, start, duration, None)
+        yield value, duration
+
+def enable_tracing(enabled=True):
+    global TRACING_ENABLED
+    TRACING_ENABLED = enabled
+
+# --- 3. 匯出與彙總 ---
+def summarize(records):
+    """每個 span 名稱一列：次數、總秒數與 p50/p95/max 秒數"""
+    durations = {}
+    for record in records:
+        durations.setdefault(record["name"], []).append(record["duration"])
+    rows = []
+    for name, values in sorted(durations.items()):
+        values = np.array(values)
+        rows.append({"stage": name, "count": len(values), "total_seconds": round(float(values.sum()), 4),
+                     "p50_seconds": round(float(np.percentile(values, 50)), 4),
+                     "p95_seconds": round(float(np.percentile(values, 95)), 4),
+                     "max_seconds": round(float(values.max()), 4)})
+    return rows
+
+def export_trace(path=TRACE_PATH, summary_filename=TRACE_SUMMARY_FILENAME):
+    """把本次執行的 span 附加到 JSONL 檔，並覆寫彙總報告；停用追蹤時不做任何事"""
+    if not TRACING_ENABLED:
+        return
+    with _spans_lock:
+        records = list(_spans)
+        _spans.clear()
+    if not records:
+        return
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    rows = summarize(records)
+    with open(summary_filename, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=["stage", "count", "total_seconds", "p50_seconds", "p95_seconds", "max_seconds"])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"\n--- 追蹤摘要 ({len(records)} 個 span 已寫入 {path}) ---")
+    for row in rows:
+        print(f"  {row['stage']:<40} {row['count']:>5} 次  總計 {row['total_seconds']:>8.2f} 秒  "
+              f"p50 {row['p50_seconds']:.3f}  p95 {row['p95_seconds']:.3f}  max {row['max_seconds']:.3f}")
+    print(f"彙總報告已寫入: {summary_filename}")